@@ -15,7 +15,7 @@ import urlparse
 
 import lxml.html
 
-from simplespider import Spider
+from simplespider import Spider, setup_logging
 from simplespider.storage import DictStorage, AnydbmStorage, StoreObjectTask
 from simplespider.web import DownloadTask, BaseScraper, Downloader, \
     LinkExtractor
@@ -114,6 +114,7 @@ spider.add_runners([
 
 
 if __name__ == '__main__':
+    setup_logging()
     try:
         ## Prepare the storage
         if len(sys.argv) > 1:
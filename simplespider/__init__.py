@@ -5,29 +5,55 @@ The spider class will simply handle a queue of tasks
 and distribute them amongst a bunch of runners.
 """
 
+from collections import deque
 import copy
 import logging
+import Queue
 import sys
+import threading
+import time
 import uuid
 
 import six
 
+from simplespider.frontier import SpillFile
+from simplespider.metrics import Registry
+from simplespider.retry import RetryScheduler, backoff_delay
+from simplespider.utils import current_rss
+
 __version__ = '0.1a'
 
+_END = object()  # end of the results stream
+
 
 logger = logging.getLogger(__name__)
-handler = logging.StreamHandler(sys.stderr)
-handler.setLevel(logging.DEBUG)
 try:
-    from cool_logging.formatters import ConsoleColorFormatter
-    # pip install cool_logging==0.2-beta
-except ImportError:  # pragma: no cover
-    handler.setFormatter(logging.Formatter(
-        "%(levelname)s %(filename)s:%(lineno)d %(funcName)s: %(message)s"))
-else:
-    handler.setFormatter(ConsoleColorFormatter())
-logger.addHandler(handler)
-logger.setLevel(logging.DEBUG)
+    logger.addHandler(logging.NullHandler())
+except AttributeError:  # pragma: no cover
+    pass  # Python 2.6
+
+
+def setup_logging(level=logging.DEBUG):
+    """
+    Send the spider log messages to stderr.
+
+    Logging is not configured by default, so debug messages
+    stay off the hot path unless asked for.
+    """
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setLevel(level)
+    try:
+        from cool_logging.formatters import ConsoleColorFormatter
+        # pip install cool_logging==0.2-beta
+    except ImportError:  # pragma: no cover
+        handler.setFormatter(logging.Formatter(
+            "%(levelname)s %(filename)s:%(lineno)d %(funcName)s: "
+            "%(message)s"))
+    else:
+        handler.setFormatter(ConsoleColorFormatter())
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    return handler
 
 
 class BaseTask(object):
@@ -97,15 +123,15 @@ class BaseTask(object):
     def from_dict(cls, data):
         data = copy.deepcopy(data)  # so we can safely modify..
         if '_type' in data:
-            module, name = data.pop('_type').split(':')
+            module, name = str(data.pop('_type')).split(':')
             mod = __import__(module, globals(), globals(), [name])
             klass = getattr(mod, name)
             if not issubclass(klass, BaseTask):
                 raise TypeError("Invalid object: not a BaseTask")
         else:
             klass = cls
-        task_id = data.pop('task_id', None)
-        data.pop('_id', None)
+        task_id = data.pop('_id', None)
+        task_id = data.pop('task_id', task_id)
         data.pop('_type', None)
         return klass(task_id=task_id, **data)
 
@@ -143,7 +169,25 @@ class BaseTaskRunner(object):
 
 
 class RetryTask(Exception):
-    """Ask for the task to be retried"""
+    """
+    Ask for the task to be retried.
+
+    :param retry_after:
+        minimum number of seconds to wait before retrying,
+        eg. from a ``Retry-After`` HTTP header. If not specified,
+        the spider will use exponential backoff.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.retry_after = kwargs.pop('retry_after', None)
+        super(RetryTask, self).__init__(*args, **kwargs)
+
+
+class DeferTask(RetryTask):
+    """
+    Ask for the task to be run again later, without counting
+    this as a failed attempt (eg. when its host is unavailable).
+    """
     pass
 
 
@@ -165,8 +209,92 @@ class Spider(object):
 
         :param storage: object used to store objects
         :param queue: object used to handle the task queue
+        :param retry_delay: seconds to wait before the first retry
+            of a failed task. Retries are kept in memory, and the task
+            is only marked as done in the queue (eg. its message
+            acknowledged) once it stops being retried: if the process
+            dies meanwhile, durable queues deliver it again. (Default: 1)
+        :param retry_backoff: factor by which the delay is multiplied
+            at each subsequent retry. (Default: 2)
+        :param retry_max_delay: maximum delay between retries, in
+            seconds. (Default: 300)
+        :param retry_jitter: maximum fraction of the delay that is
+            randomly taken away. (Default: 0.5)
+        :param metrics: :py:class:`~simplespider.metrics.Registry`
+            used to keep statistics. (Default: a new registry)
+        :param tracer: :py:class:`~simplespider.tracing.Tracer` used
+            to record the lifecycle of (a sample of) the tasks.
+            (Default: None)
+        :param profiler: :py:class:`~simplespider.profiling.Profiler`
+            used to profile (a sample of) the runner executions.
+            (Default: None)
+        :param fuse: task classes (or a function telling whether
+            a task qualifies) to be run right away, depth-first,
+            when yielded by a runner, instead of going through the
+            queue, as long as a local runner accepts them. Useful eg.
+            for ``ScrapingTask``, which carries a whole page.
+            (Default: None, everything is queued)
+        :param fuse_max_depth: maximum nesting of fused tasks; deeper
+            ones are queued as usual. (Default: 8)
+        :param frontier_high_water: queue length above which new tasks
+            are spilled to disk instead of being queued, until the
+            queue drains down to ``frontier_low_water``; the spilled
+            tasks are then queued again. (Default: None, no limit)
+        :param frontier_low_water: see above. (Default: half of
+            ``frontier_high_water``)
+        :param frontier_max_rss: resident memory, in bytes, above
+            which new tasks are spilled too. (Default: None)
+        :param frontier_pause: task classes whose execution is put off
+            (eg. ``ScrapingTask``, to stop extracting new links) while
+            over the high-water mark. (Default: None)
+        :param frontier_spill_dir: directory for the spilled tasks.
+            (Default: the system temporary directory)
+        :param frontier_check_every: how many queue operations to
+            wait between checks of the queue length. (Default: 100)
+        :param queue_batch_size: maximum number of tasks yielded by a
+            runner to be collected before pushing them to the queue
+            at once. (Default: 500)
+        :param recrawl: :py:class:`~simplespider.recrawl.RecrawlIndex`
+            (or any object with ``pop_due_tasks(limit=...)`` and
+            ``next_due()`` methods) whose due URLs are queued again.
+            (Default: None)
+        :param recrawl_check_interval: seconds between checks for due
+            URLs. (Default: 1)
+        :param recrawl_wait: how long to wait, when there's nothing
+            else to do, for URLs to become due, in seconds.
+            (Default: None, forever)
+        :param budget: :py:class:`~simplespider.budget.CrawlBudget`
+            each task is checked against before being run; the crawl
+            stops when its job-wide limits are reached. (Default: None)
         """
 
+        kwargs.setdefault('retry_delay', 1.0)
+        kwargs.setdefault('retry_backoff', 2.0)
+        kwargs.setdefault('retry_max_delay', 300.0)
+        kwargs.setdefault('retry_jitter', 0.5)
+        if kwargs.get('metrics') is None:
+            kwargs['metrics'] = Registry()
+        kwargs.setdefault('tracer', None)
+        kwargs.setdefault('profiler', None)
+        if isinstance(kwargs.get('fuse'), list):
+            kwargs['fuse'] = tuple(kwargs['fuse'])
+        kwargs.setdefault('fuse', None)
+        kwargs.setdefault('fuse_max_depth', 8)
+        kwargs.setdefault('frontier_high_water', None)
+        if kwargs.get('frontier_low_water') is None and \
+                kwargs['frontier_high_water'] is not None:
+            kwargs['frontier_low_water'] = kwargs['frontier_high_water'] // 2
+        kwargs.setdefault('frontier_max_rss', None)
+        if isinstance(kwargs.get('frontier_pause'), list):
+            kwargs['frontier_pause'] = tuple(kwargs['frontier_pause'])
+        kwargs.setdefault('frontier_pause', None)
+        kwargs.setdefault('frontier_spill_dir', None)
+        kwargs.setdefault('frontier_check_every', 100)
+        kwargs.setdefault('queue_batch_size', 500)
+        kwargs.setdefault('recrawl', None)
+        kwargs.setdefault('recrawl_check_interval', 1.0)
+        kwargs.setdefault('recrawl_wait', None)
+        kwargs.setdefault('budget', None)
         self.conf = kwargs
 
         ## Registers of downloaders and scrapers
@@ -175,72 +303,487 @@ class Spider(object):
         ## Keep a list of already downloaded
         ## URLs to prevent infinite recursion.
         ## todo: we need a smarter way to do this..
-        self._already_done = set()
+        self._already_done = set()  # ids of the fused tasks
+        self._fuse_depth = 0
+
+        ## Failed tasks waiting to be retried, and the names they
+        ## were popped from the queue with (by id() of the task)
+        self._retry_scheduler = RetryScheduler()
+        self._retrying = set()
+        self._retry_names = {}
+
+        ## Tasks kept out of the queue, while it's too long
+        self._bounded_frontier = (
+            self.conf['frontier_high_water'] is not None or
+            self.conf['frontier_max_rss'] is not None)
+        self._backpressure = False
+        self._frontier_ops = 0
+        self._frontier_next_check = 0
+        self._spilled = SpillFile(self.conf['frontier_spill_dir'])
+        self._spilled_names = set()  # the queue didn't see them yet
+        self._paused = SpillFile(self.conf['frontier_spill_dir'])
+
+        ## Buffer of the objects yielded by runners, while
+        ## they're being consumed through iter_results()
+        self._results = None
+        self._results_closed = False
+
+        self._next_recrawl_check = 0
+
+        self._setup_metrics(self.conf['metrics'])
+
+    def _setup_metrics(self, metrics):
+        self.metrics = metrics
+        self._m_tasks = metrics.counter(
+            'simplespider_tasks_total', 'Tasks run, by type and outcome',
+            ['type', 'outcome'])
+        self._m_queued = metrics.counter(
+            'simplespider_tasks_queued_total', 'Tasks queued, by type',
+            ['type'])
+        self._m_fused = metrics.counter(
+            'simplespider_tasks_fused_total',
+            'Tasks run right away, bypassing the queue', ['type'])
+        self._m_retries = metrics.counter(
+            'simplespider_retries_total', 'Tasks scheduled for retry',
+            ['type'])
+        self._m_task_time = metrics.histogram(
+            'simplespider_task_seconds', 'Task execution time, by type',
+            ['type'])
+        self._m_runner_time = metrics.histogram(
+            'simplespider_runner_seconds', 'Time spent in each runner',
+            ['runner'])
+        metrics.gauge('simplespider_queue_depth', 'Tasks in the queue',
+                      lambda: len(self._task_queue))
+        metrics.gauge('simplespider_retries_pending',
+                      'Tasks waiting to be retried',
+                      lambda: len(self._retry_scheduler))
+        metrics.gauge('simplespider_frontier_spilled',
+                      'Tasks spilled to disk, or paused',
+                      lambda: len(self._spilled) + len(self._paused))
+        metrics.gauge('simplespider_frontier_backpressure',
+                      'Whether the queue is over the high-water mark',
+                      lambda: int(self._backpressure))
+        self._m_results = metrics.counter(
+            'simplespider_results_total',
+            'Objects yielded by runners, streamed to iter_results()')
+        metrics.gauge('simplespider_results_buffered',
+                      'Objects waiting to be read from iter_results()',
+                      lambda: self._results.qsize()
+                      if self._results is not None else 0)
+        metrics.gauge('simplespider_tasks_per_second',
+                      'Average tasks run per second',
+                      lambda: metrics.rate('simplespider_tasks_total'))
 
     def add_runners(self, runners):
         self._runners.extend(runners)
 
     def _get_runners(self, task):
-        logger.debug("Looking for runners suitable to run {0!r}".format(task))
-        logger.debug("We have {0} registered runners".format(
-            len(self._runners)))
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("Looking for runners suitable to run %r "
+                         "(out of %d)", task, len(self._runners))
+        tracer = self.conf['tracer']
         for runner in self._runners:
-            logger.debug("Trying {0!r}".format(runner))
-            if runner.match(task):
-                logger.debug("Runner {0!r} matched".format(runner))
+            if tracer is not None:
+                start = tracer.begin()
+                matched = runner.match(task)
+                tracer.end(start, type(runner).__name__, 'match',
+                           matched=bool(matched))
+            else:
+                matched = runner.match(task)
+            if matched:
+                if debug:
+                    logger.debug("Runner %r matched", runner)
                 yield runner
 
     def queue_task(self, task):
         """Queue a task for later execution"""
-        logger.debug("Scheduling new task: {0!r}".format(task))
+        logger.debug("Scheduling new task: %r", task)
         if not isinstance(task, BaseTask):
             raise TypeError("This doesn't look like a task!")
+        self._m_queued.inc(labels=(task.type,))
+        if self.conf['tracer'] is not None:
+            self.conf['tracer'].task_queued(task)
+        if self._bounded_frontier:
+            self._check_frontier()
+            if self._backpressure:
+                self._spill(task.id, task)
+                return
         self._task_queue.push(task.id, task)
 
-    def yield_tasks(self):
-        """Continue yielding tasks until queue is empty"""
+    def queue_tasks(self, tasks):
+        """
+        Queue many tasks at once. Duplicates within the batch are
+        dropped right away; the others are pushed to the queue
+        in bulk, with ``push_many()``.
+        """
+        seen = set()
+        batch = []
+        counts = {}
+        for task in tasks:
+            if not isinstance(task, BaseTask):
+                raise TypeError("This doesn't look like a task!")
+            if task.id in seen:
+                continue
+            seen.add(task.id)
+            batch.append((task.id, task))
+            counts[task.type] = counts.get(task.type, 0) + 1
+        if not batch:
+            return
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Scheduling %d new tasks", len(batch))
+
+        for task_type, count in counts.iteritems():
+            self._m_queued.inc(count, (task_type,))
+        tracer = self.conf['tracer']
+        if tracer is not None:
+            for name, task in batch:
+                tracer.task_queued(task)
+        if self._bounded_frontier:
+            self._check_frontier(ops=len(batch))
+            if self._backpressure:
+                for name, task in batch:
+                    self._spill(name, task)
+                return
+        self._task_queue.push_many(batch)
+
+    def flush(self):
+        """
+        Make sure all the queued tasks reached the queue, for queues
+        buffering their pushes (call it after queuing tasks from
+        outside of the spider run)
+        """
+        self._task_queue.flush()
+
+    def _spill(self, name, task):
+        """
+        Put a task aside on disk, unless it would be dropped as a
+        duplicate by the queue, so that the spill file grows with the
+        number of new tasks (not with the number of links found)
+        """
+        if name in self._spilled_names or self._task_queue.seen(name, task):
+            return
+        self._spilled_names.add(name)
+        self._spilled.append(name, task)
+
+    def _check_frontier(self, force=False, ops=1):
+        """
+        Update the backpressure state, every ``frontier_check_every``
+        queue operations (or now, if forced), and move spilled tasks
+        back to the queue when there is room.
+
+        :return: the number of tasks moved back to the queue
+        """
+        self._frontier_ops += ops
+        every = self.conf['frontier_check_every']
+        if not force and self._frontier_ops < self._frontier_next_check:
+            return 0
+        self._frontier_next_check = self._frontier_ops + every
+        high = self.conf['frontier_high_water']
+        max_rss = self.conf['frontier_max_rss']
+        depth = len(self._task_queue)
+        if (high is not None and depth >= high) or \
+                (max_rss is not None and (current_rss() or 0) >= max_rss):
+            if not self._backpressure:
+                logger.info("Frontier over the high-water mark "
+                            "(%d tasks queued): spilling new tasks", depth)
+            self._backpressure = True
+        elif depth <= (self.conf['frontier_low_water'] or 0):
+            self._backpressure = False
+
+        ## If the queue is empty, we need to go on anyway
+        if not self._spilled or (self._backpressure and depth):
+            return 0
+        if high is not None:
+            room = max(high - depth, 1)
+        else:
+            room = every
+        items = self._spilled.pop_many(room)
+        for name, task in items:
+            self._spilled_names.discard(name)
+        self._task_queue.push_many(items)
+        self._task_queue.flush()
+        return len(items)
+
+    def _queue_recrawls(self, force=False):
+        """
+        Queue the URLs due for recrawling, checking at most every
+        ``recrawl_check_interval`` seconds (unless forced).
+
+        :return: the number of tasks queued
+        """
+        now = time.time()
+        if not force and now < self._next_recrawl_check:
+            return 0
+        self._next_recrawl_check = now + self.conf['recrawl_check_interval']
+        tasks = self.conf['recrawl'].pop_due_tasks(
+            limit=self.conf['queue_batch_size'])
+        if tasks:
+            logger.debug("Queuing %d URLs due for recrawling", len(tasks))
+            self.queue_tasks(tasks)
+            self._task_queue.flush()
+        return len(tasks)
+
+    def _next_due(self):
+        """Time the next retry or recrawl will be due, or None"""
+        next_due = self._retry_scheduler.next_due()
+        recrawl = self.conf['recrawl']
+        if recrawl is not None:
+            recrawl_due = recrawl.next_due()
+            wait = self.conf['recrawl_wait']
+            if recrawl_due is not None and wait is not None and \
+                    recrawl_due > time.time() + wait:
+                recrawl_due = None  # Not worth waiting for
+            if next_due is None or (recrawl_due is not None and
+                                    recrawl_due < next_due):
+                next_due = recrawl_due
+        return next_due
+
+    def yield_tasks(self, wait=True):
+        """
+        Continue yielding tasks until queue is empty and
+        there are no more tasks waiting to be retried
+        (or recrawled).
+
+        Tasks popped from the queue are marked as done when
+        the next one is requested, or when the iteration is stopped;
+        tasks to be retried are marked as done after their last run.
+
+        :param wait: sleep until the next retry or recrawl is due,
+            when there's nothing else to do; if False, yield None
+            instead (and check again when the next item is requested)
+        """
+        recrawl = self.conf['recrawl']
         while True:
+            task = self._retry_scheduler.pop_due()
+            if task is not None:
+                self._retrying.discard(id(task))
+                name = self._retry_names.pop(id(task), None)
+                try:
+                    yield task.id, task
+                finally:
+                    self._task_done(name, task)
+                continue
+
+            if recrawl is not None:
+                self._queue_recrawls()
+
+            if self._paused and not self._backpressure:
+                name, task = self._paused.pop_many(1)[0]
+                yield name, task
+                continue
+
+            if self._bounded_frontier:
+                self._check_frontier()
+
             try:
-                logger.debug("Task queue length is {0}".format(
-                    len(self._task_queue)))
-                task = self._task_queue.pop()
-                if task is None:  # pragma: no cover
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Task queue length is %d",
+                                 len(self._task_queue))
+                item = self._task_queue.pop()
+                if item is None:  # pragma: no cover
                     ## This in the rare case of a misbehaving queue..
                     raise IndexError("Null task received")
             except IndexError:  # queue empty
-                logger.info("Queue empty. Terminating execution.")
-                return
+                if self._bounded_frontier and self._check_frontier(True):
+                    continue
+                if self._paused:
+                    name, task = self._paused.pop_many(1)[0]
+                    yield name, task
+                    continue
+                if recrawl is not None and self._queue_recrawls(True):
+                    continue
+                next_due = self._next_due()
+                if next_due is None:
+                    logger.info("Queue empty. Terminating execution.")
+                    return
+                if not wait:
+                    yield None
+                    continue
+                ## Wait for retries and recrawls, but keep
+                ## an eye on the queue
+                time.sleep(max(0, min(next_due - time.time(), 1.0)))
             else:
-                yield task
+                name, task = item
+                pause = self.conf['frontier_pause']
+                if self._backpressure and pause and isinstance(task, pause):
+                    ## Put it aside: we'll run it when there's less work
+                    self._paused.append(name, task)
+                    self._task_queue.task_done(name)
+                    continue
+                try:
+                    yield name, task
+                finally:
+                    self._task_done(name, task)
+
+    def _task_done(self, name, task):
+        """Mark a task as done in the queue, unless it's to be retried"""
+        if name is None:
+            return
+        if id(task) in self._retrying:
+            self._retry_names[id(task)] = name
+            return
+        self._task_queue.task_done(name)
+
+    def _retry_later(self, task, delay):
+        self._retrying.add(id(task))
+        self._retry_scheduler.schedule(task, delay)
 
     def run(self):
-        """Start execution of the queue, until no tasks are left"""
-        for name, task in self.yield_tasks():
-            self.run_task(task)
+        """
+        Start execution of the queue, until no tasks are left (or
+        the budget is exhausted)
+        """
+        self._begin_run()
+        if not self._budget_exhausted():
+            tasks = self.yield_tasks()
+            try:
+                for name, task in tasks:
+                    self.run_task(task)
+                    if self._results_closed:
+                        logger.info("Results no longer wanted. Stopping.")
+                        break
+                    if self._budget_exhausted():
+                        break
+            finally:
+                ## Marks the last task as done
+                tasks.close()
+        self._end_run()
+
+    def _begin_run(self):
+        budget = self.conf['budget']
+        if budget is not None:
+            budget.start()
+
+    def _end_run(self):
+        tracer = self.conf['tracer']
+        if tracer is not None and tracer.path:
+            tracer.export()
+
+    def _budget_exhausted(self):
+        budget = self.conf['budget']
+        if budget is None:
+            return False
+        reason = budget.exhausted()
+        if reason is not None:
+            logger.info("Crawl budget exhausted (%s). Stopping.", reason)
+            return True
+        return False
+
+    def iter_results(self, buffer_size=1000):
+        """
+        Run the spider in a background thread, yielding the objects
+        (anything that is not a task) yielded by the runners, as
+        they come.
+
+        The crawl is paused while ``buffer_size`` objects are waiting
+        to be consumed; it is stopped after the current task if the
+        iteration is stopped early. Exceptions raised by :py:meth:`run`
+        are re-raised here.
+        """
+        if self._results is not None:
+            raise RuntimeError("Results are already being streamed")
+        self._results = Queue.Queue(maxsize=buffer_size)
+        self._results_closed = False
+        errors = []
+
+        def crawl():
+            try:
+                self.run()
+            except Exception:
+                errors.append(sys.exc_info())
+            finally:
+                self._put_result(_END)
+
+        thread = threading.Thread(target=crawl, name='simplespider-crawl')
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item = self._results.get()
+                if item is _END:
+                    break
+                yield item
+        finally:
+            self._results_closed = True
+            thread.join()
+            self._results = None
+            self._results_closed = False  # for later runs
+        if errors:
+            six.reraise(*errors[0])
+
+    def _put_result(self, item):
+        """Wait for room in the results buffer, unless it was closed"""
+        while not self._results_closed:
+            try:
+                self._results.put(item, timeout=0.1)
+            except Queue.Full:
+                continue
+            return True
+        return False
 
     def run_task(self, task):
         """Run a given task"""
 
-        logger.info("Starting task execution: {0!r}".format(task))
+        logger.debug("Starting task execution: %r", task)
 
         if not isinstance(task, BaseTask):
             raise TypeError("This doesn't look like a task!")
 
-        for runner in self._get_runners(task):
-            logger.debug("Starting execution with {0!r}".format(runner))
+        budget = self.conf['budget']
+        if budget is not None:
+            reason = budget.admit(task)
+            if reason is not None:
+                logger.info("Task %r is over budget (%s)", task, reason)
+                self._m_tasks.inc(labels=(task.type, 'over_budget'))
+                return
 
+        tracer = self.conf['tracer']
+        if tracer is not None:
+            tracer.begin_task(task)
+
+        start = time.time()
+        outcome = None
+        try:
+            outcome = self._run_runners(task)
+        finally:
+            self._m_task_time.observe(time.time() - start, (task.type,))
+            self._m_tasks.inc(labels=(task.type, outcome))
+            if budget is not None and outcome == 'deferred':
+                budget.refund(task)
+            if tracer is not None:
+                tracer.end_task(task, outcome)
+            if self.conf['profiler'] is not None:
+                self.conf['profiler'].task_done()
+
+    def _run_runners(self, task):
+        """Run all the matching runners, returning the task outcome"""
+
+        tracer = self.conf['tracer']
+        profiler = self.conf['profiler']
+        for runner in self._get_runners(task):
             ## todo: we need to stop if asked to do so, etc.
+            start = time.time()
+            if tracer is not None:
+                span = tracer.begin()
+            if profiler is not None:
+                profile = profiler.begin(runner)
             try:
                 self._wrap_task_execution(runner, task)
 
             except AbortTask:
-                logger.info("Task {0!r} aborted".format(task))
-                return  # And never execute this anymore!
+                logger.info("Task %r aborted", task)
+                return 'aborted'  # And never execute this anymore!
 
             except SkipRunner:
                 logger.debug("Runner asked to be skipped")
                 pass  # Ok, let's just skip this..
 
+            except DeferTask, e:
+                logger.debug("Task %r deferred", task)
+                self._retry_later(task, e.retry_after or 0)
+                return 'deferred'
+
             except Exception, e:
                 if not isinstance(e, RetryTask):
                     ## We retry failing tasks, but we notify the user, if the
@@ -249,30 +792,106 @@ class Spider(object):
                                    "Re-scheduling it for retry.")
                     logger.exception("")
                 if task['retry'] > 0:
-                    logger.info("Task {0!r} to be retried "
-                                "{1} more times".format(task, task['retry']))
-                    new_task = copy.deepcopy(task)
-                    new_task._id += '[R]'  # to make sure this is run again
-                    new_task['retry'] = task['retry'] - 1
-                    ## todo: we need to change the id, or the task will
-                    ##       never be executed again!
-                    self.queue_task(new_task)
-                else:
-                    logger.info("Max retries reached. Aborting task {0!r}.")
-                return  # do not continue with other runners..
+                    logger.info("Task %r to be retried %d more times",
+                                task, task['retry'])
+                    self._schedule_retry(task, getattr(e, 'retry_after', None))
+                    return 'retried'
+                logger.info("Max retries reached. Aborting task %r.", task)
+                return 'failed'  # do not continue with other runners..
+
+            finally:
+                if profiler is not None:
+                    profiler.end(runner, profile)
+                self._m_runner_time.observe(time.time() - start,
+                                            (type(runner).__name__,))
+                if tracer is not None:
+                    tracer.end(span, type(runner).__name__, 'run')
+
+        logger.debug("Task execution successful")
+        return 'success'
+
+    def _schedule_retry(self, task, retry_after=None):
+        """
+        Schedule a failed task to be run again later.
 
-        logger.info("Task execution successful")
+        The task keeps its id (so it doesn't need to go through
+        deduplication again): the number of retries done so far is
+        kept in its ``retries`` attribute instead.
+        """
+        retries = task.get('retries', 0) + 1
+        if retry_after is None:
+            retry_after = backoff_delay(
+                retries,
+                base=self.conf['retry_delay'],
+                factor=self.conf['retry_backoff'],
+                max_delay=self.conf['retry_max_delay'],
+                jitter=self.conf['retry_jitter'])
+        task['retry'] -= 1
+        task['retries'] = retries
+        self._m_retries.inc(labels=(task.type,))
+        self._retry_later(task, retry_after)
 
     def _wrap_task_execution(self, runner, task):
-        logger.info("Starting task: {0!r} (via {1!r})".format(task, runner))
-        for item in runner(task):
-            if isinstance(item, BaseTask):
-                logger.debug("  -> Got new task {0!r}".format(item))
-                self.queue_task(item)
+        logger.debug("Starting task: %r (via %r)", task, runner)
+        items = runner(task)
+        if items is None:
+            return  # Runners like storages don't yield anything
+
+        ## New tasks are queued in batches; the ones yielded before
+        ## a failure get queued anyway.
+        batch = []
+        batch_size = self.conf['queue_batch_size']
+        try:
+            for item in items:
+                if isinstance(item, BaseTask):
+                    if self._should_fuse(item):
+                        self._run_fused(item)
+                        continue
+                    batch.append(item)
+                    if len(batch) >= batch_size:
+                        self.queue_tasks(batch)
+                        batch = []
+
+                elif self._results is not None:
+                    self._m_results.inc()
+                    self._put_result(item)
 
-            else:
-                logger.warning("  -> I don't know what to do with: {0!r}"
-                               "".format(item))
+                else:
+                    logger.warning("  -> I don't know what to do with: %r",
+                                   item)
+        finally:
+            if batch:
+                self.queue_tasks(batch)
+
+    def _should_fuse(self, task):
+        fuse = self.conf['fuse']
+        if fuse is None or self._fuse_depth >= self.conf['fuse_max_depth']:
+            return False
+        if isinstance(fuse, (type, tuple)):
+            if not isinstance(task, fuse):
+                return False
+        elif not fuse(task):
+            return False
+        ## Tasks nobody here can run might be for other workers
+        return any(runner.match(task) for runner in self._runners)
+
+    def _run_fused(self, task):
+        """
+        Run a task yielded by a runner right away, skipping the queue.
+
+        Tasks are deduplicated by id, like the queue would do; if they
+        fail, they're retried as usual.
+        """
+        if task.id in self._already_done:
+            logger.debug("Task %r was already executed. Not running.", task)
+            return
+        self._already_done.add(task.id)
+        self._m_fused.inc(labels=(task.type,))
+        self._fuse_depth += 1
+        try:
+            self.run_task(task)
+        finally:
+            self._fuse_depth -= 1
 
     @property
     def _task_queue(self):
@@ -294,11 +913,36 @@ class BaseQueueManager(object):
         """Pushes a task to the queue"""
         raise NotImplementedError
 
+    def push_many(self, items):
+        """
+        Pushes many ``(name, task)`` pairs to the queue, with the
+        same deduplication as :py:meth:`push`. Backends should
+        override this to use their native bulk operations.
+        """
+        for name, task in items:
+            self.push(name, task)
+
+    def flush(self):
+        """Make sure all the pushed tasks reached the queue"""
+        pass
+
+    def seen(self, name, task):
+        """
+        Tell whether a task with this name was already pushed, and
+        would be dropped as a duplicate. Backends that can't tell
+        cheaply just return False.
+        """
+        return False
+
+    def task_done(self, name):
+        """Called once a popped task has been completely executed"""
+        pass
+
     def __len__(self):
         raise NotImplementedError
 
 
-class ListQueueManager(object):
+class ListQueueManager(BaseQueueManager):
     """
     Simple queue manager, using a list to keep track
     of the tasks.
@@ -307,20 +951,31 @@ class ListQueueManager(object):
         This will quickly grow out of memory for large sites!
     """
 
-    def __init__(self):
-        self._queue = []
+    def __init__(self, **kwargs):
+        super(ListQueueManager, self).__init__(**kwargs)
+        self._queue = deque()
         self._dedup_set = set()
 
     def pop(self):
-        return self._queue.pop(0)
+        return self._queue.popleft()
 
     def push(self, name, task):
         if name in self._dedup_set:
-            logger.debug("Task {0!r} was already executed. "
-                         "Not queuing.".format(name))
+            logger.debug("Task %r was already executed. Not queuing.", name)
             return
         self._dedup_set.add(name)
         self._queue.append((name, task))
 
+    def push_many(self, items):
+        dedup_set = self._dedup_set
+        append = self._queue.append
+        for item in items:
+            if item[0] not in dedup_set:
+                dedup_set.add(item[0])
+                append(item)
+
+    def seen(self, name, task):
+        return name in self._dedup_set
+
     def __len__(self):
         return len(self._queue)
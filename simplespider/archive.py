@@ -0,0 +1,253 @@
+"""
+Compressed, indexed archive of HTTP responses
+
+Responses are stored as WARC ``response`` records, each compressed as
+a separate gzip member (like ``.warc.gz`` files), so single records
+can be read with one seek. An index of ``url offset length`` lines
+is kept next to the data file, and rebuilt from it if missing or
+incomplete (eg. after a crash).
+
+Record the responses while crawling, then re-run the scrapers on
+them without touching the network::
+
+    archive = HttpArchive('crawl.warc.gz', 'a')
+    spider.add_runners([Downloader(archive=archive), MyScraper()])
+    spider.run()
+    archive.close()
+
+    archive = HttpArchive('crawl.warc.gz')
+    spider.add_runners([Downloader(replay=archive), MyScraper()])
+    for url in archive:
+        spider.queue_task(DownloadTask(url=url))
+    spider.run()
+"""
+
+import datetime
+import os
+import threading
+import uuid
+import zlib
+
+from simplespider.web import HttpResponse
+
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def _compress(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, _GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _parse_headers(block):
+    headers = []
+    for line in block.split('\r\n'):
+        if not line:
+            continue
+        name, _, value = line.partition(':')
+        headers.append((name.strip(), value.strip()))
+    return headers
+
+
+def serialize_response(url, response, date=None):
+    """Build the WARC record for an :py:class:`HttpResponse`"""
+    status_line = 'HTTP/1.1 {0} {1}'.format(response['status_code'],
+                                            _encode(response['reason']))
+    http_headers = ''.join('{0}: {1}\r\n'.format(_encode(k), _encode(v))
+                           for k, v in sorted(response['headers'].items()))
+    block = ''.join((status_line, '\r\n', http_headers, '\r\n',
+                     response['content']))
+
+    if date is None:
+        date = datetime.datetime.utcnow()
+    warc_headers = [
+        ('WARC-Type', 'response'),
+        ('WARC-Target-URI', _encode(url)),
+        ('WARC-Date', date.strftime('%Y-%m-%dT%H:%M:%SZ')),
+        ('WARC-Record-ID', '<urn:uuid:{0}>'.format(uuid.uuid4())),
+        ('Content-Type', 'application/http; msgtype=response'),
+        ('Content-Length', str(len(block))),
+    ]
+    if response['url'] and response['url'] != url:
+        warc_headers.append(('WARC-X-Response-URI',
+                             _encode(response['url'])))
+    if response['encoding']:
+        warc_headers.append(('WARC-X-Encoding', _encode(response['encoding'])))
+    return ''.join(['WARC/1.0\r\n'] +
+                   ['{0}: {1}\r\n'.format(k, v) for k, v in warc_headers] +
+                   ['\r\n', block, '\r\n\r\n'])
+
+
+def _is_complete(record):
+    """Whether a (possibly truncated) record holds its whole block"""
+    warc_block, sep, rest = record.partition('\r\n\r\n')
+    if not sep:
+        return False
+    for name, value in _parse_headers(warc_block):
+        if name.lower() == 'content-length':
+            return value.isdigit() and len(rest) == int(value) + 4 and \
+                rest.endswith('\r\n\r\n')
+    return False
+
+
+def parse_response(record):
+    """
+    Parse a WARC record built by :py:func:`serialize_response`.
+
+    :return: a ``(url, response)`` tuple
+    """
+    warc_block, _, rest = record.partition('\r\n\r\n')
+    warc_headers = dict(_parse_headers(warc_block.split('\r\n', 1)[1]))
+    block = rest[:int(warc_headers['Content-Length'])]
+    http_block, _, content = block.partition('\r\n\r\n')
+    status_line, _, http_headers = http_block.partition('\r\n')
+    status = status_line.split(' ', 2)
+    status_code = int(status[1])
+    url = warc_headers['WARC-Target-URI'].decode('utf-8')
+    response_url = warc_headers.get('WARC-X-Response-URI')
+    return url, HttpResponse(
+        headers=dict(_parse_headers(http_headers)),
+        content=content,
+        encoding=warc_headers.get('WARC-X-Encoding'),
+        ok=status_code < 400,
+        status_code=status_code,
+        reason=status[2] if len(status) > 2 else '',
+        url=response_url.decode('utf-8') if response_url else url)
+
+
+class HttpArchive(object):
+    """
+    Archive of HTTP responses, indexed by requested URL.
+
+    If the same URL is recorded more than once, the latest
+    response wins.
+    """
+
+    def __init__(self, path, mode='r'):
+        """
+        :param path: path of the data file; the index is kept
+            in ``path + '.idx'``
+        :param mode: ``'r'`` to read an existing archive, ``'a'`` to
+            append to it (creating it if needed)
+        """
+        if mode not in ('r', 'a'):
+            raise ValueError("Invalid mode: {0!r}".format(mode))
+        self.path = path
+        self.index_path = path + '.idx'
+        self.mode = mode
+        self._index = {}  # url -> (offset, length)
+        self._lock = threading.Lock()
+        self._data_out = self._index_out = None
+        if mode == 'a':
+            self._data_out = open(path, 'ab')
+            self._data_out.seek(0, os.SEEK_END)
+        self._data_in = open(path, 'rb')
+        self._load_index()
+
+    def _load_index(self):
+        end = 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as fp:
+                for line in fp:
+                    try:
+                        url, offset, length = line.rstrip('\n').rsplit(' ', 2)
+                        offset, length = int(offset), int(length)
+                    except ValueError:
+                        break  # truncated line
+                    self._index[url.decode('utf-8')] = (offset, length)
+        size = os.fstat(self._data_in.fileno()).st_size
+        for url, (offset, length) in self._index.items():
+            if offset + length > size:
+                del self._index[url]  # data lost in a crash
+            else:
+                end = max(end, offset + length)
+        if self.mode == 'a':
+            self._index_out = open(self.index_path, 'ab')
+        if end < size:
+            ## Index missing or incomplete: rebuild it from the data
+            for offset, length, url in self._scan(end):
+                self._index[url] = (offset, length)
+                self._write_index(url, offset, length)
+
+    def _scan(self, offset, chunk_size=1 << 20):
+        """Yield ``(offset, length, url)`` for the records after offset"""
+        fp = self._data_in
+        fp.seek(offset)
+        buf = ''
+        while True:
+            decompressor = zlib.decompressobj(_GZIP_WBITS)
+            parts, length = [], 0
+            while not decompressor.unused_data:
+                if not buf:
+                    buf = fp.read(chunk_size)
+                    if not buf:
+                        break  # end of file
+                try:
+                    parts.append(decompressor.decompress(buf))
+                except zlib.error:
+                    return  # garbage at the end of the file
+                length += len(buf) - len(decompressor.unused_data)
+                buf = ''
+            record = ''.join(parts)
+            if not _is_complete(record):
+                return  # truncated record
+            buf = decompressor.unused_data
+            yield offset, length, parse_response(record)[0]
+            offset += length
+
+    def _write_index(self, url, offset, length):
+        if self._index_out is not None:
+            self._index_out.write('{0} {1} {2}\n'.format(
+                _encode(url), offset, length))
+
+    def record(self, url, response):
+        """Append a response for ``url`` to the archive"""
+        if self._data_out is None:
+            raise IOError("Archive {0!r} is read-only".format(self.path))
+        data = _compress(serialize_response(url, response))
+        with self._lock:
+            offset = self._data_out.tell()
+            self._data_out.write(data)
+            self._index[url] = (offset, len(data))
+            self._write_index(url, offset, len(data))
+
+    def get(self, url):
+        """Return the archived response for ``url``, or None"""
+        try:
+            offset, length = self._index[url]
+        except KeyError:
+            return None
+        with self._lock:
+            if self._data_out is not None:
+                self._data_out.flush()
+            self._data_in.seek(offset)
+            data = self._data_in.read(length)
+        return parse_response(zlib.decompress(data, _GZIP_WBITS))[1]
+
+    def flush(self):
+        with self._lock:
+            if self._data_out is not None:
+                self._data_out.flush()
+                self._index_out.flush()
+
+    def close(self):
+        self.flush()
+        for fp in (self._data_out, self._index_out, self._data_in):
+            if fp is not None:
+                fp.close()
+
+    def __contains__(self, url):
+        return url in self._index
+
+    def __iter__(self):
+        """Iterate the archived URLs, in file order"""
+        return (url for url, pos in
+                sorted(self._index.iteritems(), key=lambda x: x[1]))
+
+    def __len__(self):
+        return len(self._index)
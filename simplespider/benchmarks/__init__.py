@@ -0,0 +1,12 @@
+"""
+Offline benchmarks for the spider
+
+:py:mod:`simplespider.benchmarks.site` generates a deterministic
+synthetic website and serves it from a local HTTP server;
+:py:mod:`simplespider.benchmarks.crawl` runs standard crawls against
+it, with each queue and storage backend, and writes the results as
+JSON so they can be compared across versions::
+
+    % python -m simplespider.benchmarks.crawl --pages 5000 \\
+        --latency 0.005 --output bench-0.1a.json
+"""
@@ -0,0 +1,333 @@
+"""
+End-to-end crawl benchmarks
+
+Each run crawls a :py:class:`~simplespider.benchmarks.site.SyntheticSite`
+with :py:class:`~simplespider.web.Downloader`,
+:py:class:`~simplespider.web.LinkExtractor` and a storage backend,
+and reports throughput, latency percentiles and peak memory usage.
+Runs happen in a forked process each, so that their peak RSS
+figures don't pollute each other.
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import simplespider
+from simplespider import ListQueueManager, Spider
+from simplespider.benchmarks.site import SyntheticSite, serve_site
+from simplespider.metrics import Registry
+from simplespider.storage import AnydbmStorage, DictStorage, StoreObjectTask
+from simplespider.transports import DictTransport, RequestsTransport, \
+    Urllib3Transport
+from simplespider.web import BaseScraper, DownloadTask, Downloader, \
+    LinkExtractor, ScrapingTask
+
+QUEUES = ('list', 'shm', 'kombu_simple', 'kombu_batched')
+STORAGES = ('dict', 'anydbm')
+TRANSPORTS = ('requests', 'requests_session', 'urllib3', 'dict')
+
+
+class PageRecorder(BaseScraper):
+    """Store a small record for each downloaded page"""
+
+    def __call__(self, task):
+        response = task['response']
+        yield StoreObjectTask(data={
+            '_type': 'page',
+            '_id': task['url'],
+            'url': task['url'],
+            'status_code': response['status_code'],
+            'length': len(response['content']),
+        })
+
+
+class _BenchmarkSpider(Spider):
+    """Spider keeping track of the peak queue depth"""
+
+    sample_every = 100
+
+    def __init__(self, **kwargs):
+        super(_BenchmarkSpider, self).__init__(**kwargs)
+        self.peak_queue_depth = 0
+        self._sampled = 0
+
+    def run_task(self, task):
+        self._sampled += 1
+        if self._sampled % self.sample_every == 1:
+            self.peak_queue_depth = max(self.peak_queue_depth,
+                                        len(self._task_queue))
+        super(_BenchmarkSpider, self).run_task(task)
+
+
+def make_queue(name, kombu_url=None):
+    """Create a queue manager for the benchmarks"""
+    if name == 'list':
+        return ListQueueManager()
+    if name == 'shm':
+        from simplespider.queues.shm import SharedMemoryQueueManager
+        return SharedMemoryQueueManager()
+    if name in ('kombu_simple', 'kombu_batched'):
+        if not kombu_url:
+            raise ValueError("A kombu URL is needed for the {0!r} queue"
+                             .format(name))
+        from simplespider.queues.kombu import KombuQueueSimple, \
+            KombuQueueBatched
+        ## Use a fresh queue, not to pick up leftovers of other runs
+        queue_name = 'simplespider_bench_{0}_{1}'.format(
+            os.getpid(), int(time.time()))
+        klass = KombuQueueBatched if name == 'kombu_batched' \
+            else KombuQueueSimple
+        return klass(connection=kombu_url, queue_name=queue_name)
+    raise ValueError("Unknown queue: {0!r}".format(name))
+
+
+def make_storage(name, workdir):
+    """Create a storage runner for the benchmarks"""
+    if name == 'dict':
+        return DictStorage()
+    if name == 'anydbm':
+        return AnydbmStorage(path=os.path.join(workdir, 'storage.db'))
+    raise ValueError("Unknown storage: {0!r}".format(name))
+
+
+def make_transport(name, url=None, site=None):
+    """
+    Create a transport for the benchmarks. The ``'dict'`` one serves
+    the pages of ``site`` from memory, bypassing HTTP (and ignoring
+    the site latency), starting from ``url``.
+    """
+    if name == 'requests':
+        return RequestsTransport()
+    if name == 'requests_session':
+        import requests
+        return RequestsTransport(session=requests.Session())
+    if name == 'urllib3':
+        return Urllib3Transport()
+    if name == 'dict':
+        if site is None:
+            raise ValueError("The 'dict' transport needs a site")
+        base = url.rsplit('/page/', 1)[0]
+        pages = {}
+        for i in xrange(site.pages):
+            status, content_type, body = site.get('/page/{0}'.format(i))
+            pages['{0}/page/{1}'.format(base, i)] = (
+                status, {'Content-Type': content_type}, body)
+        return DictTransport(pages)
+    raise ValueError("Unknown transport: {0!r}".format(name))
+
+
+def _peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024  # bytes, not kilobytes
+    return rss
+
+
+def _summaries(histogram):
+    return dict(('/'.join(str(label) for label in labels), summary)
+                for labels, summary in histogram.snapshot().iteritems())
+
+
+def run_crawl(url, queue='list', storage='dict', kombu_url=None,
+              transport='requests', site=None, fuse=False,
+              frontier_high_water=None):
+    """
+    Crawl a site starting from ``url``, in the current process.
+
+    :param site: the :py:class:`SyntheticSite` being crawled,
+        needed by the ``'dict'`` transport
+    :param fuse: run scraping and storage tasks right away, instead
+        of queuing them
+    :param frontier_high_water: queue length above which new tasks
+        are spilled to disk
+    :return: a dict with the results
+    """
+    workdir = tempfile.mkdtemp(prefix='simplespider-bench-')
+    try:
+        registry = Registry()
+        spider = _BenchmarkSpider(
+            queue=make_queue(queue, kombu_url), metrics=registry,
+            fuse=(ScrapingTask, StoreObjectTask) if fuse else None,
+            frontier_high_water=frontier_high_water,
+            frontier_pause=[ScrapingTask])
+        spider.add_runners([
+            Downloader(metrics=registry,
+                       transport=make_transport(transport, url, site)),
+            LinkExtractor(),
+            PageRecorder(),
+            make_storage(storage, workdir),
+        ])
+        rss_before = _peak_rss_kb()
+        spider.queue_task(DownloadTask(url=url))
+        start = time.time()
+        spider.run()
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    responses = registry.get('simplespider_responses_total').snapshot()
+    pages = sum(responses.itervalues())
+    return {
+        'queue': queue,
+        'storage': storage,
+        'transport': transport,
+        'fuse': fuse,
+        'frontier_high_water': frontier_high_water,
+        'seconds': elapsed,
+        'pages': pages,
+        'server_errors': sum(count for (host, status), count
+                             in responses.iteritems() if status >= 500),
+        'fetch_errors': registry.get(
+            'simplespider_fetch_errors_total').total(),
+        'tasks': registry.get('simplespider_tasks_total').total(),
+        'pages_per_second': pages / elapsed if elapsed else None,
+        'fetch_latency': _summaries(
+            registry.get('simplespider_fetch_seconds')),
+        'task_latency': _summaries(
+            registry.get('simplespider_task_seconds')),
+        'peak_queue_depth': spider.peak_queue_depth,
+        'rss_before_kb': rss_before,
+        'peak_rss_kb': _peak_rss_kb(),
+    }
+
+
+def _run_isolated(conn, *args):
+    try:
+        conn.send(run_crawl(*args))
+    except Exception, e:
+        conn.send({'error': '{0}: {1}'.format(type(e).__name__, e)})
+    finally:
+        conn.close()
+
+
+def run_suite(site, queues=('list', 'shm'), storages=STORAGES,
+              kombu_url=None, isolate=True, transports=('requests',),
+              fuse=False, frontier_high_water=None):
+    """
+    Serve ``site`` locally and crawl it with each combination of
+    queue, storage and transport.
+
+    :param fuse, frontier_high_water: see :py:func:`run_crawl`
+    :param isolate: run each crawl in a separate process (required
+        for the peak RSS figures to be meaningful)
+    :return: a JSON-serializable report
+    """
+    server = serve_site(site)
+    results = []
+    try:
+        for queue, storage, transport in itertools.product(
+                queues, storages, transports):
+            args = (server.url, queue, storage, kombu_url, transport, site,
+                    fuse, frontier_high_water)
+            if not isolate:
+                results.append(run_crawl(*args))
+                continue
+            parent_conn, child_conn = multiprocessing.Pipe(False)
+            proc = multiprocessing.Process(
+                target=_run_isolated, args=(child_conn,) + args)
+            proc.start()
+            ## Only the child holds the sending end, so that recv()
+            ## fails instead of blocking if the child dies
+            child_conn.close()
+            try:
+                result = parent_conn.recv()
+            except EOFError:
+                result = {'error': 'Crawl process died'}
+            finally:
+                parent_conn.close()
+            proc.join()
+            if 'error' in result and proc.exitcode:
+                result['error'] += ' (exit code {0})'.format(proc.exitcode)
+            result.setdefault('queue', queue)
+            result.setdefault('storage', storage)
+            result.setdefault('transport', transport)
+            results.append(result)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return {
+        'simplespider_version': simplespider.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'site': {
+            'pages': site.pages,
+            'fanout': site.fanout,
+            'page_size': site.page_size,
+            'latency': site.latency,
+            'error_rate': site.error_rate,
+            'seed': site.seed,
+        },
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark crawls of a local synthetic website")
+    parser.add_argument('--pages', type=int, default=1000)
+    parser.add_argument('--fanout', type=int, default=10)
+    parser.add_argument('--page-size', type=int, default=4096)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds to wait before each response")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="fraction of pages answering with a 500")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--queue', action='append', choices=QUEUES,
+                        help="queue backend (repeatable; default: "
+                        "list and shm, plus kombu if --kombu-url is set)")
+    parser.add_argument('--storage', action='append', choices=STORAGES,
+                        help="storage backend (repeatable; default: all)")
+    parser.add_argument('--transport', action='append', choices=TRANSPORTS,
+                        help="fetch transport (repeatable; "
+                        "default: requests)")
+    parser.add_argument('--kombu-url', default=os.environ.get('KOMBU_URL'))
+    parser.add_argument('--fuse', action='store_true',
+                        help="run scraping and storage tasks right away, "
+                        "bypassing the queue")
+    parser.add_argument('--frontier-high-water', type=int,
+                        help="spill new tasks to disk while more than "
+                        "this many are queued")
+    parser.add_argument('--no-isolate', action='store_true',
+                        help="run all the crawls in this process")
+    parser.add_argument('--output', '-o',
+                        help="write the JSON report here (default: stdout)")
+    args = parser.parse_args(argv)
+
+    queues = args.queue
+    if not queues:
+        queues = ['list', 'shm']
+        if args.kombu_url:
+            queues.extend(['kombu_simple', 'kombu_batched'])
+
+    site = SyntheticSite(pages=args.pages, fanout=args.fanout,
+                         page_size=args.page_size, latency=args.latency,
+                         error_rate=args.error_rate, seed=args.seed)
+    report = run_suite(site, queues=queues,
+                       storages=args.storage or STORAGES,
+                       kombu_url=args.kombu_url,
+                       isolate=not args.no_isolate,
+                       transports=args.transport or ['requests'],
+                       fuse=args.fuse,
+                       frontier_high_water=args.frontier_high_water)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
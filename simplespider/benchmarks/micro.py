@@ -0,0 +1,407 @@
+"""
+Micro-benchmarks for the core hot paths
+
+Each benchmark times a batch of ``n`` operations (best of ``repeat``
+runs) and reports the time per operation. Results can be saved as a
+baseline, and later runs compared against it: the run fails if any
+benchmark got slower by more than ``--max-regression``::
+
+    % python -m simplespider.benchmarks.micro --output baseline.json
+    ... hack hack hack ...
+    % python -m simplespider.benchmarks.micro --baseline baseline.json
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+import simplespider
+from simplespider import BaseTask, BaseTaskRunner, ListQueueManager, Spider
+from simplespider.benchmarks.site import SyntheticSite
+from simplespider.storage import AnydbmStorage, DictStorage, StoreObjectTask
+from simplespider.web import DownloadTask, HttpResponse, LinkExtractor, \
+    Trail
+
+BENCHMARKS = []  # (name, default number of operations, setup function)
+
+
+def benchmark(n):
+    """
+    Register a benchmark. The decorated function is given the number
+    of operations, and returns a callable performing them, and
+    optionally a cleanup function.
+    """
+    def decorator(fn):
+        BENCHMARKS.append((fn.__name__, n, fn))
+        return fn
+    return decorator
+
+
+_TRAIL = ['http://example.com/', 'http://example.com/index']
+
+
+def _task(i):
+    return DownloadTask(url='http://example.com/page/{0}'.format(i),
+                        trail=Trail.from_list(_TRAIL))
+
+
+@benchmark(100000)
+def task_init(n):
+    trail = Trail.from_list(_TRAIL)
+
+    def run():
+        for i in xrange(n):
+            DownloadTask(url='http://example.com/', trail=trail)
+    return run
+
+
+@benchmark(100000)
+def task_to_dict(n):
+    task = _task(0)
+
+    def run():
+        for i in xrange(n):
+            task.to_dict()
+    return run
+
+
+@benchmark(100000)
+def task_from_dict(n):
+    data = _task(0).to_dict()
+
+    def run():
+        for i in xrange(n):
+            BaseTask.from_dict(data)
+    return run
+
+
+def _names(n):
+    return ['simplespider.web:DownloadTask:http://example.com/page/{0}'
+            .format(i) for i in xrange(n)]
+
+
+@benchmark(1000000)
+def list_queue_push_pop(n):
+    names = _names(n)
+    task = _task(0)
+
+    def run():
+        queue = ListQueueManager()
+        for name in names:
+            queue.push(name, task)
+        for name in names:
+            queue.pop()
+    return run
+
+
+@benchmark(1000000)
+def list_queue_dedup(n):
+    names = _names(n)
+    task = _task(0)
+    queue = ListQueueManager()
+    for name in names:
+        queue.push(name, task)
+
+    def run():
+        for name in names:
+            queue.push(name, task)
+    return run
+
+
+def _spider_tasks(n):
+    return [DownloadTask(url='http://example.com/page/{0}'.format(i % 1000))
+            for i in xrange(n)]
+
+
+@benchmark(100000)
+def spider_queue_task(n):
+    tasks = _spider_tasks(n)
+
+    def run():
+        spider = Spider()
+        for task in tasks:
+            spider.queue_task(task)
+    return run
+
+
+@benchmark(100000)
+def spider_queue_tasks(n):
+    tasks = _spider_tasks(n)
+
+    def run():
+        spider = Spider()
+        for i in xrange(0, n, 500):
+            spider.queue_tasks(tasks[i:i + 500])
+    return run
+
+
+@benchmark(1000000)
+def shm_queue_push_pop(n):
+    from simplespider.queues.shm import SharedMemoryQueueManager
+    names = _names(n)
+    task = _task(0)
+    batch = 1000  # keep it within the ring buffer
+
+    def run():
+        queue = SharedMemoryQueueManager(dedup_bits=0)
+        for i in xrange(0, n, batch):
+            for name in names[i:i + batch]:
+                queue.push(name, task)
+            for name in names[i:i + batch]:
+                queue.pop()
+                queue.task_done(name)
+    return run
+
+
+@benchmark(1000000)
+def shm_queue_dedup(n):
+    from simplespider.queues.shm import SharedMemoryQueueManager
+    names = _names(n)
+    queue = SharedMemoryQueueManager(size=1024)
+    for name in names:
+        queue._test_and_set(queue._dedup_bits(name))
+
+    def run():
+        for name in names:
+            queue._test_and_set(queue._dedup_bits(name))
+    return run
+
+
+class _TypeRunner(BaseTaskRunner):
+    def match(self, task):
+        return task.type == self.conf['type']
+
+    def __call__(self, task):
+        pass
+
+
+@benchmark(10000)
+def get_runners(n):
+    spider = Spider()
+    spider.add_runners([_TypeRunner(type='example:Task{0}'.format(i))
+                        for i in xrange(200)])
+    spider.add_runners([_TypeRunner(type=_task(0).type)])
+    task = _task(0)
+
+    def run():
+        for i in xrange(n):
+            list(spider._get_runners(task))
+    return run
+
+
+@benchmark(20)
+def extract_links(n):
+    site = SyntheticSite(pages=100000, fanout=5000, page_size=500000)
+    response = HttpResponse(
+        url='http://example.com/page/1',
+        headers={'content-type': 'text/html; charset=utf-8'},
+        content=site.render(1))
+    extractor = LinkExtractor()
+
+    def run():
+        for i in xrange(n):
+            list(extractor._extract_links(response))
+    return run
+
+
+@benchmark(200)
+def simhash_page(n):
+    from simplespider.dedup import page_tokens, simhash
+    site = SyntheticSite(pages=100, page_size=20000)
+    response = HttpResponse(content=site.render(1), encoding='utf-8')
+
+    def run():
+        for i in xrange(n):
+            simhash(page_tokens(response))
+    return run
+
+
+@benchmark(50000)
+def sitemap_seed(n):
+    import io
+    from simplespider.sitemaps import SitemapSeeder
+    sitemap = ''.join(
+        ['<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'] +
+        ['<url><loc>http://example.com/page/{0}</loc></url>'.format(i)
+         for i in xrange(n)] + ['</urlset>'])
+
+    def run():
+        seeder = SitemapSeeder(Spider(queue=ListQueueManager()),
+                               opener=lambda url: io.BytesIO(sitemap))
+        seeder.seed('http://example.com/sitemap.xml')
+    return run
+
+
+def _store_tasks(n):
+    return [StoreObjectTask(data={'_type': 'page', '_id': str(i),
+                                  'url': 'http://example.com/page/{0}'
+                                  .format(i), 'length': 1234})
+            for i in xrange(n)]
+
+
+@benchmark(100000)
+def dict_storage_write(n):
+    tasks = _store_tasks(n)
+
+    def run():
+        storage = DictStorage()
+        for task in tasks:
+            storage(task)
+    return run
+
+
+def _anydbm_storage_write(n, synchronous):
+    tasks = _store_tasks(n)
+    workdir = tempfile.mkdtemp(prefix='simplespider-bench-')
+    runs = []
+
+    def run():
+        storage = AnydbmStorage(
+            path=os.path.join(workdir, 'storage{0}.db'.format(len(runs))),
+            synchronous=synchronous)
+        runs.append(storage)
+        for task in tasks:
+            storage(task)
+        storage._storage.close()
+
+    def cleanup():
+        shutil.rmtree(workdir, ignore_errors=True)
+    return run, cleanup
+
+
+@benchmark(10000)
+def anydbm_storage_write(n):
+    return _anydbm_storage_write(n, synchronous=False)
+
+
+@benchmark(1000)
+def anydbm_storage_write_sync(n):
+    return _anydbm_storage_write(n, synchronous=True)
+
+
+def run_benchmark(setup, n, repeat=3):
+    """
+    Time ``n`` operations, ``repeat`` times.
+
+    :return: the best time per operation, in seconds
+    """
+    run = setup(n)
+    cleanup = None
+    if isinstance(run, tuple):
+        run, cleanup = run
+    try:
+        best = None
+        for i in xrange(repeat):
+            gc.collect()
+            start = timeit.default_timer()
+            run()
+            elapsed = timeit.default_timer() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        if cleanup is not None:
+            cleanup()
+    return best / n
+
+
+def run_benchmarks(scale=1.0, repeat=3, only=None, log=None):
+    """
+    Run the registered benchmarks.
+
+    :param scale: multiplier for the number of operations
+    :param only: names of the benchmarks to run (Default: all)
+    :param log: file-like object progress is reported to
+    :return: a JSON-serializable report
+    """
+    results = {}
+    for name, n, setup in BENCHMARKS:
+        if only and name not in only:
+            continue
+        n = max(1, int(n * scale))
+        per_op = run_benchmark(setup, n, repeat)
+        results[name] = {
+            'n': n,
+            'seconds_per_op': per_op,
+            'ops_per_second': 1.0 / per_op if per_op else None,
+        }
+        if log is not None:
+            log.write('{0:<28} {1:>10} ops {2:>12.3f} us/op\n'.format(
+                name, n, per_op * 1e6))
+    return {
+        'simplespider_version': simplespider.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'results': results,
+    }
+
+
+def compare(report, baseline, max_regression=0.2):
+    """
+    Compare a report against a baseline one.
+
+    :param max_regression: allowed slowdown, as a fraction
+        of the baseline time per operation
+    :return: list of ``(name, baseline, current, change)`` tuples
+        for the benchmarks that regressed more than allowed
+    """
+    regressions = []
+    for name, result in sorted(report['results'].iteritems()):
+        base = baseline['results'].get(name)
+        if base is None or not base['seconds_per_op']:
+            continue
+        change = result['seconds_per_op'] / base['seconds_per_op'] - 1
+        if change > max_regression:
+            regressions.append((name, base['seconds_per_op'],
+                                result['seconds_per_op'], change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the micro-benchmarks")
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="multiplier for the number of operations "
+                        "(eg. 10 for 10^7 queue operations)")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', action='append',
+                        choices=[name for name, n, setup in BENCHMARKS],
+                        help="run only this benchmark (repeatable)")
+    parser.add_argument('--output', '-o',
+                        help="write the JSON report here, eg. to be "
+                        "used as a baseline")
+    parser.add_argument('--baseline',
+                        help="JSON report to compare the results with")
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help="allowed slowdown relative to the baseline "
+                        "(Default: 0.2, ie. 20%%)")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(scale=args.scale, repeat=args.repeat,
+                            only=args.only, log=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = compare(report, baseline, args.max_regression)
+        for name, before, after, change in regressions:
+            sys.stderr.write(
+                'REGRESSION {0}: {1:.3f} -> {2:.3f} us/op ({3:+.0%})\n'
+                .format(name, before * 1e6, after * 1e6, change))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
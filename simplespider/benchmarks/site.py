@@ -0,0 +1,128 @@
+"""
+Deterministic synthetic website, served over HTTP
+"""
+
+import BaseHTTPServer
+import random
+import SocketServer
+import threading
+import time
+import zlib
+
+_words = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+          'eiusmod tempor incididunt ut labore et dolore magna aliqua '
+          'spider crawler queue task runner link page').split()
+
+
+class SyntheticSite(object):
+    """
+    A website made of ``pages`` pages, ``/page/0`` to ``/page/<n-1>``.
+
+    Page ``i`` links to pages ``i * fanout + 1`` to ``i * fanout +
+    fanout`` (modulo ``pages``), so the whole site is reachable from
+    ``/page/0`` and the links past the end point back to pages already
+    seen, exercising deduplication. The same parameters always give
+    the same site.
+    """
+
+    def __init__(self, pages=1000, fanout=10, page_size=4096, latency=0.0,
+                 error_rate=0.0, seed=0):
+        """
+        :param pages: number of pages in the site
+        :param fanout: number of links in each page
+        :param page_size: approximate size of each page, in bytes
+        :param latency: seconds to wait before each response
+        :param error_rate: fraction of the pages answering with
+            a 500 error
+        :param seed: seed for the generated text
+        """
+        self.pages = pages
+        self.fanout = fanout
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.seed = seed
+        self._error_threshold = int(error_rate * 0xffffffff)
+
+    def links(self, index):
+        """Indexes of the pages linked from page ``index``"""
+        return [(index * self.fanout + k + 1) % self.pages
+                for k in xrange(self.fanout)]
+
+    def is_error(self, index):
+        if not self._error_threshold:
+            return False
+        key = '{0}:{1}'.format(self.seed, index)
+        return (zlib.crc32(key) & 0xffffffff) <= self._error_threshold
+
+    def render(self, index):
+        """Generate the HTML for page ``index``"""
+        rnd = random.Random(self.seed * 1000003 + index)
+        parts = ['<!DOCTYPE html>\n<html><head><title>Page {0}</title>'
+                 '</head><body>\n<h1>Page {0}</h1>\n'.format(index)]
+        for target in self.links(index):
+            parts.append('<a href="/page/{0}">Page {0}</a>\n'.format(target))
+        size = sum(len(p) for p in parts)
+        while size < self.page_size:
+            par = '<p>{0}</p>\n'.format(
+                ' '.join(rnd.choice(_words) for _ in xrange(40)))
+            parts.append(par)
+            size += len(par)
+        parts.append('</body></html>\n')
+        return ''.join(parts)
+
+    def get(self, path):
+        """
+        Answer a request for ``path``.
+
+        :return: a ``(status, content_type, body)`` tuple
+        """
+        prefix, _, index = path.partition('/page/')
+        if prefix or not index.isdigit() or int(index) >= self.pages:
+            return 404, 'text/plain', 'Not found\n'
+        index = int(index)
+        if self.is_error(index):
+            return 500, 'text/plain', 'Internal server error\n'
+        return 200, 'text/html; charset=utf-8', self.render(index)
+
+
+class _ThreadingServer(SocketServer.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def serve_site(site, port=0, addr='127.0.0.1'):
+    """
+    Serve the site over HTTP, from a daemon thread.
+
+    :param port: port to listen on (Default: 0, meaning any free port)
+    :return: the server object; its ``url`` attribute is the URL
+        of the site root page, call ``shutdown()`` on it to stop.
+    """
+
+    class SiteHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        ## Send each response in one go: writing the headers line by
+        ## line stalls keep-alive clients on delayed ACKs.
+        wbufsize = -1
+
+        def do_GET(self):
+            if site.latency:
+                time.sleep(site.latency)
+            status, content_type, body = site.get(self.path)
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = _ThreadingServer((addr, port), SiteHandler)
+    server.url = 'http://{0}:{1}/page/0'.format(*server.server_address)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
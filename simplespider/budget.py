@@ -0,0 +1,167 @@
+"""
+Crawl budgets
+
+A :py:class:`CrawlBudget` puts hard limits on a crawl: pages and bytes
+fetched from each host, tasks run in total, and a wall-clock deadline.
+The spider checks it before running each task, so that download tasks
+for hosts over budget never reach the downloader, and stops once the
+job-wide limits are reached (leaving the remaining tasks in the queue).
+The downloader keeps the per-host counters up to date::
+
+    budget = CrawlBudget(max_pages_per_host=1000, max_seconds=3600)
+    spider = Spider(budget=budget)
+    spider.add_runners([Downloader(budget=budget), LinkExtractor()])
+"""
+
+import threading
+import time
+
+from simplespider.utils import url_host
+from simplespider.web import DownloadTask
+
+
+class CrawlBudget(object):
+    """
+    Limits on the resources used by a crawl. All of them are
+    optional (None means no limit).
+    """
+
+    def __init__(self, max_pages_per_host=None, max_bytes_per_host=None,
+                 max_tasks=None, max_seconds=None, metrics=None):
+        """
+        :param max_pages_per_host: responses fetched from each host
+        :param max_bytes_per_host: bytes (of response bodies) fetched
+            from each host; the page crossing the limit is still kept
+        :param max_tasks: tasks run, in total (retries included, but
+            not the re-runs of deferred tasks)
+        :param max_seconds: wall-clock duration of the crawl, counted
+            from :py:meth:`start`
+        :param metrics: :py:class:`~simplespider.metrics.Registry`
+            the counters are exposed to. (Default: None)
+        """
+        self.max_pages_per_host = max_pages_per_host
+        self.max_bytes_per_host = max_bytes_per_host
+        self.max_tasks = max_tasks
+        self.max_seconds = max_seconds
+        self.started = None
+        self.tasks = 0
+        self._pages = {}  # host -> responses fetched
+        self._bytes = {}  # host -> bytes fetched
+        self.rejected = {}  # reason -> tasks refused
+        self._check_hosts = (max_pages_per_host is not None or
+                             max_bytes_per_host is not None)
+        self._lock = threading.Lock()
+
+        self.metrics = metrics
+        if metrics is not None:
+            self._m_rejected = metrics.counter(
+                'simplespider_budget_rejected_total',
+                'Tasks not run because a budget was exhausted', ['reason'])
+            metrics.gauge('simplespider_budget_tasks',
+                          'Tasks run against the budget',
+                          lambda: self.tasks)
+            metrics.gauge('simplespider_budget_hosts_exhausted',
+                          'Hosts whose budget is exhausted',
+                          lambda: len(self.exhausted_hosts()))
+            metrics.gauge('simplespider_budget_seconds_left',
+                          'Time left before the crawl deadline',
+                          lambda: self.seconds_left())
+
+    def start(self, now=None):
+        """Start the clock for ``max_seconds``, if not running yet"""
+        if self.started is None:
+            self.started = time.time() if now is None else now
+
+    def seconds_left(self, now=None):
+        """Seconds left before the deadline, or None"""
+        if self.max_seconds is None or self.started is None:
+            return None
+        if now is None:
+            now = time.time()
+        return max(0.0, self.started + self.max_seconds - now)
+
+    def exhausted(self, now=None):
+        """
+        Tell whether a job-wide limit was reached.
+
+        :return: the name of the limit (``'max_tasks'`` or
+            ``'max_seconds'``), or None
+        """
+        if self.max_tasks is not None and self.tasks >= self.max_tasks:
+            return 'max_tasks'
+        if self.max_seconds is not None and self.started is not None:
+            if (time.time() if now is None else now) >= \
+                    self.started + self.max_seconds:
+                return 'max_seconds'
+        return None
+
+    def _host_exhausted(self, host):
+        if self.max_pages_per_host is not None and \
+                self._pages.get(host, 0) >= self.max_pages_per_host:
+            return 'max_pages_per_host'
+        if self.max_bytes_per_host is not None and \
+                self._bytes.get(host, 0) >= self.max_bytes_per_host:
+            return 'max_bytes_per_host'
+        return None
+
+    def admit(self, task, now=None):
+        """
+        Check a task against the budget before running it, counting
+        it if it's admitted.
+
+        :return: None if the task can be run, otherwise the name of
+            the exhausted limit
+        """
+        reason = self.exhausted(now)
+        if reason is None and self._check_hosts and \
+                isinstance(task, DownloadTask):
+            reason = self._host_exhausted(url_host(task['url']))
+        if reason is not None:
+            with self._lock:
+                self.rejected[reason] = self.rejected.get(reason, 0) + 1
+            if self.metrics is not None:
+                self._m_rejected.inc(labels=(reason,))
+            return reason
+        with self._lock:
+            self.tasks += 1
+        return None
+
+    def refund(self, task):
+        """
+        Give back the budget counted by :py:meth:`admit` for a task
+        that was deferred (eg. its host was busy): only its next run
+        counts
+        """
+        with self._lock:
+            self.tasks -= 1
+
+    def record_fetch(self, host, size):
+        """Count a response of ``size`` bytes fetched from ``host``"""
+        with self._lock:
+            self._pages[host] = self._pages.get(host, 0) + 1
+            self._bytes[host] = self._bytes.get(host, 0) + size
+
+    def pages(self, host):
+        return self._pages.get(host, 0)
+
+    def bytes(self, host):
+        return self._bytes.get(host, 0)
+
+    def exhausted_hosts(self):
+        """Hosts over their page or byte budget"""
+        if not self._check_hosts:
+            return []
+        return [host for host in list(self._pages)
+                if self._host_exhausted(host) is not None]
+
+    def stats(self):
+        """Snapshot of the counters, eg. for monitoring"""
+        with self._lock:
+            return {
+                'tasks': self.tasks,
+                'seconds_left': self.seconds_left(),
+                'rejected': dict(self.rejected),
+                'hosts': dict((host, {'pages': pages,
+                                      'bytes': self._bytes.get(host, 0)})
+                              for host, pages in self._pages.iteritems()),
+            }
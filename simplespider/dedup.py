@@ -0,0 +1,216 @@
+"""
+Detection of near-duplicate pages
+
+Many sites serve the same content under many URLs (session parameters,
+print views, mirrors...), which URL deduplication can't catch. The
+:py:class:`NearDuplicateFilter` computes a SimHash fingerprint of each
+downloaded page and, if a page with an almost identical fingerprint
+was already seen, stops the other runners (scrapers, link extraction)
+from processing it, recording its canonical URL instead. Register it
+before the scrapers::
+
+    spider.add_runners([
+        Downloader(),
+        NearDuplicateFilter(),
+        LinkExtractor(),
+        MyScraper(),
+    ])
+"""
+
+import hashlib
+import itertools
+import re
+import struct
+import threading
+
+from simplespider import AbortTask
+from simplespider.storage import StoreObjectTask
+from simplespider.utils import url_host
+from simplespider.web import BaseScraper
+
+_re_hidden = re.compile(r'<(script|style)\b.*?</\1\s*>', re.I | re.S)
+_re_tags = re.compile(r'<[^>]*>|&[#a-zA-Z0-9]+;')
+_re_words = re.compile(r'\w+', re.U)
+
+
+def page_tokens(response):
+    """Return the words of the text of a page, lowercase"""
+    content = response['content']
+    if isinstance(content, str):
+        content = content.decode(response.get('encoding') or 'utf-8',
+                                 'replace')
+    content = _re_tags.sub(' ', _re_hidden.sub(' ', content))
+    return _re_words.findall(content.lower())
+
+
+def _token_hash(token):
+    return struct.unpack(
+        '<q', hashlib.md5(token.encode('utf-8')).digest()[:8])[0]
+
+
+## For each bit, the bytes not having it set: deleting them from a
+## string of bytes (in C) leaves the ones to be counted.
+_BIT_UNSET = [''.join(chr(b) for b in xrange(256) if not (b >> bit) & 1)
+              for bit in xrange(8)]
+
+
+def simhash(tokens, shingle_size=3):
+    """
+    64-bit SimHash fingerprint of a list of tokens, computed from
+    their (distinct) ``shingle_size``-long sequences.
+
+    Tokens are hashed with MD5, shingles with the built-in tuple
+    hash: fingerprints are stable across processes on 64-bit builds.
+
+    :return: a ``(fingerprint, number of shingles)`` tuple
+    """
+    hashes = dict((token, _token_hash(token)) for token in set(tokens))
+    sequence = map(hashes.__getitem__, tokens)
+    shingles = set(itertools.izip(*[sequence[i:]
+                                    for i in xrange(shingle_size)]))
+    if not shingles and sequence:
+        shingles.add(tuple(sequence))  # shorter than a shingle
+    count = len(shingles)
+    if not count:
+        return 0, 0
+
+    ## Count the shingles having each bit set, a byte at a time
+    data = struct.pack('<{0}q'.format(count), *map(hash, shingles))
+    fingerprint = 0
+    for byte in xrange(8):
+        column = data[byte::8]
+        for bit, unset in enumerate(_BIT_UNSET):
+            if len(column.translate(None, unset)) * 2 > count:
+                fingerprint |= 1 << (byte * 8 + bit)
+    return fingerprint, count
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class SimHashIndex(object):
+    """
+    Index of fingerprints, to find the ones within ``max_distance``
+    bits of a given one.
+
+    Fingerprints are split in ``max_distance + 1`` bands: two of them
+    differing by at most ``max_distance`` bits have at least one band
+    in common, so only the fingerprints sharing a band need to
+    be compared.
+    """
+
+    def __init__(self, bits=64, max_distance=3):
+        if not 0 <= max_distance < bits:
+            raise ValueError("max_distance must be in [0, bits)")
+        self.bits = bits
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        self._bands = []  # (shift, mask)
+        start = 0
+        for i in xrange(bands):
+            width = (bits - start) // (bands - i)
+            self._bands.append((start, (1 << width) - 1))
+            start += width
+        self._tables = [{} for _ in self._bands]
+        self._count = 0
+
+    def _keys(self, fingerprint):
+        for shift, mask in self._bands:
+            yield (fingerprint >> shift) & mask
+
+    def add(self, fingerprint, key):
+        for table, band in zip(self._tables, self._keys(fingerprint)):
+            table.setdefault(band, []).append((fingerprint, key))
+        self._count += 1
+
+    def find(self, fingerprint):
+        """
+        Find the closest indexed fingerprint.
+
+        :return: a ``(key, distance)`` tuple, or None
+        """
+        best = None
+        for table, band in zip(self._tables, self._keys(fingerprint)):
+            for other, key in table.get(band, ()):
+                distance = hamming_distance(fingerprint, other)
+                if distance <= self.max_distance and \
+                        (best is None or distance < best[1]):
+                    best = (key, distance)
+                    if distance == 0:
+                        return best
+        return best
+
+    def __len__(self):
+        return self._count
+
+
+class NearDuplicateFilter(BaseScraper):
+    def __init__(self, **kwargs):
+        """
+        :param max_distance:
+            maximum number of differing fingerprint bits for two pages
+            to be considered duplicates. (Default: 3)
+        :param min_shingles:
+            pages with fewer distinct shingles (sequences of words)
+            than this are never considered duplicates. (Default: 20)
+        :param shingle_size:
+            number of words in each shingle. (Default: 3)
+        :param index:
+            :py:class:`SimHashIndex` to be used, eg. to share it
+            between spiders. (Default: a new one)
+        :param store_duplicates:
+            yield a ``StoreObjectTask`` recording the canonical URL
+            of each duplicate page. (Default: True)
+        :param metrics:
+            :py:class:`~simplespider.metrics.Registry` used to count
+            duplicate pages, per host. (Default: None)
+        """
+        kwargs.setdefault('max_distance', 3)
+        kwargs.setdefault('min_shingles', 20)
+        kwargs.setdefault('shingle_size', 3)
+        if kwargs.get('index') is None:
+            kwargs['index'] = SimHashIndex(
+                max_distance=kwargs['max_distance'])
+        kwargs.setdefault('store_duplicates', True)
+        kwargs.setdefault('metrics', None)
+        super(NearDuplicateFilter, self).__init__(**kwargs)
+        self._lock = threading.Lock()
+
+        metrics = self.conf['metrics']
+        if metrics is not None:
+            self._m_duplicates = metrics.counter(
+                'simplespider_near_duplicates_total',
+                'Pages skipped as near-duplicates of others', ['host'])
+
+    def __call__(self, task):
+        assert self.match(task)
+        response = task['response']
+        url = response['url'] or task['url']
+        fingerprint, shingles = simhash(page_tokens(response),
+                                        self.conf['shingle_size'])
+        if shingles < self.conf['min_shingles']:
+            return
+
+        index = self.conf['index']
+        with self._lock:
+            found = index.find(fingerprint)
+            if found is None:
+                index.add(fingerprint, url)
+                return
+        canonical_url, distance = found
+        if canonical_url == url:
+            return  # The same page, fetched again
+
+        if self.conf['metrics'] is not None:
+            self._m_duplicates.inc(labels=(url_host(task['url']),))
+        if self.conf['store_duplicates']:
+            yield StoreObjectTask(data={
+                '_type': 'duplicate',
+                '_id': task['url'],
+                'url': task['url'],
+                'canonical_url': canonical_url,
+                'distance': distance,
+            })
+        raise AbortTask("{0!r} is a near-duplicate of {1!r}".format(
+            task['url'], canonical_url))
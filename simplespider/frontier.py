@@ -0,0 +1,72 @@
+"""
+Spilling of the crawl frontier to disk, to keep memory bounded
+"""
+
+import os
+import tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:  # pragma: no cover
+    import pickle
+
+
+class SpillFile(object):
+    """
+    FIFO of ``(name, task)`` pairs, pickled to a temporary file.
+
+    Reads and writes share the same file; once everything written
+    has been read back, the file is truncated.
+    """
+
+    def __init__(self, dir=None):
+        """
+        :param dir: directory for the temporary file
+            (Default: the system default)
+        """
+        self.dir = dir
+        self._fp = None
+        self._read_pos = 0
+        self._write_pos = 0
+        self._count = 0
+
+    def _open(self):
+        if self._fp is None:
+            fd, path = tempfile.mkstemp(prefix='simplespider-spill-',
+                                        dir=self.dir)
+            self._fp = os.fdopen(fd, 'w+b')
+            os.unlink(path)  # we only need the file descriptor
+        return self._fp
+
+    def append(self, name, task):
+        fp = self._open()
+        fp.seek(self._write_pos)
+        pickle.dump((name, task), fp, pickle.HIGHEST_PROTOCOL)
+        self._write_pos = fp.tell()
+        self._count += 1
+
+    def pop_many(self, count):
+        """Return up to ``count`` of the oldest pairs"""
+        if not self._count:
+            return []
+        fp = self._fp
+        fp.seek(self._read_pos)
+        items = []
+        while self._count and len(items) < count:
+            items.append(pickle.load(fp))
+            self._count -= 1
+        self._read_pos = fp.tell()
+        if not self._count:
+            fp.seek(0)
+            fp.truncate()
+            self._read_pos = self._write_pos = 0
+        return items
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        self._read_pos = self._write_pos = self._count = 0
+
+    def __len__(self):
+        return self._count
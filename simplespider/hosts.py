@@ -0,0 +1,280 @@
+"""
+Per-host bookkeeping for the fetch layer
+"""
+
+import threading
+import time
+
+
+class CircuitBreaker(object):
+    """
+    Per-host circuit breaker.
+
+    After ``failure_threshold`` consecutive failures, the circuit for
+    a host is "opened", and requests to it are refused for
+    ``cooldown`` seconds. After that, a single probe request is let
+    through ("half-open" state): if it succeeds the circuit is closed
+    again, otherwise it's re-opened with a doubled cooldown, up to
+    ``max_cooldown``. Hosts still failing by then are considered
+    :py:meth:`dead`.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, cooldown=30.0,
+                 max_cooldown=600.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._hosts = {}  # host -> _HostCircuit
+        self._lock = threading.Lock()
+
+    def _get(self, host):
+        circuit = self._hosts.get(host)
+        if circuit is None:
+            circuit = self._hosts.setdefault(host,
+                                             _HostCircuit(self.cooldown))
+        return circuit
+
+    def state(self, host, now=None):
+        circuit = self._hosts.get(host)
+        if circuit is None or circuit.opened_at is None:
+            return self.CLOSED
+        if now is None:
+            now = time.time()
+        if circuit.probing or now >= circuit.opened_at + circuit.cooldown:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self, host, now=None):
+        """
+        Check whether a request to ``host`` can be made.
+
+        :return: a ``(allowed, retry_after)`` tuple, where
+            ``retry_after`` is the number of seconds to wait
+            before asking again, if the request was refused.
+        """
+        circuit = self._hosts.get(host)
+        if circuit is None or circuit.opened_at is None:
+            return True, None
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if circuit.probing:
+                ## Wait for the outcome of the probe
+                return False, circuit.cooldown
+            remaining = circuit.opened_at + circuit.cooldown - now
+            if remaining > 0:
+                return False, remaining
+            circuit.probing = True
+            return True, None
+
+    def cancel_probe(self, host):
+        """
+        Give back the probe granted by :py:meth:`allow`, when the
+        request wasn't sent, or failed for reasons unrelated to the
+        host: the next request will be the probe.
+        """
+        circuit = self._hosts.get(host)
+        if circuit is None:
+            return
+        with self._lock:
+            circuit.probing = False
+
+    def dead(self, host):
+        """
+        Whether the probes to ``host`` kept failing, until one failed
+        after waiting for ``max_cooldown``.
+        """
+        circuit = self._hosts.get(host)
+        return circuit is not None and circuit.dead
+
+    def record_success(self, host):
+        circuit = self._hosts.get(host)
+        if circuit is None:
+            return
+        with self._lock:
+            circuit.failures = 0
+            circuit.opened_at = None
+            circuit.probing = False
+            circuit.dead = False
+            circuit.cooldown = self.cooldown
+
+    def record_failure(self, host, now=None):
+        if now is None:
+            now = time.time()
+        with self._lock:
+            circuit = self._get(host)
+            circuit.failures += 1
+            if circuit.probing:
+                ## The probe failed: back off some more
+                circuit.probing = False
+                circuit.opened_at = now
+                if circuit.cooldown >= self.max_cooldown:
+                    circuit.dead = True
+                circuit.cooldown = min(self.max_cooldown,
+                                       circuit.cooldown * 2)
+            elif circuit.failures >= self.failure_threshold:
+                circuit.opened_at = now
+
+    def stats(self):
+        """Return the state of all the hosts with a non-closed circuit"""
+        now = time.time()
+        return dict((host, self.state(host, now))
+                    for host, circuit in self._hosts.items()
+                    if circuit.opened_at is not None)
+
+
+class _HostCircuit(object):
+    __slots__ = ['failures', 'opened_at', 'cooldown', 'probing', 'dead']
+
+    def __init__(self, cooldown):
+        self.failures = 0
+        self.opened_at = None
+        self.cooldown = cooldown
+        self.probing = False
+        self.dead = False
+
+
+class AdaptiveConcurrency(object):
+    """
+    Per-host concurrency windows, tuned with AIMD.
+
+    Each host gets a window of requests allowed to be in flight at
+    the same time. While requests succeed in a reasonable time, the
+    window grows additively (by ``increase`` every full window of
+    successful requests); on throttling responses (429, 503),
+    errors, timeouts or latency spikes it's cut multiplicatively
+    (by ``decrease``), at most once per round-trip time.
+
+    Requests are also paced, so that a host never sees more than
+    ``window`` requests per average round-trip time (or one every
+    ``min_interval`` seconds, if that's longer): this keeps the
+    windows meaningful for a spider running tasks one at a time.
+    """
+
+    throttle_status_codes = frozenset([429, 503])
+
+    def __init__(self, initial_window=2.0, min_window=1.0, max_window=32.0,
+                 increase=1.0, decrease=0.5, latency_spike=3.0,
+                 smoothing=0.2, min_interval=0.0):
+        """
+        :param latency_spike:
+            a request taking more than this many times the average
+            latency for its host counts as a congestion signal.
+        :param smoothing:
+            weight of each new sample in the moving average
+            of latencies.
+        """
+        self.initial_window = initial_window
+        self.min_window = min_window
+        self.max_window = max_window
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_spike = latency_spike
+        self.smoothing = smoothing
+        self.min_interval = min_interval
+        self._hosts = {}  # host -> _HostWindow
+        self._lock = threading.Lock()
+
+    def _get(self, host):
+        window = self._hosts.get(host)
+        if window is None:
+            window = self._hosts.setdefault(
+                host, _HostWindow(self.initial_window, self.min_interval))
+        return window
+
+    def set_min_interval(self, host, seconds):
+        """Set the minimum delay between requests, eg. from robots.txt"""
+        with self._lock:
+            self._get(host).min_interval = seconds
+
+    def acquire(self, host, now=None):
+        """
+        Try to reserve a slot for a request to ``host``.
+
+        :return: a ``(allowed, retry_after)`` tuple, where
+            ``retry_after`` is the number of seconds to wait
+            before trying again, if no slot was available.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            window = self._get(host)
+            if window.in_flight >= int(window.window):
+                return False, max(window.latency or 0, 0.1)
+            interval = window.min_interval
+            if window.latency is not None:
+                interval = max(interval, window.latency / window.window)
+            wait = window.last_start + interval - now
+            if wait > 0:
+                return False, wait
+            window.in_flight += 1
+            window.last_start = now
+            return True, None
+
+    def release(self, host, latency=None, status_code=None, error=False,
+                now=None):
+        """
+        Release a slot, adjusting the host window according
+        to how the request went (if told).
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            window = self._get(host)
+            window.in_flight = max(0, window.in_flight - 1)
+            if latency is None and status_code is None and not error:
+                return  # Nothing learned
+
+            congested = error or status_code in self.throttle_status_codes
+            if latency is not None:
+                if window.latency is None:
+                    window.latency = latency
+                else:
+                    if latency > window.latency * self.latency_spike:
+                        congested = True
+                    window.latency += self.smoothing * (
+                        latency - window.latency)
+
+            if congested:
+                ## Don't react more than once to the same congestion
+                rtt = window.latency or 0
+                if now - window.last_decrease >= rtt:
+                    window.window = max(self.min_window,
+                                        window.window * self.decrease)
+                    window.last_decrease = now
+            else:
+                window.window = min(self.max_window,
+                                    window.window +
+                                    self.increase / window.window)
+
+    def window(self, host):
+        """Current concurrency window for ``host``"""
+        window = self._hosts.get(host)
+        if window is None:
+            return self.initial_window
+        return window.window
+
+    def windows(self):
+        """Report the current state of all the known hosts"""
+        with self._lock:
+            return dict((host, {'window': w.window,
+                                'in_flight': w.in_flight,
+                                'latency': w.latency})
+                        for host, w in self._hosts.iteritems())
+
+
+class _HostWindow(object):
+    __slots__ = ['window', 'in_flight', 'latency', 'last_start',
+                 'last_decrease', 'min_interval']
+
+    def __init__(self, window, min_interval):
+        self.window = window
+        self.in_flight = 0
+        self.latency = None  # moving average, in seconds
+        self.last_start = 0
+        self.last_decrease = 0
+        self.min_interval = min_interval
@@ -0,0 +1,242 @@
+"""
+Running many crawl jobs in a single process
+
+Each :py:class:`CrawlJob` is a spider of its own, with its seeds,
+runners, queue, budget and storage; a :py:class:`JobPool` runs them
+all with a shared pool of worker threads, and a shared connection pool
+for their downloaders::
+
+    pool = JobPool(workers=8)
+    for customer in customers:
+        job = CrawlJob(name=customer.name, weight=customer.weight,
+                       budget=CrawlBudget(max_pages_per_host=1000))
+        job.add_runners([Downloader(transport=pool.transport),
+                         LinkExtractor(), customer.storage()])
+        job.queue_task(DownloadTask(url=customer.seed))
+        pool.add_job(job)
+    pool.run()
+
+Workers pick the next job with weighted fair queueing: each job has a
+virtual finish time, advanced after each of its tasks by the time the
+task took divided by the job weight, and the ready job with the
+earliest one goes next. Jobs get worker time in proportion to their
+weights, whatever the size of their queues, and jobs that were idle
+don't get to catch up. A job runs a single task at a time, so its
+spider needs no locking. Jobs with only retries or recrawls left are
+set aside until these are due, without holding a worker.
+"""
+
+import logging
+import threading
+import time
+
+from simplespider import Spider
+from simplespider.metrics import Registry
+from simplespider.transports import RequestsTransport, Urllib3Transport, \
+    urllib3
+
+logger = logging.getLogger(__name__)
+
+
+class CrawlJob(Spider):
+    def __init__(self, **kwargs):
+        """
+        A spider meant to be run by a :py:class:`JobPool`; it
+        accepts all the :py:class:`~simplespider.Spider` arguments.
+
+        :param name: name of the job, used in logs and
+            metrics. (Required)
+        :param weight: share of the worker time given to the job,
+            relative to the other ones. (Default: 1)
+        """
+        if kwargs.get('name') is None:
+            raise TypeError("The 'name' argument is required!")
+        kwargs.setdefault('weight', 1.0)
+        if kwargs['weight'] <= 0:
+            raise ValueError("The job weight must be positive")
+        super(CrawlJob, self).__init__(**kwargs)
+
+    @property
+    def name(self):
+        return self.conf['name']
+
+    def __repr__(self):
+        return "<CrawlJob {0!r}>".format(self.name)
+
+
+class _JobState(object):
+    """Scheduling state of a job in the pool"""
+
+    def __init__(self, job):
+        self.job = job
+        self.weight = float(job.conf['weight'])
+        self.finish = 0.0  # virtual finish time of the last task
+        self.start = 0.0
+        self.turn = 0  # when the job was last picked, to break ties
+        self.busy = False
+        self.done = False
+        self.due = None  # when a waiting job is worth checking again
+        self.tasks = None  # the job's yield_tasks() iterator
+        self.error = None
+        self.served = 0
+        self.seconds = 0.0
+
+
+class JobPool(object):
+    def __init__(self, workers=4, transport=None, metrics=None):
+        """
+        :param workers: number of worker threads
+        :param transport: transport shared by the downloaders of the
+            jobs, available as ``pool.transport``. (Default: an
+            ``Urllib3Transport``, or a ``RequestsTransport`` with a
+            session if urllib3 is missing)
+        :param metrics: :py:class:`~simplespider.metrics.Registry`
+            used for the per-job statistics. (Default: a new registry)
+        """
+        if transport is None:
+            if urllib3 is not None:
+                transport = Urllib3Transport(maxsize=workers)
+            else:  # pragma: no cover
+                import requests
+                transport = RequestsTransport(session=requests.Session())
+        self.workers = workers
+        self.transport = transport
+        self._states = []
+        self._vtime = 0.0  # virtual time: start of the last picked task
+        self._turns = 0
+        self._cond = threading.Condition()
+
+        if metrics is None:
+            metrics = Registry()
+        self.metrics = metrics
+        self._m_tasks = metrics.counter(
+            'simplespider_job_tasks_total', 'Tasks run, by job', ['job'])
+        self._m_seconds = metrics.counter(
+            'simplespider_job_seconds_total',
+            'Worker time used, by job', ['job'])
+        metrics.gauge('simplespider_jobs_active',
+                      'Jobs with tasks left to run',
+                      lambda: sum(1 for s in self._states if not s.done))
+
+    def add_job(self, job):
+        """Add a job; it can be done while the pool is running"""
+        with self._cond:
+            state = _JobState(job)
+            ## Newcomers start at the current virtual time, so they
+            ## neither wait for nor overtake the running jobs
+            state.finish = self._vtime
+            self._states.append(state)
+            self._cond.notify_all()
+
+    def _acquire(self):
+        """Wait for a job to be ready, or return None if all are done"""
+        with self._cond:
+            while True:
+                now = time.time()
+                idle = [state for state in self._states
+                        if not state.busy and not state.done]
+                ready = [state for state in idle
+                         if state.due is None or state.due <= now]
+                if ready:
+                    state = min(ready, key=lambda s: (
+                        max(self._vtime, s.finish), s.turn))
+                    state.start = max(self._vtime, state.finish)
+                    self._vtime = state.start
+                    self._turns += 1
+                    state.turn = self._turns
+                    state.busy = True
+                    state.due = None
+                    return state
+                if all(state.done for state in self._states):
+                    return None
+                if idle:
+                    ## Wake up when the first waiting job is due
+                    self._cond.wait(min(s.due for s in idle) - now)
+                else:
+                    self._cond.wait()
+
+    def _release(self, state, cost, done):
+        with self._cond:
+            state.finish = state.start + cost / state.weight
+            state.busy = False
+            state.done = done
+            self._cond.notify_all()
+
+    def _step(self, state):
+        """
+        Run a task of the job, or set it aside until the next retry or
+        recrawl is due, if there's nothing to run yet.
+
+        :return: whether the job has more work to do
+        """
+        job = state.job
+        if state.tasks is None:
+            job._begin_run()
+            state.tasks = job.yield_tasks(wait=False)
+        if job._budget_exhausted():
+            return False
+        try:
+            item = next(state.tasks)
+        except StopIteration:
+            return False
+        if item is None:
+            ## Keep an eye on the queue, as Spider.yield_tasks() does
+            now = time.time()
+            next_due = job._next_due()
+            state.due = now + 1.0 if next_due is None \
+                else min(next_due, now + 1.0)
+            return True
+        name, task = item
+        job.run_task(task)
+        state.served += 1
+        self._m_tasks.inc(labels=(job.name,))
+        return True
+
+    def _finish(self, state):
+        logger.info("Job %r done, after %d tasks", state.job.name,
+                    state.served)
+        if state.tasks is not None:
+            state.tasks.close()
+        state.job._end_run()
+
+    def _work(self):
+        while True:
+            state = self._acquire()
+            if state is None:
+                return
+            start = time.time()
+            try:
+                more = self._step(state)
+            except Exception, e:
+                logger.exception("Job %r failed", state.job.name)
+                state.error = e
+                more = False
+            cost = time.time() - start
+            state.seconds += cost
+            self._m_seconds.inc(cost, (state.job.name,))
+            if not more:
+                self._finish(state)
+            ## A minimal cost, so that jobs with instant tasks
+            ## still take turns
+            self._release(state, max(cost, 1e-6), not more)
+
+    def run(self):
+        """Run all the jobs, until they're done"""
+        threads = [threading.Thread(target=self._work,
+                                    name='simplespider-worker-{0}'.format(i))
+                   for i in xrange(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def stats(self):
+        """Per-job statistics"""
+        with self._cond:
+            return dict((state.job.name, {
+                'tasks': state.served,
+                'seconds': state.seconds,
+                'done': state.done,
+                'error': state.error,
+            }) for state in self._states)
@@ -0,0 +1,284 @@
+"""
+Low-overhead metrics: counters, gauges and latency histograms
+
+Metrics are kept in a :py:class:`Registry`, which can render them in
+the Prometheus text format, optionally served over HTTP::
+
+    registry = Registry()
+    spider = Spider(metrics=registry)
+    spider.add_runners([Downloader(metrics=registry), LinkExtractor()])
+    start_http_server(registry, port=9100)
+"""
+
+import BaseHTTPServer
+import threading
+import time
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(k, str(v).replace('\\', '\\\\')
+                           .replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in pairs) + '}'
+
+
+class Counter(object):
+    """A monotonically increasing value, for each set of label values"""
+
+    type = 'counter'
+
+    def __init__(self, name, help='', labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()  # spiders may share the registry
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            try:
+                self._values[labels] += amount
+            except KeyError:
+                self._values[labels] = amount
+
+    def get(self, labels=()):
+        return self._values.get(labels, 0)
+
+    def total(self):
+        return sum(self.snapshot().itervalues())
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        for labels, value in sorted(self.snapshot().iteritems()):
+            yield '{0}{1} {2}'.format(
+                self.name, _format_labels(self.labels, labels), value)
+
+
+class Gauge(object):
+    """A value computed on demand, by calling ``func``"""
+
+    type = 'gauge'
+
+    def __init__(self, name, help='', func=None):
+        self.name = name
+        self.help = help
+        self.func = func
+
+    def get(self):
+        return self.func()
+
+    def snapshot(self):
+        return {(): self.get()}
+
+    def render(self):
+        yield '{0} {1}'.format(self.name, self.get())
+
+
+class HistogramData(object):
+    """
+    Log-linear histogram of values, in the spirit of HdrHistogram.
+
+    Values are recorded as integers (in ``unit`` fractions, eg.
+    microseconds); each power of two is split in ``2 ** sub_bits``
+    linear buckets, so the relative error is at most
+    ``2 ** -sub_bits`` whatever the magnitude, and recording a value
+    is just a few integer operations.
+    """
+
+    __slots__ = ['unit', 'sub_bits', 'counts', 'count', 'sum', 'min',
+                 'max']
+
+    def __init__(self, unit=1e-6, sub_bits=4):
+        self.unit = unit
+        self.sub_bits = sub_bits
+        self.counts = {}  # bucket index -> count
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def _bucket(self, value):
+        v = int(value / self.unit)
+        if v < (2 << self.sub_bits):
+            return max(v, 0)
+        ## len(bin(v)) - 2 is v.bit_length(), missing on Python 2.6
+        shift = len(bin(v)) - 2 - self.sub_bits - 1
+        return (shift << self.sub_bits) + (v >> shift)
+
+    def _bucket_bounds(self, idx):
+        sub = 1 << self.sub_bits
+        if idx < 2 * sub:
+            return idx, idx + 1
+        shift = (idx >> self.sub_bits) - 1
+        mantissa = idx - (shift << self.sub_bits)
+        return mantissa << shift, (mantissa + 1) << shift
+
+    def record(self, value):
+        idx = self._bucket(value)
+        try:
+            self.counts[idx] += 1
+        except KeyError:
+            self.counts[idx] = 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Approximate value at percentile ``p`` (0-100)"""
+        if not self.count:
+            return None
+        target = max(1, p / 100.0 * self.count)
+        seen = 0
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            if seen >= target:
+                low, high = self._bucket_bounds(idx)
+                value = (low + high) / 2.0 * self.unit
+                return min(max(value, self.min), self.max)
+        return self.max  # pragma: no cover
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+class Histogram(object):
+    """Latency histograms, for each set of label values"""
+
+    type = 'summary'
+    quantiles = (0.5, 0.9, 0.99)
+
+    def __init__(self, name, help='', labels=(), unit=1e-6):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.unit = unit
+        self._values = {}
+        self._lock = threading.Lock()  # spiders may share the registry
+
+    def observe(self, value, labels=()):
+        with self._lock:
+            try:
+                data = self._values[labels]
+            except KeyError:
+                data = self._values[labels] = HistogramData(unit=self.unit)
+            data.record(value)
+
+    def get(self, labels=()):
+        return self._values.get(labels)
+
+    def snapshot(self):
+        with self._lock:
+            return dict((labels, data.summary())
+                        for labels, data in self._values.iteritems())
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for labels, data in sorted(self._values.iteritems()):
+                for q in self.quantiles:
+                    lines.append('{0}{1} {2}'.format(
+                        self.name,
+                        _format_labels(self.labels, labels,
+                                       [('quantile', q)]),
+                        data.percentile(q * 100)))
+                label_str = _format_labels(self.labels, labels)
+                lines.append('{0}_sum{1} {2}'.format(
+                    self.name, label_str, data.sum))
+                lines.append('{0}_count{1} {2}'.format(
+                    self.name, label_str, data.count))
+        return lines
+
+
+class Registry(object):
+    """A collection of named metrics"""
+
+    def __init__(self):
+        self._metrics = {}
+        self.start_time = time.time()
+
+    def _register(self, klass, name, *args, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = klass(name, *args, **kwargs)
+        elif not isinstance(metric, klass):
+            raise ValueError("Metric {0!r} is already registered as a {1}"
+                             .format(name, metric.type))
+        return metric
+
+    def counter(self, name, help='', labels=()):
+        return self._register(Counter, name, help, labels)
+
+    def gauge(self, name, help='', func=None):
+        return self._register(Gauge, name, help, func)
+
+    def histogram(self, name, help='', labels=(), unit=1e-6):
+        return self._register(Histogram, name, help, labels, unit)
+
+    def get(self, name):
+        return self._metrics[name]
+
+    def rate(self, name):
+        """Average per-second rate of a counter, since start"""
+        elapsed = time.time() - self.start_time
+        if elapsed <= 0:
+            return 0.0
+        return self._metrics[name].total() / elapsed
+
+    def snapshot(self):
+        """All the current values, as a dict"""
+        return dict((name, metric.snapshot())
+                    for name, metric in self._metrics.iteritems())
+
+    def render_text(self):
+        """Render all the metrics in the Prometheus text format"""
+        lines = []
+        for name, metric in sorted(self._metrics.iteritems()):
+            if metric.help:
+                lines.append('# HELP {0} {1}'.format(name, metric.help))
+            lines.append('# TYPE {0} {1}'.format(name, metric.type))
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def start_http_server(registry, port=9100, addr='127.0.0.1'):
+    """
+    Serve the registry metrics over HTTP, from a daemon thread.
+
+    :return: the server object; call ``shutdown()`` on it to stop.
+    """
+
+    class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.render_text()
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer((addr, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
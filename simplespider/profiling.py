@@ -0,0 +1,210 @@
+"""
+Opt-in profiling hooks for long-running crawls
+
+The :py:class:`Profiler` runs cProfile on a sample of the runner
+executions, accumulating the statistics per runner, and optionally
+takes periodic memory snapshots: tracemalloc ones on Python 3.4+,
+otherwise counts of the objects tracked by the garbage collector, per
+type, along with the resident memory size. Results are written to
+``output_dir`` every ``dump_every`` tasks, or on a signal; another
+signal can turn profiling on and off, so it can be enabled on a
+running crawl::
+
+    spider = Spider(profiler=Profiler(output_dir='/tmp/prof',
+                                      active=False,
+                                      dump_signal=signal.SIGUSR1,
+                                      toggle_signal=signal.SIGUSR2))
+
+    % kill -USR2 <pid>  # start profiling
+    % kill -USR1 <pid>  # dump the results
+"""
+
+from collections import defaultdict
+import cProfile
+import gc
+import logging
+import os
+import pstats
+import random
+import signal
+import threading
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    tracemalloc = None  # Python < 3.4
+
+from simplespider.utils import current_rss
+
+logger = logging.getLogger(__name__)
+
+
+class Profiler(object):
+    """Samples runner executions with cProfile, grouped by runner"""
+
+    def __init__(self, output_dir='.', sample_rate=0.01, dump_every=None,
+                 active=True, snapshot_every=None, snapshot_top=50,
+                 dump_signal=None, toggle_signal=None):
+        """
+        :param output_dir: directory the results are written to
+        :param sample_rate: fraction of runner executions to profile
+        :param dump_every: dump the results every this many tasks
+        :param active: whether to start profiling right away
+        :param snapshot_every: take a memory snapshot every this
+            many tasks, and dump the difference with the first one
+            (without tracemalloc, snapshots walk all the objects:
+            take them rarely)
+        :param snapshot_top: number of allocation sites (or object
+            types) to dump
+        :param dump_signal: signal triggering a dump, eg.
+            ``signal.SIGUSR1``. (Default: None)
+        :param toggle_signal: signal turning profiling on and off, eg.
+            ``signal.SIGUSR2``. (Default: None)
+        """
+        self.output_dir = output_dir
+        self.sample_rate = sample_rate
+        self.dump_every = dump_every
+        self.active = active
+        self.snapshot_every = snapshot_every
+        self.snapshot_top = snapshot_top
+
+        self.stats = {}  # runner name -> pstats.Stats
+        self.samples = {}  # runner name -> number of profiled runs
+        self._tasks = 0
+        self._dumps = 0
+        self._dump_requested = False
+        self._local = threading.local()
+        self._first_snapshot = None
+
+        self._install_signal(dump_signal, self._on_dump_signal)
+        self._install_signal(toggle_signal, self._on_toggle_signal)
+
+    def _install_signal(self, signum, handler):
+        if signum is None:
+            return
+        try:
+            signal.signal(signum, handler)
+        except ValueError:  # pragma: no cover
+            logger.warning("Cannot install signal handlers "
+                           "outside of the main thread")
+
+    def _on_dump_signal(self, signum, frame):
+        ## Dumping from within the signal handler isn't safe:
+        ## wait for the current task to complete.
+        self._dump_requested = True
+
+    def _on_toggle_signal(self, signum, frame):
+        self.active = not self.active
+
+    def begin(self, runner):
+        """Maybe start profiling a runner execution"""
+        if not self.active or getattr(self._local, 'profile', None):
+            return None
+        if random.random() >= self.sample_rate:
+            return None
+        profile = cProfile.Profile()
+        self._local.profile = profile
+        profile.enable()
+        return profile
+
+    def end(self, runner, profile):
+        """Stop profiling a runner execution started by :py:meth:`begin`"""
+        if profile is None:
+            return
+        profile.disable()
+        self._local.profile = None
+        name = type(runner).__name__
+        if name in self.stats:
+            self.stats[name].add(profile)
+        else:
+            self.stats[name] = pstats.Stats(profile)
+        self.samples[name] = self.samples.get(name, 0) + 1
+
+    def task_done(self):
+        """Called after each task, to take snapshots and dumps"""
+        self._tasks += 1
+        if self.snapshot_every and self.active:
+            if tracemalloc is not None and not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if self._tasks % self.snapshot_every == 0:
+                self.dump_snapshot()
+        if self._dump_requested or (
+                self.dump_every and self._tasks % self.dump_every == 0):
+            self._dump_requested = False
+            self.dump()
+
+    def _path(self, name):
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        return os.path.join(self.output_dir, '{0}-{1}.{2}'.format(
+            name, os.getpid(), self._dumps))
+
+    def dump(self):
+        """
+        Write the accumulated statistics for each runner, both in
+        binary form (to be loaded with :py:mod:`pstats`) and as a
+        text report sorted by cumulative time.
+        """
+        paths = []
+        for name, stats in sorted(self.stats.iteritems()):
+            path = self._path('profile-' + name)
+            stats.dump_stats(path + '.pstats')
+            with open(path + '.txt', 'w') as fp:
+                fp.write("{0} profiled executions of {1}\n\n".format(
+                    self.samples[name], name))
+                stats.stream = fp
+                stats.sort_stats('cumulative').print_stats(30)
+            paths.append(path + '.pstats')
+        self._dumps += 1
+        logger.info("Profiling results written to %s", self.output_dir)
+        return paths
+
+    def dump_snapshot(self):
+        """Write the allocation differences since the first snapshot"""
+        if tracemalloc is None:
+            return self._dump_object_counts()
+        snapshot = tracemalloc.take_snapshot()
+        if self._first_snapshot is None:
+            self._first_snapshot = snapshot
+            return None
+        path = self._path('tracemalloc') + '.txt'
+        with open(path, 'w') as fp:
+            diff = snapshot.compare_to(self._first_snapshot, 'lineno')
+            for stat in diff[:self.snapshot_top]:
+                fp.write('{0}\n'.format(stat))
+        self._dumps += 1
+        return path
+
+    def _dump_object_counts(self):
+        """Write the growth of the object counts since the first snapshot"""
+        counts, rss = object_counts(), current_rss()
+        if self._first_snapshot is None:
+            self._first_snapshot = (counts, rss)
+            return None
+        first_counts, first_rss = self._first_snapshot
+        growth = sorted(((count - first_counts.get(name, 0), count, name)
+                         for name, count in counts.iteritems()),
+                        reverse=True)
+        path = self._path('objects') + '.txt'
+        with open(path, 'w') as fp:
+            if rss is not None and first_rss is not None:
+                fp.write('RSS: {0} bytes ({1:+d})\n\n'.format(
+                    rss, rss - first_rss))
+            for diff, count, name in growth[:self.snapshot_top]:
+                if diff <= 0:
+                    break
+                fp.write('{0}: {1} ({2:+d})\n'.format(name, count, diff))
+        self._dumps += 1
+        return path
+
+
+def object_counts():
+    """
+    Number of objects tracked by the garbage collector (containers
+    and instances, not strings or numbers), per type
+    """
+    by_type = defaultdict(int)
+    for obj in gc.get_objects():
+        by_type[type(obj)] += 1
+    return dict(('{0}.{1}'.format(t.__module__, t.__name__), count)
+                for t, count in by_type.iteritems())
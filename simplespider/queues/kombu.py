@@ -4,14 +4,31 @@ Kombu-based tasks queue
 
 from __future__ import absolute_import
 
-from kombu import Connection
+from collections import deque
+import time
+
+from kombu import Connection, Exchange, Producer, Queue
 
 from simplespider import BaseQueueManager, BaseTask
-from simplespider.utils import lazy_property
 
 
 class KombuQueueSimple(BaseQueueManager):
-    """Queue based on kombu.simple queues"""
+    """
+    Queue based on kombu.simple queues
+
+    Tasks can be routed to different broker queues, by passing a
+    ``routes`` mapping of task classes (or ``module:Class`` type
+    strings) to queue names, or a callable returning the queue name
+    for a given task (or ``None`` for the default queue)::
+
+        KombuQueueSimple(
+            connection='amqp://',
+            routes={DownloadTask: 'fetch', ScrapingTask: 'parse'},
+            consume_from=['fetch'])
+
+    Workers only pop tasks from the queues listed in ``consume_from``,
+    so fetching and parsing can be scaled independently.
+    """
 
     def __init__(self, **kwargs):
         """
@@ -23,6 +40,15 @@ class KombuQueueSimple(BaseQueueManager):
             serializer to be used for tasks. (Default: 'json')
         :param compression:
             compression to be used. (Default: None)
+        :param timeout:
+            how many seconds to wait for a message before
+            considering the queue empty. (Default: 1)
+        :param routes:
+            dict or callable used to pick the queue for each task.
+            (Default: None, everything goes to ``queue_name``)
+        :param consume_from:
+            list of queue names tasks will be popped from.
+            (Default: ``queue_name`` plus all the queues in ``routes``)
         """
         if 'connection' not in kwargs:
             raise TypeError("The 'connection' argument is required!")
@@ -31,19 +57,107 @@ class KombuQueueSimple(BaseQueueManager):
         kwargs.setdefault('queue_name', 'simplespider_tasks')
         kwargs.setdefault('serializer', 'json')
         kwargs.setdefault('compression', None)
+        kwargs.setdefault('timeout', 1)
+        kwargs.setdefault('routes', None)
+        if kwargs.get('consume_from') is None:
+            consume_from = [kwargs['queue_name']]
+            if isinstance(kwargs['routes'], dict):
+                for name in kwargs['routes'].itervalues():
+                    if name not in consume_from:
+                        consume_from.append(name)
+            kwargs['consume_from'] = consume_from
         super(KombuQueueSimple, self).__init__(**kwargs)
 
+        self._queues = {}
+        self._producers = {}
+        self._routes_cache = {}
+        self._next_queue = 0
+
     @property
     def connection(self):
         return self.conf['connection']
 
-    @lazy_property
+    @property
     def queue(self):
-        return self.connection.SimpleQueue(self.conf['queue_name'])
+        """The default queue"""
+        return self.get_queue(self.conf['queue_name'])
+
+    def get_queue(self, name):
+        """Get the SimpleQueue with the given name"""
+        if name not in self._queues:
+            self._queues[name] = self._make_queue(name)
+        return self._queues[name]
+
+    def _make_queue(self, name):
+        return self.connection.SimpleQueue(name)
+
+    def get_producer(self, name):
+        """
+        Get a producer publishing to the queue with the given name,
+        without consuming from it (unlike :py:meth:`get_queue`)
+        """
+        if name not in self._producers:
+            ## Same entities as kombu's SimpleQueue
+            exchange = Exchange(name, type='direct')
+            channel = self.connection.default_channel
+            Queue(name, exchange, name)(channel).declare()
+            self._producers[name] = Producer(channel, exchange=exchange,
+                                             routing_key=name)
+        return self._producers[name]
+
+    def route(self, task):
+        """Return the name of the queue this task should be sent to"""
+        routes = self.conf['routes']
+        if routes is None:
+            return self.conf['queue_name']
+        if callable(routes):
+            return routes(task) or self.conf['queue_name']
+
+        ## Look up the task class and its bases, so subclasses
+        ## get routed like their parents, unless told otherwise.
+        klass = type(task)
+        if klass not in self._routes_cache:
+            name = self.conf['queue_name']
+            for base in klass.__mro__:
+                type_name = ':'.join((base.__module__, base.__name__))
+                if base in routes:
+                    name = routes[base]
+                    break
+                if type_name in routes:
+                    name = routes[type_name]
+                    break
+            self._routes_cache[klass] = name
+        return self._routes_cache[klass]
+
+    def _get_message(self):
+        """Get a message from any of the consumed queues"""
+        names = self.conf['consume_from']
+        if len(names) == 1:
+            queue = self.get_queue(names[0])
+            try:
+                return queue.get(block=True, timeout=self.conf['timeout'])
+            except queue.Empty:
+                raise IndexError("pop from empty queue")
+
+        ## Poll the queues in turn, starting from a different
+        ## one each time, so none of them gets starved.
+        deadline = time.time() + self.conf['timeout']
+        while True:
+            for i in xrange(len(names)):
+                self._next_queue = (self._next_queue + 1) % len(names)
+                queue = self.get_queue(names[self._next_queue])
+                try:
+                    return queue.get_nowait()
+                except queue.Empty:
+                    pass
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise IndexError("pop from empty queue")
+            time.sleep(min(remaining, .05))
 
     def pop(self):
+        message = self._get_message()
         ## We need to deserialize the task..
-        message = self.queue.get(block=True, timeout=1)
         raw_task = message.payload
         task = BaseTask.from_dict(raw_task)
         message.ack()
@@ -51,9 +165,204 @@ class KombuQueueSimple(BaseQueueManager):
 
     def push(self, name, task):
         assert name == task.id
-        self.queue.put(task.to_dict(),
-                       serializer=self.conf['serializer'],
-                       compression=self.conf['compression'])
+        self.get_producer(self.route(task)).publish(
+            task.to_dict(),
+            serializer=self.conf['serializer'],
+            compression=self.conf['compression'])
+
+    def release(self):
+        """
+        Stop consuming from the broker, giving back the messages
+        already delivered to us, eg. before handing this queue over
+        to another worker. Pushing tasks is still possible.
+        """
+        for queue in self._queues.itervalues():
+            queue.close()  # cancel the consumer
+            while queue.buffer:
+                queue.buffer.popleft().requeue()
+        self._queues = {}
+
+    def __len__(self):
+        return sum(len(self.get_queue(name))
+                   for name in self.conf['consume_from'])
+
+
+class KombuQueueBatched(KombuQueueSimple):
+    """
+    Kombu queue packing many tasks in each message.
+
+    Pushed tasks are collected locally and published as a single
+    message (a list of serialized tasks) once ``publish_batch_size``
+    of them are pending, or when :py:meth:`flush` is called.
+    Popped messages are unpacked in a local buffer, and acknowledged
+    only once :py:meth:`task_done` has been called for all the
+    tasks they contained, so a worker dying mid-task will cause
+    the message to be redelivered.
+
+    ``len()`` is approximate: the broker is asked for the queue size
+    at most once every ``length_ttl`` seconds.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param publish_batch_size:
+            maximum number of tasks to be sent in a single
+            message. (Default: 100)
+        :param prefetch_count:
+            number of messages the broker is allowed to send
+            us before acknowledgement. (Default: 10)
+        :param length_ttl:
+            how many seconds to cache the queue length
+            for. (Default: 5)
+        """
+        kwargs.setdefault('publish_batch_size', 100)
+        kwargs.setdefault('prefetch_count', 10)
+        kwargs.setdefault('length_ttl', 5)
+        super(KombuQueueBatched, self).__init__(**kwargs)
+
+        self._outbox = {}  # queue name -> serialized tasks to be published
+        self._buffer = deque()  # (name, task, message) waiting to be run
+        self._pending = {}  # task name -> [messages]
+        self._unacked = {}  # message delivery tag -> outstanding tasks
+        self._length_cache = (0, None)  # (broker length, timestamp)
+        self._batch_size_avg = 1.0
+
+    def _make_queue(self, name):
+        queue = self.connection.SimpleQueue(name)
+        queue.consumer.qos(prefetch_count=self.conf['prefetch_count'])
+        return queue
+
+    def pop(self):
+        if not self._buffer:
+            ## Make sure our own tasks are visible before
+            ## waiting for new ones from the broker.
+            self.flush()
+            self._fetch()
+        name, task, message = self._buffer.popleft()
+        self._pending.setdefault(name, []).append(message)
+        return name, task
+
+    def _fetch(self):
+        """Fill the local buffer with messages from the broker"""
+        ## Empty messages don't fill the buffer: keep waiting, until
+        ## a task arrives or the queue looks empty
+        while not self._buffer:
+            self._receive(self._get_message())
+
+        ## Take any other message that was already delivered to us,
+        ## without waiting for the broker. When polling from many
+        ## queues, messages are fetched one at a time instead.
+        if len(self.conf['consume_from']) > 1:
+            return
+        queue = self.get_queue(self.conf['consume_from'][0])
+        for _ in xrange(self.conf['prefetch_count'] - 1):
+            try:
+                message = queue.get(block=True, timeout=0)
+            except queue.Empty:
+                break
+            self._receive(message)
+
+    def _receive(self, message):
+        payload = message.payload
+        if isinstance(payload, dict):
+            payload = [payload]  # Published by KombuQueueSimple
+        if not payload:
+            message.ack()
+            return
+        self._batch_size_avg = (self._batch_size_avg * 0.9 +
+                                len(payload) * 0.1)
+        self._unacked[message.delivery_tag] = len(payload)
+        for raw_task in payload:
+            task = BaseTask.from_dict(raw_task)
+            self._buffer.append((task.id, task, message))
+
+    def push(self, name, task):
+        assert name == task.id
+        queue_name = self.route(task)
+        outbox = self._outbox.setdefault(queue_name, [])
+        outbox.append(task.to_dict())
+        if len(outbox) >= self.conf['publish_batch_size']:
+            self._publish(queue_name)
+
+    def push_many(self, items):
+        batch_size = self.conf['publish_batch_size']
+        full = set()
+        for name, task in items:
+            assert name == task.id
+            queue_name = self.route(task)
+            outbox = self._outbox.setdefault(queue_name, [])
+            outbox.append(task.to_dict())
+            if len(outbox) >= batch_size:
+                full.add(queue_name)
+        ## Publish whole batches, keeping the rest for later
+        for queue_name in full:
+            outbox = self._outbox[queue_name]
+            cut = len(outbox) - len(outbox) % batch_size
+            self._outbox[queue_name] = outbox[cut:]
+            self._publish_tasks(queue_name, outbox[:cut])
+
+    def _publish(self, queue_name):
+        self._publish_tasks(queue_name, self._outbox.pop(queue_name, []))
+
+    def _publish_tasks(self, queue_name, outbox):
+        batch_size = self.conf['publish_batch_size']
+        producer = self.get_producer(queue_name)
+        for i in xrange(0, len(outbox), batch_size):
+            producer.publish(outbox[i:i + batch_size],
+                             serializer=self.conf['serializer'],
+                             compression=self.conf['compression'])
+
+    def flush(self):
+        """Publish all the tasks waiting in the outbox"""
+        for queue_name in list(self._outbox):
+            self._publish(queue_name)
+
+    def task_done(self, name):
+        """
+        Mark a popped task as completed, acknowledging its
+        message once all the tasks it contained are done.
+        """
+        ## Tasks generated while running this one must reach the
+        ## broker before we acknowledge, or they might get lost.
+        self.flush()
+        messages = self._pending.get(name)
+        if not messages:
+            return
+        message = messages.pop(0)
+        if not messages:
+            del self._pending[name]
+        tag = message.delivery_tag
+        if tag not in self._unacked:
+            return  # The message was released
+        self._unacked[tag] -= 1
+        if self._unacked[tag] <= 0:
+            del self._unacked[tag]
+            message.ack()
+
+    def release(self):
+        """
+        Give back to the broker all the messages in the local buffer,
+        and stop consuming, eg. before handing this queue over to
+        another worker.
+
+        Messages are requeued whole, so tasks from the same message
+        that were already executed will be run again.
+        """
+        self.flush()
+        messages = {}
+        for name, task, message in self._buffer:
+            messages[message.delivery_tag] = message
+        self._buffer.clear()
+        for tag, message in messages.iteritems():
+            del self._unacked[tag]
+            message.requeue()
+        super(KombuQueueBatched, self).release()
 
     def __len__(self):
-        return len(self.queue)
+        length, timestamp = self._length_cache
+        now = time.time()
+        if timestamp is None or (now - timestamp) > self.conf['length_ttl']:
+            length = super(KombuQueueBatched, self).__len__()
+            self._length_cache = (length, now)
+        return (int(length * self._batch_size_avg) + len(self._buffer) +
+                sum(len(x) for x in self._outbox.itervalues()))
@@ -0,0 +1,292 @@
+"""
+Host-sharded task queue, for crawling with many workers
+
+The frontier is split into a fixed number of shards, each of them
+backed by its own queue (usually a :py:class:`KombuQueueBatched`
+pointed at a shared broker). Tasks are assigned to shards by
+consistent hashing of their URL host, so all the tasks for a given
+host end up in the same shard, and each worker only pops from the
+shards it owns.
+"""
+
+from __future__ import absolute_import
+
+import bisect
+import hashlib
+import logging
+import struct
+
+from simplespider import BaseQueueManager
+from simplespider.utils import url_host
+
+logger = logging.getLogger(__name__)
+
+## Deduplication states of the tasks of a shard
+_QUEUED = 'queued'
+_DONE = 'done'
+
+
+def _hash(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return struct.unpack('>Q', hashlib.md5(key).digest()[:8])[0]
+
+
+class HashRing(object):
+    """
+    Consistent hashing ring.
+
+    Each node is placed ``replicas`` times on the ring, and keys are
+    assigned to the first node found going clockwise from their hash.
+    Adding or removing a node only moves the keys falling in its
+    own segments.
+    """
+
+    def __init__(self, nodes, replicas=64):
+        self._replicas = replicas
+        self._ring = []
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node):
+        for i in xrange(self._replicas):
+            point = (_hash('{0}#{1}'.format(node, i)), node)
+            bisect.insort(self._ring, point)
+
+    def remove_node(self, node):
+        self._ring = [x for x in self._ring if x[1] != node]
+
+    @property
+    def nodes(self):
+        return sorted(set(x[1] for x in self._ring))
+
+    def get_node(self, key):
+        if not self._ring:
+            raise ValueError("The hash ring is empty")
+        idx = bisect.bisect(self._ring, (_hash(key),))
+        if idx == len(self._ring):
+            idx = 0
+        return self._ring[idx][1]
+
+
+def assign_shards(worker, workers, shards):
+    """
+    Pick the shards owned by ``worker``, using rendezvous hashing:
+    when workers join or leave, only the shards of the involved
+    workers change owner.
+    """
+    owned = []
+    for shard in shards:
+        owner = max(workers,
+                    key=lambda w: _hash('{0}:{1}'.format(w, shard)))
+        if owner == worker:
+            owned.append(shard)
+    return owned
+
+
+def task_host(task):
+    """Default shard key: the host of the task URL, or the task id"""
+    url = task.get('url')
+    if url:
+        host = url_host(url)
+        if host:
+            return host
+    return task.id
+
+
+class ShardedQueueManager(BaseQueueManager):
+    """
+    Queue manager distributing tasks amongst host-hashed shards.
+
+    Tasks for shards owned by this worker are pushed straight to the
+    shard queue; the others are collected and forwarded to their shard
+    in batches, when :py:meth:`flush` or :py:meth:`task_done` are called
+    or ``forward_batch_size`` of them are pending.
+
+    Each worker deduplicates the tasks of the shards it owns: tasks
+    already queued (or run) from a shard are not pushed to it again,
+    and copies forwarded by other workers are dropped when popped. The
+    deduplication state of a shard is kept in the mapping returned by
+    ``shard_seen``: with the default (a dict in memory) it is lost when
+    a shard changes owner, and the new owner may run again tasks that
+    were already run; use a shared, persistent mapping to avoid that.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param shards:
+            number of shards. (Required)
+        :param shard_queue:
+            callable returning the queue manager for a given shard
+            number, eg. ``lambda n: KombuQueueBatched(connection=url,
+            queue_name='tasks.{0}'.format(n), timeout=0.1)``. (Required)
+        :param owned_shards:
+            list of shards owned by this worker. (Default: all)
+        :param shard_key:
+            callable returning the key used to pick a shard for a
+            task. (Default: :py:func:`task_host`)
+        :param forward_batch_size:
+            maximum number of tasks kept back before forwarding them
+            to shards owned by other workers. (Default: 100)
+        :param shard_seen:
+            callable returning the mapping used to deduplicate the
+            tasks of a given shard number (task names to ``'queued'``
+            or ``'done'``), eg. an anydbm database shared by the
+            workers. (Default: a new dict)
+        """
+        if not kwargs.get('shards'):
+            raise TypeError("The 'shards' argument is required!")
+        if not kwargs.get('shard_queue'):
+            raise TypeError("The 'shard_queue' argument is required!")
+        kwargs.setdefault('owned_shards', range(kwargs['shards']))
+        kwargs.setdefault('shard_key', task_host)
+        kwargs.setdefault('forward_batch_size', 100)
+        kwargs.setdefault('shard_seen', lambda shard: {})
+        super(ShardedQueueManager, self).__init__(**kwargs)
+
+        self.ring = HashRing(xrange(self.conf['shards']))
+        self._queues = {}
+        self._outbox = {}  # shard -> [(name, task)]
+        self._outbox_size = 0
+        self._seen = {}  # owned shard -> {task name: _QUEUED or _DONE}
+        self._popped = {}  # task name -> [shards]
+        self._owned = []
+        self._next_shard = 0
+        self.set_owned_shards(self.conf['owned_shards'])
+
+    def get_queue(self, shard):
+        if shard not in self._queues:
+            self._queues[shard] = self.conf['shard_queue'](shard)
+        return self._queues[shard]
+
+    def get_shard(self, task):
+        return self.ring.get_node(self.conf['shard_key'](task))
+
+    @property
+    def owned_shards(self):
+        return list(self._owned)
+
+    def set_owned_shards(self, shards):
+        """
+        Change the set of shards owned by this worker.
+
+        Tasks kept back for forwarding are flushed first, and the
+        queues of released shards are flushed and released (so they
+        stop receiving tasks), so no task gets lost or held back:
+        whatever is left in a shard stays in its queue,
+        waiting for the new owner (along with the deduplication
+        state, if ``shard_seen`` returns a shared mapping).
+        """
+        shards = sorted(shards)
+        released = set(self._owned) - set(shards)
+        self.flush()
+        for shard in released:
+            queue = self.get_queue(shard)
+            queue.flush()
+            release = getattr(queue, 'release', None)
+            if release is not None:
+                release()
+            self._seen.pop(shard, None)
+        self._owned = shards
+        for shard in shards:
+            if shard not in self._seen:
+                self._seen[shard] = self.conf['shard_seen'](shard)
+
+    def rebalance(self, worker, workers):
+        """Recompute the owned shards, after workers joined or left"""
+        shards = assign_shards(worker, workers, xrange(self.conf['shards']))
+        logger.info("Worker {0!r} now owns {1} shards out of {2}".format(
+            worker, len(shards), self.conf['shards']))
+        self.set_owned_shards(shards)
+
+    def push(self, name, task):
+        shard = self.get_shard(task)
+        seen = self._seen.get(shard)
+        if seen is not None:
+            if name not in seen:
+                seen[name] = _QUEUED
+                self.get_queue(shard).push(name, task)
+            return
+        self._outbox.setdefault(shard, []).append((name, task))
+        self._outbox_size += 1
+        if self._outbox_size >= self.conf['forward_batch_size']:
+            self.flush()
+
+    def push_many(self, items):
+        by_shard = {}
+        for name, task in items:
+            by_shard.setdefault(self.get_shard(task), []).append((name, task))
+        for shard, tasks in sorted(by_shard.iteritems()):
+            seen = self._seen.get(shard)
+            if seen is not None:
+                new = []
+                for name, task in tasks:
+                    if name not in seen:
+                        seen[name] = _QUEUED
+                        new.append((name, task))
+                self.get_queue(shard).push_many(new)
+                continue
+            self._outbox.setdefault(shard, []).extend(tasks)
+            self._outbox_size += len(tasks)
+        if self._outbox_size >= self.conf['forward_batch_size']:
+            self.flush()
+
+    def seen(self, name, task):
+        ## Only known for the shards we own
+        seen = self._seen.get(self.get_shard(task))
+        return seen is not None and name in seen
+
+    def flush(self):
+        """Forward all the tasks for shards owned by other workers"""
+        for shard, tasks in sorted(self._outbox.iteritems()):
+            queue = self.get_queue(shard)
+            queue.push_many(tasks)
+            queue.flush()
+        self._outbox = {}
+        self._outbox_size = 0
+        for shard in self._owned:
+            self.get_queue(shard).flush()
+
+    def pop(self):
+        ## Try each of the owned shards in turn, skipping tasks
+        ## that were already run from the same shard.
+        tried = 0
+        while tried < len(self._owned):
+            self._next_shard = (self._next_shard + 1) % len(self._owned)
+            shard = self._owned[self._next_shard]
+            queue = self.get_queue(shard)
+            try:
+                name, task = queue.pop()
+            except IndexError:
+                tried += 1
+                continue
+            seen = self._seen[shard]
+            if seen.get(name) == _DONE or name in self._popped:
+                queue.task_done(name)
+                continue
+            seen[name] = _QUEUED
+            self._popped.setdefault(name, []).append(shard)
+            return name, task
+
+        if self._outbox:
+            ## Maybe we're keeping back tasks some other worker
+            ## is waiting for..
+            self.flush()
+        raise IndexError("pop from empty queue")
+
+    def task_done(self, name):
+        self.flush()
+        shards = self._popped.get(name)
+        if not shards:
+            return
+        shard = shards.pop(0)
+        if not shards:
+            del self._popped[name]
+        seen = self._seen.get(shard)
+        if seen is not None:  # unless released meanwhile
+            seen[name] = _DONE
+        self.get_queue(shard).task_done(name)
+
+    def __len__(self):
+        return (sum(len(self.get_queue(shard)) for shard in self._owned) +
+                self._outbox_size)
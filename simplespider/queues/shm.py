@@ -0,0 +1,303 @@
+"""
+Shared-memory task queue, for many worker processes on a single node
+
+The queue lives in anonymous shared memory, so it must be created
+*before* forking the worker processes, which will inherit it::
+
+    queue = SharedMemoryQueueManager(size=64 * 1024 * 1024)
+
+    def worker():
+        spider = Spider(queue=queue)
+        spider.add_runners([Downloader(), LinkExtractor()])
+        spider.run()
+
+    task = DownloadTask(url='http://example.com')
+    queue.push(task.id, task)
+    procs = [multiprocessing.Process(target=worker) for _ in range(8)]
+"""
+
+from __future__ import absolute_import
+
+from collections import deque
+import ctypes
+import errno
+import hashlib
+import logging
+import multiprocessing
+import multiprocessing.sharedctypes
+import os
+import struct
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:  # pragma: no cover
+    import pickle
+
+from simplespider import BaseQueueManager
+
+logger = logging.getLogger(__name__)
+
+_header = struct.Struct('<I')
+
+
+class _State(ctypes.Structure):
+    _fields_ = [
+        ('head', ctypes.c_uint64),  # offset of the next record to be read
+        ('tail', ctypes.c_uint64),  # offset where the next record goes
+        ('used', ctypes.c_uint64),  # bytes used in the ring buffer
+        ('count', ctypes.c_uint64),  # records in the ring buffer
+    ]
+
+
+class _Worker(ctypes.Structure):
+    _fields_ = [
+        ('pid', ctypes.c_int64),  # 0 for free slots
+        ('active', ctypes.c_int64),  # tasks popped but not done yet
+    ]
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    ## Zombies (dead, but not waited for yet) are still there
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as fp:
+            return fp.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except (IOError, IndexError):
+        return True
+
+
+class SharedMemoryQueueManager(BaseQueueManager):
+    """
+    Queue manager storing pickled tasks in a shared-memory ring buffer.
+
+    Records are variable-sized (a length header followed by the
+    pickled ``(name, task)`` pair) and wrap around the end of the
+    buffer. All the operations take a single process-shared lock, for
+    a few microseconds.
+
+    Deduplication uses a shared bitmap (a Bloom filter with
+    ``dedup_hashes`` bits per task name): memory usage is fixed, but
+    there is a small probability of a new task being mistaken for an
+    already-queued one, depending on ``dedup_bits``.
+
+    When the buffer is full, tasks are kept in a process-local
+    overflow list and pushed again as soon as there is room.
+
+    ``pop()`` only reports the queue as empty once no other process
+    is running a task (which might yield new ones), so
+    :py:meth:`task_done` must be called for each popped task. Running
+    tasks are counted per process, and processes that died are no
+    longer waited for (the tasks they were running are lost).
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param size:
+            size of the ring buffer, in bytes. (Default: 16 MiB)
+        :param dedup_bits:
+            size of the deduplication bitmap, in bits. Set to 0
+            to disable deduplication. (Default: 2 ** 24)
+        :param dedup_hashes:
+            number of bits set for each task name. (Default: 3)
+        :param poll_interval:
+            seconds to sleep between checks, while waiting for
+            other processes to produce tasks. (Default: 0.001)
+        :param max_workers:
+            maximum number of processes popping tasks. (Default: 256)
+        """
+        kwargs.setdefault('size', 16 * 1024 * 1024)
+        kwargs.setdefault('dedup_bits', 2 ** 24)
+        kwargs.setdefault('dedup_hashes', 3)
+        kwargs.setdefault('poll_interval', 0.001)
+        kwargs.setdefault('max_workers', 256)
+        super(SharedMemoryQueueManager, self).__init__(**kwargs)
+
+        self._size = self.conf['size']
+        self._lock = multiprocessing.Lock()
+        self._state = multiprocessing.sharedctypes.RawValue(_State)
+        self._workers = multiprocessing.sharedctypes.RawArray(
+            _Worker, self.conf['max_workers'])
+        self._slot = None  # (pid, our slot in _workers)
+        self._buffer = multiprocessing.sharedctypes.RawArray(
+            ctypes.c_char, self._size)
+        self._buffer_addr = ctypes.addressof(self._buffer)
+        self._bitmap = None
+        if self.conf['dedup_bits'] > 0:
+            self._bitmap = multiprocessing.sharedctypes.RawArray(
+                ctypes.c_ubyte, (self.conf['dedup_bits'] + 7) // 8)
+        self._overflow = deque()
+
+    def _dedup_bits(self, name):
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        ## Double hashing, from the two halves of the digest
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(name).digest())
+        nbits = self.conf['dedup_bits']
+        for i in xrange(self.conf['dedup_hashes']):
+            yield (h1 + i * h2) % nbits
+
+    def _test(self, bits):
+        """Tell whether the bits are all set"""
+        bitmap = self._bitmap
+        return all(bitmap[bit >> 3] & (1 << (bit & 7)) for bit in bits)
+
+    def _test_and_set(self, bits):
+        """Set the bits, returning True if they were all set already"""
+        found = True
+        bitmap = self._bitmap
+        for bit in bits:
+            byte, mask = bit >> 3, 1 << (bit & 7)
+            if not bitmap[byte] & mask:
+                found = False
+                bitmap[byte] |= mask
+        return found
+
+    def _write(self, offset, data):
+        first = min(len(data), self._size - offset)
+        ctypes.memmove(self._buffer_addr + offset, data, first)
+        if first < len(data):
+            ctypes.memmove(self._buffer_addr, data[first:],
+                           len(data) - first)
+        return (offset + len(data)) % self._size
+
+    def _read(self, offset, length):
+        first = min(length, self._size - offset)
+        data = ctypes.string_at(self._buffer_addr + offset, first)
+        if first < length:
+            data += ctypes.string_at(self._buffer_addr, length - first)
+        return data, (offset + length) % self._size
+
+    def _put(self, record):
+        """Append a record to the ring, returning False if full"""
+        state = self._state
+        if state.used + len(record) > self._size:
+            return False
+        state.tail = self._write(state.tail, record)
+        state.used += len(record)
+        state.count += 1
+        return True
+
+    def _push_overflow(self):
+        """Move tasks from the local overflow to the ring. Needs lock."""
+        while self._overflow:
+            if not self._put(self._overflow[0]):
+                return
+            self._overflow.popleft()
+
+    def _record(self, name, task):
+        """Serialize a task, returning ``(record, dedup bits)``"""
+        payload = pickle.dumps((name, task), pickle.HIGHEST_PROTOCOL)
+        record = _header.pack(len(payload)) + payload
+        if len(record) > self._size:
+            raise ValueError("Task {0!r} is too large for the queue "
+                             "({1} bytes)".format(name, len(record)))
+        bits = None
+        if self._bitmap is not None:
+            bits = list(self._dedup_bits(name))
+        return record, bits
+
+    def _push_record(self, record, bits):
+        """Needs lock"""
+        if bits is not None and self._test_and_set(bits):
+            return
+        if self._overflow or not self._put(record):
+            self._overflow.append(record)
+
+    def push(self, name, task):
+        record, bits = self._record(name, task)
+        with self._lock:
+            self._push_overflow()
+            self._push_record(record, bits)
+
+    def push_many(self, items):
+        ## Serialize everything first, then take the lock only once
+        records = [self._record(name, task) for name, task in items]
+        if not records:
+            return
+        with self._lock:
+            self._push_overflow()
+            for record, bits in records:
+                self._push_record(record, bits)
+
+    def seen(self, name, task):
+        if self._bitmap is None:
+            return False
+        with self._lock:
+            return self._test(self._dedup_bits(name))
+
+    def flush(self):
+        if self._overflow:
+            with self._lock:
+                self._push_overflow()
+
+    def _worker(self):
+        """Our slot in the table of workers. Needs lock."""
+        pid = os.getpid()
+        if self._slot is not None and self._slot[0] == pid:
+            return self._slot[1]  # not inherited from the parent
+        free = None
+        for worker in self._workers:
+            if worker.pid == pid:
+                free = worker
+                break
+            if free is None and (worker.pid == 0 or
+                                 not _pid_alive(worker.pid)):
+                free = worker
+        if free is None:
+            raise RuntimeError("Too many processes using the queue "
+                               "(max_workers={0})"
+                               .format(self.conf['max_workers']))
+        free.pid, free.active = pid, 0
+        self._slot = (pid, free)
+        return free
+
+    def _active(self):
+        """
+        Tasks being run by any process, forgetting about the processes
+        that died meanwhile. Needs lock.
+        """
+        total = 0
+        pid = os.getpid()
+        for worker in self._workers:
+            if worker.active <= 0 or worker.pid == 0:
+                continue
+            if worker.pid != pid and not _pid_alive(worker.pid):
+                logger.warning("Process %d died while running %d tasks",
+                               worker.pid, worker.active)
+                worker.pid, worker.active = 0, 0
+                continue
+            total += worker.active
+        return total
+
+    def pop(self):
+        state = self._state
+        while True:
+            with self._lock:
+                self._push_overflow()
+                if state.count > 0:
+                    header, head = self._read(state.head, _header.size)
+                    length = _header.unpack(header)[0]
+                    payload, head = self._read(head, length)
+                    state.head = head
+                    state.used -= _header.size + length
+                    state.count -= 1
+                    self._worker().active += 1
+                    break
+                if not self._overflow and self._active() <= 0:
+                    raise IndexError("pop from empty queue")
+            ## Some other process is still running tasks, which
+            ## might yield new ones: wait for them.
+            time.sleep(self.conf['poll_interval'])
+        return pickle.loads(payload)
+
+    def task_done(self, name):
+        with self._lock:
+            self._push_overflow()
+            self._worker().active -= 1
+
+    def __len__(self):
+        return int(self._state.count) + len(self._overflow)
@@ -0,0 +1,249 @@
+"""
+Incremental recrawling
+
+The :py:class:`RecrawlIndex` keeps, for each fetched URL, a hash of
+its content, its ``ETag`` and ``Last-Modified`` headers, and when it
+should be fetched again. The revisit interval adapts to how often the
+page actually changes: it's multiplied by ``backoff`` each time the
+page is found unchanged, and divided by it when it changed, within
+``min_interval`` and ``max_interval``.
+
+The :py:class:`RecrawlTracker` runner updates the index after each
+download (skipping the scrapers for unchanged pages), and the spider
+queues the URLs as they become due::
+
+    index = RecrawlIndex(path='recrawl.db')
+    spider = Spider(recrawl=index)
+    spider.add_runners([Downloader(), RecrawlTracker(index=index),
+                        LinkExtractor(), MyScraper()])
+    spider.queue_task(DownloadTask(url='http://example.com'))
+    spider.run()  # runs forever, fetching pages as they become due
+
+Revisits send conditional requests (``If-None-Match`` and
+``If-Modified-Since``), so servers can answer with a cheap ``304``.
+"""
+
+import anydbm
+import hashlib
+import heapq
+import json
+import threading
+import time
+
+from simplespider import AbortTask
+from simplespider.web import BaseScraper, DownloadTask
+
+
+class RecrawlIndex(object):
+    """
+    Revisit state of the crawled URLs, with a heap of their due times.
+
+    The state is kept in an anydbm database if ``path`` is given (the
+    heap is rebuilt from it when opened), or in memory otherwise.
+    """
+
+    def __init__(self, path=None, initial_interval=86400.0,
+                 min_interval=3600.0, max_interval=30 * 86400.0,
+                 backoff=2.0, synchronous=False):
+        """
+        :param path: path of the database. (Default: None, in memory)
+        :param initial_interval: seconds before the first revisit
+        :param min_interval, max_interval: bounds of the intervals
+        :param backoff: factor the interval is multiplied by when a
+            page is found unchanged, and divided by when changed
+        :param synchronous: sync the database after each update
+        """
+        self.path = path
+        self.initial_interval = initial_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.synchronous = synchronous
+        self._lock = threading.Lock()
+        self._heap = []  # (due, url); stale entries are skipped
+        if path is None:
+            self._db = {}
+        else:
+            self._db = anydbm.open(path, 'c')
+        for key in self._db.keys():
+            state = json.loads(self._db[key])
+            self._heap.append((state['due'], key.decode('utf-8')))
+        heapq.heapify(self._heap)
+
+    def _key(self, url):
+        return url.encode('utf-8') if isinstance(url, unicode) else url
+
+    def get(self, url):
+        """Return the state dict for ``url``, or None"""
+        data = self._db.get(self._key(url))
+        if data is None:
+            return None
+        return json.loads(data)
+
+    def _put(self, url, state):
+        self._db[self._key(url)] = json.dumps(state)
+        if self.synchronous and hasattr(self._db, 'sync'):
+            self._db.sync()
+
+    def record(self, url, content_hash=None, etag=None, last_modified=None,
+               not_modified=False, now=None):
+        """
+        Record a fetch of ``url``, and schedule the next one.
+
+        :param not_modified: the server answered ``304 Not Modified``
+        :return: whether the page changed since the last fetch
+            (always True for new pages)
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            state = self.get(url)
+            if state is None:
+                changed = True
+                state = {'interval': float(self.initial_interval), 'visits': 0,
+                         'revisits': 0, 'changes': 0, 'hash': None,
+                         'etag': None, 'last_modified': None}
+            else:
+                if not_modified:
+                    changed = False
+                else:
+                    changed = content_hash != state['hash']
+                if changed:
+                    interval = state['interval'] / float(self.backoff)
+                    state['changes'] += 1
+                else:
+                    interval = state['interval'] * self.backoff
+                state['interval'] = max(self.min_interval,
+                                        min(self.max_interval, interval))
+            if not not_modified:
+                state['hash'] = content_hash
+                state['etag'] = etag
+                state['last_modified'] = last_modified
+            state['visits'] += 1
+            state['checked'] = now
+            state['due'] = now + state['interval']
+            self._put(url, state)
+            heapq.heappush(self._heap, (state['due'], url))
+        return changed
+
+    def reschedule(self, url, delay, now=None):
+        """Fetch ``url`` again in ``delay`` seconds, eg. after an error"""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            state = self.get(url)
+            if state is None:
+                return
+            state['due'] = now + delay
+            self._put(url, state)
+            heapq.heappush(self._heap, (state['due'], url))
+
+    def next_due(self):
+        """Time at which the next URL will be due, or None"""
+        with self._lock:
+            while self._heap:
+                due, url = self._heap[0]
+                state = self.get(url)
+                if state is not None and state['due'] == due:
+                    return due
+                heapq.heappop(self._heap)  # stale entry
+        return None
+
+    def pop_due(self, now=None, limit=None):
+        """
+        Pop the URLs that are due. Each of them is scheduled again
+        after its interval, in case the revisit fails without being
+        recorded; recording (or rescheduling) it overrides that.
+
+        Each pop bumps the ``revisits`` counter of the URL, so that
+        each revisit task gets a new id, and isn't dropped by the
+        queue as a duplicate of a previous (maybe failed) one.
+
+        :return: list of ``(url, state)`` tuples
+        """
+        if now is None:
+            now = time.time()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                if limit is not None and len(due) >= limit:
+                    break
+                time_due, url = heapq.heappop(self._heap)
+                state = self.get(url)
+                if state is None or state['due'] != time_due:
+                    continue  # stale entry
+                state['due'] = now + state['interval']
+                ## Revisit ids used to be based on the visits
+                state['revisits'] = state.get('revisits',
+                                              state['visits']) + 1
+                self._put(url, state)
+                heapq.heappush(self._heap, (state['due'], url))
+                due.append((url, state))
+        return due
+
+    def pop_due_tasks(self, now=None, limit=None):
+        """Pop the URLs that are due, as ``DownloadTask``s"""
+        return [DownloadTask(url=url, revisit=state['revisits'],
+                             etag=state['etag'],
+                             last_modified=state['last_modified'])
+                for url, state in self.pop_due(now, limit)]
+
+    def sync(self):
+        if hasattr(self._db, 'sync'):
+            self._db.sync()
+
+    def close(self):
+        if hasattr(self._db, 'close'):
+            self._db.close()
+
+    def __contains__(self, url):
+        return self._key(url) in self._db
+
+    def __len__(self):
+        return len(self._db)
+
+
+class RecrawlTracker(BaseScraper):
+    def __init__(self, **kwargs):
+        """
+        :param index: the :py:class:`RecrawlIndex` to be
+            updated. (Required)
+        :param skip_unchanged: stop the other runners (scrapers, link
+            extraction) from processing pages that didn't change since
+            the last visit. (Default: True)
+        :param error_delay: seconds to wait before fetching again pages
+            that returned an error. (Default: the page interval)
+        """
+        if kwargs.get('index') is None:
+            raise TypeError("The 'index' argument is required!")
+        kwargs.setdefault('skip_unchanged', True)
+        kwargs.setdefault('error_delay', None)
+        super(RecrawlTracker, self).__init__(**kwargs)
+
+    def __call__(self, task):
+        assert self.match(task)
+        index = self.conf['index']
+        response = task['response']
+        status_code = response['status_code']
+        headers = dict((k.lower(), v)
+                       for k, v in response['headers'].iteritems())
+
+        if status_code == 304:
+            changed = index.record(task['url'], not_modified=True)
+        elif not response['ok']:
+            state = index.get(task['url'])
+            if state is not None:
+                delay = self.conf['error_delay']
+                if delay is None:
+                    delay = state['interval']
+                index.reschedule(task['url'], delay)
+            return
+        else:
+            changed = index.record(
+                task['url'],
+                content_hash=hashlib.md5(response['content']).hexdigest(),
+                etag=headers.get('etag'),
+                last_modified=headers.get('last-modified'))
+
+        if not changed and self.conf['skip_unchanged']:
+            raise AbortTask("{0!r} didn't change".format(task['url']))
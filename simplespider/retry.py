@@ -0,0 +1,56 @@
+"""
+Delayed retries for failed tasks
+"""
+
+import heapq
+import itertools
+import random
+import time
+
+
+def backoff_delay(attempt, base=1.0, factor=2.0, max_delay=300.0,
+                  jitter=0.5):
+    """
+    Exponential backoff delay for the given (1-based) attempt.
+
+    The delay grows as ``base * factor ** (attempt - 1)``, up to
+    ``max_delay``, then a random fraction (up to ``jitter``) of it
+    is taken away, so that tasks failing together don't get all
+    retried at the same time.
+    """
+    delay = min(max_delay, base * (factor ** (attempt - 1)))
+    return delay * (1 - jitter * random.random())
+
+
+class RetryScheduler(object):
+    """
+    Keeps tasks waiting to be retried, in a heap sorted by due time.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()  # keep FIFO order on ties
+
+    def schedule(self, task, delay, now=None):
+        if now is None:
+            now = time.time()
+        heapq.heappush(self._heap, (now + delay, next(self._counter), task))
+
+    def next_due(self):
+        """Time at which the next task will be due, or None"""
+        if not self._heap:
+            return None
+        return self._heap[0][0]
+
+    def pop_due(self, now=None):
+        """Pop the first task that is due, or return None"""
+        if not self._heap:
+            return None
+        if now is None:
+            now = time.time()
+        if self._heap[0][0] > now:
+            return None
+        return heapq.heappop(self._heap)[2]
+
+    def __len__(self):
+        return len(self._heap)
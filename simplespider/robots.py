@@ -0,0 +1,269 @@
+"""
+robots.txt support
+
+:py:class:`RobotsCache` fetches ``/robots.txt`` once per host, and
+keeps the parsed rules in memory for ``ttl`` seconds, evicting the
+least recently used hosts beyond ``max_hosts``. Rules are compiled
+into a :py:class:`RobotsRules` matcher: plain prefixes are checked with
+``str.startswith``, patterns with ``*`` or ``$`` with a regular
+expression, and the longest matching rule wins (``Allow`` on ties), as
+in RFC 9309.
+
+Pass it to the downloader to skip disallowed pages; the crawl delays
+are applied to the per-host scheduler, if any. While a host's
+robots.txt can't be fetched (server or connection errors), its tasks
+are deferred until it's fetched again::
+
+    Downloader(robots=RobotsCache(), concurrency=AdaptiveConcurrency())
+"""
+
+from collections import OrderedDict
+import logging
+import re
+import threading
+import time
+import urllib
+import urlparse
+
+from simplespider.transports import RequestsTransport
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize_path(path):
+    ## Compare paths with the same percent-encoding (but keep "/"
+    ## and friends, which have a meaning of their own)
+    if '%' in path:
+        path = urllib.quote(urllib.unquote(path), safe="/?=&;:@!$'()*+,~")
+    return path
+
+
+class RobotsRules(object):
+    """Compiled rules of a robots.txt group"""
+
+    def __init__(self, rules=(), crawl_delay=None, sitemaps=(),
+                 unavailable=False):
+        """
+        :param rules: list of ``(path pattern, allowed)`` tuples
+        :param crawl_delay: seconds between requests, or None
+        :param unavailable: the robots.txt couldn't be fetched
+        """
+        self.crawl_delay = crawl_delay
+        self.unavailable = unavailable
+        self.sitemaps = list(sitemaps)
+        self._rules = []  # (length, allowed, prefix, regex or None)
+        for pattern, allowed in rules:
+            if not pattern:
+                continue  # "Disallow:" with no path allows everything
+            pattern = _normalize_path(pattern)
+            regex = None
+            if '*' in pattern or pattern.endswith('$'):
+                anchored = pattern.endswith('$')
+                body = pattern[:-1] if anchored else pattern
+                regex = re.compile(
+                    '.*'.join(re.escape(part) for part in body.split('*')) +
+                    ('$' if anchored else ''))
+                prefix = body.split('*', 1)[0]
+            else:
+                prefix = pattern
+            self._rules.append((len(pattern), allowed, prefix, regex))
+        ## Longest rules first; on ties, "Allow" first
+        self._rules.sort(key=lambda rule: (-rule[0], not rule[1]))
+
+    @classmethod
+    def parse(cls, text, user_agent='simplespider'):
+        """
+        Parse a robots.txt, keeping the rules of the group for
+        ``user_agent`` (or of the ``*`` group, if there's none).
+        """
+        user_agent = user_agent.lower()
+        groups = []  # [agents, rules, crawl_delay]
+        sitemaps = []
+        group = None
+        for line in text.splitlines():
+            line = line.split('#', 1)[0].strip()
+            if ':' not in line:
+                continue
+            field, value = line.split(':', 1)
+            field, value = field.strip().lower(), value.strip()
+            if field == 'sitemap':
+                sitemaps.append(value)
+            elif field == 'user-agent':
+                if group is None or group[1] or group[2] is not None:
+                    group = [[], [], None]
+                    groups.append(group)
+                group[0].append(value.lower())
+            elif group is None:
+                continue  # rules before any user-agent line
+            elif field in ('allow', 'disallow'):
+                group[1].append((value, field == 'allow'))
+            elif field == 'crawl-delay':
+                try:
+                    group[2] = float(value)
+                except ValueError:
+                    pass
+
+        ## Merge the groups for the most specific agent matching ours
+        best, rules, crawl_delay = None, [], None
+        for agents, group_rules, group_delay in groups:
+            for agent in agents:
+                if agent != '*' and agent not in user_agent:
+                    continue
+                specificity = 0 if agent == '*' else len(agent)
+                if best is None or specificity > best:
+                    best, rules, crawl_delay = specificity, [], None
+                if specificity == best:
+                    rules.extend(group_rules)
+                    if group_delay is not None:
+                        crawl_delay = group_delay
+        return cls(rules, crawl_delay, sitemaps)
+
+    @classmethod
+    def allow_all(cls):
+        return cls()
+
+    @classmethod
+    def disallow_all(cls):
+        return cls([('/', False)])
+
+    @classmethod
+    def unavailable_host(cls):
+        """Rules for a host whose robots.txt couldn't be fetched"""
+        return cls([('/', False)], unavailable=True)
+
+    def allowed(self, url):
+        """Whether the rules allow fetching ``url`` (or a path)"""
+        parts = urlparse.urlsplit(url)
+        path = _normalize_path(parts.path or '/')
+        if parts.query:
+            path = path + '?' + parts.query
+        for length, allowed, prefix, regex in self._rules:
+            if not path.startswith(prefix):
+                continue
+            if regex is None or regex.match(path):
+                return allowed
+        return True
+
+
+class RobotsCache(object):
+    """
+    Per-host cache of robots.txt rules.
+    """
+
+    def __init__(self, transport=None, user_agent='simplespider',
+                 ttl=86400.0, error_ttl=600.0, max_hosts=10000,
+                 timeout=(10, 30), concurrency=None, max_crawl_delay=60.0):
+        """
+        :param transport: transport used to fetch the robots.txt
+            files. (Default: the downloader's one, or a new
+            ``RequestsTransport`` if not used by a downloader)
+        :param user_agent: product token used to pick the rules
+        :param ttl: seconds the rules are kept for
+        :param error_ttl: seconds to wait before fetching a
+            robots.txt again, after a server or connection error
+            (meanwhile, the host is unavailable)
+        :param max_hosts: maximum number of hosts kept in memory
+        :param concurrency:
+            :py:class:`~simplespider.hosts.AdaptiveConcurrency` the
+            crawl delays are applied to
+        :param max_crawl_delay: cap for crawl delays, in seconds
+        """
+        self.transport = transport
+        self.user_agent = user_agent
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.max_hosts = max_hosts
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.max_crawl_delay = max_crawl_delay
+        self._cache = OrderedDict()  # origin -> (expires, rules)
+        self._lock = threading.Lock()
+        self.fetches = 0
+
+    def _fetch(self, origin):
+        """Fetch and parse robots.txt, returning ``(rules, ttl)``"""
+        from simplespider.web import default_user_agent
+        if self.transport is None:
+            self.transport = RequestsTransport()
+        self.fetches += 1
+        try:
+            response = self.transport.fetch(
+                origin + '/robots.txt',
+                headers={'User-agent': default_user_agent()},
+                timeout=self.timeout)
+        except self.transport.errors, e:
+            logger.info("Failed fetching %s/robots.txt: %s", origin, e)
+            return RobotsRules.unavailable_host(), self.error_ttl
+        status_code = response['status_code']
+        if status_code >= 500:
+            return RobotsRules.unavailable_host(), self.error_ttl
+        if status_code >= 400:
+            return RobotsRules.allow_all(), self.ttl  # No robots.txt
+        content = response['content']
+        if isinstance(content, str):
+            content = content.decode('utf-8', 'replace')
+        return RobotsRules.parse(content, self.user_agent), self.ttl
+
+    def _origin(self, url):
+        parts = urlparse.urlsplit(url)
+        return '{0}://{1}'.format(parts.scheme, parts.netloc.lower())
+
+    def cached(self, url, now=None):
+        """
+        Return the cached :py:class:`RobotsRules` for the host of
+        ``url``, or None if robots.txt needs to be fetched
+        """
+        origin = self._origin(url)
+        if now is None:
+            now = time.time()
+        with self._lock:
+            cached = self._cache.get(origin)
+            if cached is None or cached[0] <= now:
+                return None
+            ## Move it to the end, as the most recently used
+            del self._cache[origin]
+            self._cache[origin] = cached
+            return cached[1]
+
+    def rules(self, url, now=None):
+        """Return the :py:class:`RobotsRules` for the host of ``url``"""
+        if now is None:
+            now = time.time()
+        rules = self.cached(url, now)
+        if rules is not None:
+            return rules
+
+        parts = urlparse.urlsplit(url)
+        origin = self._origin(url)
+        rules, ttl = self._fetch(origin)
+        with self._lock:
+            self._cache.pop(origin, None)
+            self._cache[origin] = (now + ttl, rules)
+            while len(self._cache) > self.max_hosts:
+                self._cache.popitem(last=False)
+        if self.concurrency is not None and rules.crawl_delay is not None:
+            self.concurrency.set_min_interval(
+                parts.hostname, min(rules.crawl_delay, self.max_crawl_delay))
+        return rules
+
+    def retry_after(self, url, now=None):
+        """
+        Seconds before the robots.txt of the host of ``url`` is
+        fetched again, if it was unavailable; otherwise None.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            cached = self._cache.get(self._origin(url))
+        if cached is None or not cached[1].unavailable:
+            return None
+        return max(0.0, cached[0] - now)
+
+    def allowed(self, url):
+        return self.rules(url).allowed(url)
+
+    def crawl_delay(self, url):
+        return self.rules(url).crawl_delay
+
+    def __len__(self):
+        return len(self._cache)
@@ -0,0 +1,223 @@
+"""
+Seeding crawls from sitemaps
+
+:py:class:`SitemapSeeder` reads sitemaps and sitemap indexes
+(optionally gzipped) with an incremental parser, freeing each entry
+once read, so that memory use doesn't depend on their size. URLs are
+canonicalized, deduplicated in batches and queued in bulk::
+
+    seeder = SitemapSeeder(spider)
+    seeder.seed('http://example.com/sitemap_index.xml')
+    spider.run()
+"""
+
+import logging
+import urllib
+import urlparse
+import zlib
+
+import lxml.etree
+import requests
+
+from simplespider.web import DownloadTask
+
+logger = logging.getLogger(__name__)
+
+_GZIP_MAGIC = '\x1f\x8b'
+
+
+def canonicalize_url(url):
+    """
+    Canonical form of an URL: lowercase scheme and host, no default
+    port, no fragment, and ``/`` for an empty path. Returns None
+    for anything but HTTP(S) URLs.
+    """
+    try:
+        parts = urlparse.urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return None
+    scheme = parts.scheme.lower()
+    if scheme not in ('http', 'https') or not parts.hostname:
+        return None
+    netloc = parts.hostname
+    if ':' in netloc:
+        netloc = '[{0}]'.format(netloc)  # IPv6 address
+    if port is not None and port != {'http': 80, 'https': 443}[scheme]:
+        netloc = '{0}:{1}'.format(netloc, port)
+    if '@' in parts.netloc:
+        netloc = parts.netloc.rsplit('@', 1)[0] + '@' + netloc
+    return urlparse.urlunsplit((scheme, netloc, parts.path or '/',
+                                parts.query, ''))
+
+
+class _Prefixed(object):
+    """File-like object re-reading some already consumed bytes first"""
+
+    def __init__(self, prefix, fp):
+        self.prefix = prefix
+        self.fp = fp
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.fp.read(size)
+        if size is None or size < 0:
+            data, self.prefix = self.prefix + self.fp.read(), ''
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        if len(data) < size:
+            data += self.fp.read(size - len(data))
+        return data
+
+
+class _Gunzip(object):
+    """Decompress a gzip stream as it's read"""
+
+    def __init__(self, fp, chunk_size=64 * 1024):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self._buffer) < size:
+            chunk = self.fp.read(self.chunk_size)
+            if not chunk:
+                self._buffer += self._decompressor.flush()
+                break
+            self._buffer += self._decompressor.decompress(chunk)
+            if self._decompressor.unused_data:
+                ## Concatenated gzip members
+                rest = self._decompressor.unused_data
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                self._buffer += self._decompressor.decompress(rest)
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def open_stream(fp):
+    """Wrap a file-like object, decompressing it if gzipped"""
+    head = fp.read(2)
+    fp = _Prefixed(head, fp)
+    if head == _GZIP_MAGIC:
+        return _Gunzip(fp)
+    return fp
+
+
+def iter_sitemap(fp):
+    """
+    Parse a sitemap or sitemap index, incrementally.
+
+    :return: an iterator of ``(kind, url)`` tuples, where ``kind`` is
+        ``'url'`` for pages, ``'sitemap'`` for nested sitemaps
+    """
+    context = lxml.etree.iterparse(
+        open_stream(fp), events=('end',), tag=('{*}url', '{*}sitemap'),
+        resolve_entities=False, no_network=True, huge_tree=True,
+        recover=True)
+    for event, elem in context:
+        loc = elem.findtext('{*}loc')
+        if loc:
+            yield elem.tag.rsplit('}', 1)[-1], loc.strip()
+        ## Free the parsed entries, so the tree doesn't keep growing
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def open_url(url, timeout=(10, 30)):
+    """Open a sitemap URL (or local path) for streaming"""
+    parts = urlparse.urlsplit(url)
+    if parts.scheme in ('', 'file'):
+        return open(urllib.url2pathname(parts.path) if parts.scheme
+                    else url, 'rb')
+    from simplespider.web import default_user_agent
+    response = requests.get(url, stream=True, timeout=timeout,
+                            headers={'User-agent': default_user_agent()})
+    response.raise_for_status()
+    response.raw.decode_content = True  # transfer encoding only
+    return response.raw
+
+
+class SitemapSeeder(object):
+    def __init__(self, spider, batch_size=1000, max_depth=3, opener=None,
+                 url_filter=None, make_task=None):
+        """
+        :param spider: the spider tasks are queued to
+        :param batch_size: number of URLs deduplicated and queued
+            at once
+        :param max_depth: maximum nesting of sitemap indexes
+        :param opener: callable returning a file-like object for a
+            sitemap URL. (Default: :py:func:`open_url`)
+        :param url_filter: callable telling whether a (canonical)
+            URL should be queued. (Default: None, all of them)
+        :param make_task: callable building the task for an URL.
+            (Default: a ``DownloadTask``)
+        """
+        self.spider = spider
+        self.batch_size = batch_size
+        self.max_depth = max_depth
+        self.opener = opener or open_url
+        self.url_filter = url_filter
+        self.make_task = make_task or (lambda url: DownloadTask(url=url))
+        self.stats = {'sitemaps': 0, 'urls': 0, 'queued': 0, 'errors': 0}
+
+    def _flush(self, batch):
+        if batch:
+            self.spider.queue_tasks(self.make_task(url) for url in batch)
+            self.stats['queued'] += len(batch)
+
+    def seed(self, *sitemap_urls):
+        """
+        Queue the URLs listed in the given sitemaps, following
+        sitemap indexes.
+
+        :return: a dict of statistics
+        """
+        pending = [(url, 0) for url in reversed(sitemap_urls)]
+        seen_sitemaps = set()
+        batch = set()
+        while pending:
+            sitemap_url, depth = pending.pop()
+            if sitemap_url in seen_sitemaps:
+                continue
+            seen_sitemaps.add(sitemap_url)
+            children = []
+            try:
+                fp = self.opener(sitemap_url)
+                try:
+                    for kind, url in iter_sitemap(fp):
+                        if kind == 'sitemap':
+                            child = urlparse.urljoin(sitemap_url, url)
+                            children.append((child, depth + 1))
+                            continue
+                        self.stats['urls'] += 1
+                        url = canonicalize_url(url)
+                        if url is None or (self.url_filter is not None and
+                                           not self.url_filter(url)):
+                            continue
+                        batch.add(url)
+                        if len(batch) >= self.batch_size:
+                            self._flush(batch)
+                            batch = set()
+                finally:
+                    close = getattr(fp, 'close', None)
+                    if close is not None:
+                        close()
+            except (IOError, OSError, requests.RequestException,
+                    lxml.etree.LxmlError), e:
+                logger.warning("Failed reading sitemap %s: %s",
+                               sitemap_url, e)
+                self.stats['errors'] += 1
+                continue
+            self.stats['sitemaps'] += 1
+            if depth >= self.max_depth and children:
+                logger.warning("Not following %d sitemaps from %s: too deep",
+                               len(children), sitemap_url)
+                continue
+            pending.extend(reversed(children))
+        self._flush(batch)
+        self.spider.flush()
+        return dict(self.stats)
@@ -6,12 +6,12 @@ import six
 from simplespider import ListQueueManager
 
 
-@pytest.fixture(params=['list', 'kombu_simple'])
+@pytest.fixture(params=['list', 'kombu_simple', 'kombu_batched'])
 def queue(request):
     if request.param == 'list':
         return ListQueueManager()
 
-    if request.param == 'kombu_simple':
+    if request.param in ('kombu_simple', 'kombu_batched'):
         KOMBU_URL = os.environ.get('KOMBU_URL')
 
         if not KOMBU_URL:
@@ -21,7 +21,12 @@ def queue(request):
             pytest.xfail("We have some problem with serializing tasks "
                          "on Python 3")
 
-        from simplespider.queues.kombu import KombuQueueSimple
+        from simplespider.queues.kombu import KombuQueueSimple, \
+            KombuQueueBatched
         ## todo: retrieve connection url from environment, skip
         ## if not available..
+        if request.param == 'kombu_batched':
+            return KombuQueueBatched(
+                connection=KOMBU_URL,
+                queue_name='simplespider_tasks_batched')
         return KombuQueueSimple(connection=KOMBU_URL)
@@ -0,0 +1,109 @@
+"""
+Tests for the offline benchmark suite
+"""
+
+import json
+import os
+
+import requests
+
+from simplespider.benchmarks import crawl
+from simplespider.benchmarks.crawl import run_crawl, run_suite
+from simplespider.benchmarks.site import SyntheticSite, serve_site
+
+
+def test_synthetic_site():
+    site = SyntheticSite(pages=100, fanout=3, page_size=1000,
+                         error_rate=0.2, seed=42)
+    assert site.links(0) == [1, 2, 3]
+    assert site.links(40) == [21, 22, 23]  # wraps around
+
+    status, content_type, body = site.get('/page/7')
+    assert status == 200
+    assert content_type.startswith('text/html')
+    assert len(body) >= 1000
+    assert '<a href="/page/22">' in body
+    assert site.get('/page/7') == (status, content_type, body)
+    assert SyntheticSite(seed=1).render(7) != \
+        SyntheticSite(seed=2).render(7)
+
+    errors = [i for i in xrange(100) if site.get('/page/{0}'.format(i))[0]
+              == 500]
+    assert 5 < len(errors) < 40
+    assert errors == [i for i in xrange(100) if site.is_error(i)]
+
+    assert site.get('/page/100')[0] == 404
+    assert site.get('/other')[0] == 404
+
+
+def test_serve_site():
+    server = serve_site(SyntheticSite(pages=10, fanout=2))
+    try:
+        response = requests.get(server.url)
+        assert response.status_code == 200
+        assert '<a href="/page/1">' in response.text
+        assert requests.get(server.url + 'x').status_code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_run_crawl():
+    site = SyntheticSite(pages=30, fanout=3, page_size=500, error_rate=0.1)
+    server = serve_site(site)
+    try:
+        result = run_crawl(server.url, queue='list', storage='dict')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert result['pages'] == 30
+    assert result['server_errors'] == sum(
+        1 for i in xrange(30) if site.is_error(i))
+    assert result['fetch_errors'] == 0
+    assert result['tasks'] == 30 * 3  # download + scrape + store
+    assert result['pages_per_second'] > 0
+    latency, = result['fetch_latency'].values()
+    assert latency['count'] == 30
+    assert latency['p50'] <= latency['p99']
+    assert result['peak_rss_kb'] > 0
+
+
+def test_run_suite():
+    report = run_suite(SyntheticSite(pages=20, fanout=2),
+                       queues=['list'], storages=['dict', 'anydbm'])
+    report = json.loads(json.dumps(report))
+    assert report['site']['pages'] == 20
+    assert [(r['queue'], r['storage']) for r in report['results']] == \
+        [('list', 'dict'), ('list', 'anydbm')]
+    for result in report['results']:
+        assert result['pages'] == 20
+
+
+def test_run_suite_child_dies(monkeypatch):
+    monkeypatch.setattr(crawl, 'run_crawl', lambda *args: os._exit(3))
+    report = run_suite(SyntheticSite(pages=20, fanout=2),
+                       queues=['list'], storages=['dict'])
+    result, = report['results']
+    assert result['error'] == 'Crawl process died (exit code 3)'
+    assert (result['queue'], result['storage']) == ('list', 'dict')
+
+
+def test_run_suite_transports():
+    report = run_suite(SyntheticSite(pages=20, fanout=2, error_rate=0.1),
+                       queues=['list'], storages=['dict'], isolate=False,
+                       transports=['urllib3', 'dict'])
+    urllib3_result, dict_result = report['results']
+    assert (urllib3_result['transport'], dict_result['transport']) == \
+        ('urllib3', 'dict')
+    assert urllib3_result['pages'] == dict_result['pages'] == 20
+    assert urllib3_result['server_errors'] == dict_result['server_errors']
+
+
+def test_run_crawl_fused():
+    site = SyntheticSite(pages=30, fanout=3, page_size=500)
+    url = 'http://example.com/page/0'
+    plain = run_crawl(url, transport='dict', site=site)
+    fused = run_crawl(url, transport='dict', site=site, fuse=True)
+    assert fused['pages'] == plain['pages'] == 30
+    assert fused['tasks'] == plain['tasks'] == 90
@@ -2,10 +2,12 @@
 Tests for the main Spider object
 """
 
+import time
+
 import pytest
 
 from simplespider import Spider, BaseTask, BaseTaskRunner, \
-    AbortTask, SkipRunner, RetryTask
+    AbortTask, SkipRunner, RetryTask, DeferTask, ListQueueManager
 
 
 class MyTask(BaseTask):
@@ -58,7 +60,7 @@ def spider():
         2: MyOtherTaskRunner(),
     }
 
-    spider = Spider()
+    spider = Spider(retry_delay=0)
     spider.add_runners(x[1] for x in sorted(runners.iteritems()))
     # spider.execution_log = tasks_execution_log
 
@@ -114,20 +116,410 @@ def test_task_dispatching(spider):
     assert execution_log.pop(0) == (runners[0], 'task-5')
     assert execution_log.pop(0) == (runners[1], 'task-5')
 
+    ## Retries keep the same id, and are run as soon
+    ## as they're due (ie. immediately, here)
+    assert execution_log.pop(0) == (runners[0], 'task-6')
     assert execution_log.pop(0) == (runners[0], 'task-6')
+    assert execution_log.pop(0) == (runners[0], 'task-6')
+    assert execution_log.pop(0) == (runners[0], 'task-7')
+    assert execution_log.pop(0) == (runners[0], 'task-7')
     assert execution_log.pop(0) == (runners[0], 'task-7')
 
     assert execution_log.pop(0) == (runners[2], 'was:task-1')
     assert execution_log.pop(0) == (runners[2], 'was:task-5')
 
-    assert execution_log.pop(0) == (runners[0], 'task-6[R]')
-    assert execution_log.pop(0) == (runners[0], 'task-7[R]')
-    assert execution_log.pop(0) == (runners[0], 'task-6[R][R]')
-    assert execution_log.pop(0) == (runners[0], 'task-7[R][R]')
-
     assert len(execution_log) == 0  # we popped 'em all
 
     with pytest.raises(TypeError):
         spider.run_task('this is not a task')
     with pytest.raises(TypeError):
         spider.queue_task('this is not a task')
+
+
+def test_retry_backoff(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr('time.time', lambda: clock[0])
+    monkeypatch.setattr('time.sleep', lambda t: clock.__setitem__(
+        0, clock[0] + t))
+
+    execution_log = []
+
+    class FailingRunner(BaseTaskRunner):
+        def __call__(self, task):
+            execution_log.append((task.id, clock[0], task.get('retries')))
+            if task.get('retry_after') is not None:
+                raise RetryTask(retry_after=task['retry_after'])
+            raise RetryTask()
+
+    spider = Spider(retry_delay=10, retry_backoff=2, retry_jitter=0)
+    spider.add_runners([FailingRunner()])
+    spider.queue_task(MyTask('task-1', retry=3))
+    spider.queue_task(MyTask('task-2', retry=1, retry_after=5))
+    spider.run()
+
+    assert execution_log == [
+        ('task-1', 1000.0, None),
+        ('task-2', 1000.0, None),
+        ('task-2', 1005.0, 1),
+        ('task-1', 1010.0, 1),
+        ('task-1', 1030.0, 2),
+        ('task-1', 1070.0, 3),
+    ]
+
+
+def test_defer_task(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr('time.time', lambda: clock[0])
+    monkeypatch.setattr('time.sleep', lambda t: clock.__setitem__(
+        0, clock[0] + t))
+
+    execution_log = []
+
+    class DeferringRunner(BaseTaskRunner):
+        def __call__(self, task):
+            execution_log.append((task.id, clock[0]))
+            if len(execution_log) < 4:
+                raise DeferTask(retry_after=60)
+            return iter([])
+
+    spider = Spider()
+    spider.add_runners([DeferringRunner()])
+    spider.queue_task(MyTask('task-1', retry=0))
+    spider.run()
+
+    ## Deferring doesn't use up retries
+    assert execution_log == [
+        ('task-1', 1000.0),
+        ('task-1', 1060.0),
+        ('task-1', 1120.0),
+        ('task-1', 1180.0),
+    ]
+
+
+class _BulkQueue(ListQueueManager):
+    def __init__(self, **kwargs):
+        super(_BulkQueue, self).__init__(**kwargs)
+        self.batches = []
+
+    def push(self, name, task):
+        raise AssertionError("Tasks should be pushed in bulk")
+
+    def push_many(self, items):
+        items = list(items)
+        self.batches.append(len(items))
+        super(_BulkQueue, self).push_many(items)
+
+
+def test_queue_tasks():
+    queue = _BulkQueue()
+    spider = Spider(queue=queue)
+    spider.queue_tasks([MyTask('task-1'), MyTask('task-2'),
+                        MyTask('task-1'), MyOtherTask('task-3')])
+    spider.queue_tasks([])
+    spider.queue_tasks([MyTask('task-2')])  # deduplicated by the queue
+    assert queue.batches == [3, 1]
+    assert [name for name, task in spider.yield_tasks()] == \
+        ['task-1', 'task-2', 'task-3']
+
+    queued = spider.metrics.get('simplespider_tasks_queued_total')
+    assert queued.get((MyTask('x').type,)) == 3
+    assert queued.get((MyOtherTask('x').type,)) == 1
+
+    with pytest.raises(TypeError):
+        spider.queue_tasks([MyTask('task-4'), {'not': 'a task'}])
+
+
+class _FanOutRunner(BaseTaskRunner):
+    def __call__(self, task):
+        if task.get('fail'):
+            yield MyOtherTask('before-failure')
+            raise AbortTask()
+        for i in xrange(25):
+            yield MyOtherTask('child-{0}'.format(i % 20))
+        yield 'not a task'
+
+
+def test_runner_tasks_queued_in_bulk():
+    queue = _BulkQueue()
+    spider = Spider(queue=queue, queue_batch_size=10)
+    spider.add_runners([_FanOutRunner()])
+    spider._wrap_task_execution(spider._runners[0], MyTask('parent'))
+    assert queue.batches == [10, 10, 5]
+    assert len(queue) == 20
+
+    ## Tasks yielded before a failure are queued anyway
+    with pytest.raises(AbortTask):
+        spider._wrap_task_execution(spider._runners[0],
+                                    MyTask('failing', fail=True))
+    assert queue.batches[-1] == 1
+
+
+class _ResultsRunner(BaseTaskRunner):
+    produced = 0
+
+    def __call__(self, task):
+        for i in xrange(task['count']):
+            _ResultsRunner.produced += 1
+            yield {'task': task.id, 'n': i}
+        if task['count'] > 1:
+            yield MyTask('more-' + task.id, count=task['count'] // 2)
+
+
+def _results_spider(**kwargs):
+    _ResultsRunner.produced = 0
+    spider = Spider(**kwargs)
+    spider.add_runners([_ResultsRunner()])
+    spider.queue_task(MyTask('root', count=8))
+    return spider
+
+
+def test_iter_results():
+    spider = _results_spider()
+    results = list(spider.iter_results())
+    assert len(results) == 8 + 4 + 2 + 1
+    assert results[:2] == [{'task': 'root', 'n': 0}, {'task': 'root', 'n': 1}]
+    assert spider.metrics.get('simplespider_results_total').total() == 15
+    assert spider._results is None
+
+
+def test_iter_results_backpressure():
+    spider = _results_spider()
+    results = spider.iter_results(buffer_size=2)
+    for consumed in xrange(1, 6):
+        next(results)
+        time.sleep(.05)  # let the crawl thread run
+        ## One more object is waiting to be put in the buffer
+        assert _ResultsRunner.produced <= consumed + 2 + 1
+
+    ## Stopping early stops the crawl too
+    results.close()
+    assert spider._results is None
+    assert _ResultsRunner.produced <= 8 + 4
+
+
+def test_run_after_iter_results_close():
+    spider = _results_spider()
+    results = spider.iter_results(buffer_size=1)
+    next(results)
+    results.close()
+
+    ## The spider can still be run to completion
+    left = len(spider._task_queue)
+    assert left > 0
+    executed = _ResultsRunner.produced
+    spider.run()
+    assert len(spider._task_queue) == 0
+    assert _ResultsRunner.produced > executed
+
+
+class _TrackingQueue(ListQueueManager):
+    """Keep track of the tasks popped, but not marked as done"""
+
+    def __init__(self, *args, **kwargs):
+        super(_TrackingQueue, self).__init__(*args, **kwargs)
+        self.pending = set()
+
+    def pop(self):
+        name, task = super(_TrackingQueue, self).pop()
+        self.pending.add(name)
+        return name, task
+
+    def task_done(self, name):
+        self.pending.remove(name)
+
+
+def test_iter_results_close_marks_task_done():
+    queue = _TrackingQueue()
+    spider = _results_spider(queue=queue)
+    results = spider.iter_results(buffer_size=1)
+    next(results)
+    results.close()
+    assert queue.pending == set()
+
+
+def test_retried_task_done_after_last_run():
+    queue = _TrackingQueue()
+    pending = []
+
+    class FlakyRunner(BaseTaskRunner):
+        def __call__(self, task):
+            pending.append(sorted(queue.pending))
+            if task.id == 'flaky' and task.get('retries', 0) < 2:
+                raise RetryTask(retry_after=0.01)
+            return iter([])
+
+    spider = Spider(queue=queue)
+    spider.add_runners([FlakyRunner()])
+    spider.queue_task(MyTask('flaky'))
+    spider.queue_task(MyTask('other'))
+    spider.run()
+
+    ## Not marked as done while waiting to be retried, so that
+    ## durable queues deliver it again if the process dies
+    assert pending == [['flaky'], ['flaky', 'other'], ['flaky'], ['flaky']]
+    assert queue.pending == set()
+
+
+def test_budget_stop_marks_task_done():
+    from simplespider.budget import CrawlBudget
+    queue = _TrackingQueue()
+    budget = CrawlBudget(max_tasks=2)
+    spider = _results_spider(queue=queue, budget=budget)
+    spider.run()
+    assert budget.tasks == 2
+    assert len(queue) == 1  # more-more-root is left
+    assert queue.pending == set()
+
+
+class _BrokenQueue(ListQueueManager):
+    def pop(self):
+        raise ValueError("Broken queue")
+
+
+def test_iter_results_error():
+    spider = _results_spider(queue=_BrokenQueue())
+    with pytest.raises(ValueError):
+        list(spider.iter_results())
+
+
+def test_fused_tasks():
+    execution_log = []
+
+    class ParentRunner(BaseTaskRunner):
+        def match(self, task):
+            return isinstance(task, MyTask)
+
+        def __call__(self, task):
+            execution_log.append(task.id)
+            for child_id in task['children']:
+                yield MyOtherTask(child_id, retryme=(child_id == 'flaky'))
+            execution_log.append(task.id + ' done')
+
+    class ChildRunner(BaseTaskRunner):
+        def match(self, task):
+            return isinstance(task, MyOtherTask)
+
+        def __call__(self, task):
+            execution_log.append(task.id)
+            if task['retryme'] and not task.get('retries'):
+                raise RetryTask()
+            return iter([])
+
+    spider = Spider(retry_delay=0, fuse=[MyOtherTask, MyTask])
+    spider.add_runners([ParentRunner(), ChildRunner()])
+    spider.queue_task(MyTask('parent-1', children=['a', 'b', 'flaky']))
+    spider.queue_task(MyTask('parent-2', children=['b', 'c']))
+    spider.run()
+
+    ## Children are run depth-first, deduplicated, and retried
+    ## through the scheduler if they fail
+    assert execution_log == [
+        'parent-1', 'a', 'b', 'flaky', 'parent-1 done',
+        'flaky',
+        'parent-2', 'c', 'parent-2 done',
+    ]
+    fused = spider.metrics.get('simplespider_tasks_fused_total')
+    assert fused.get((MyOtherTask('x').type,)) == 4
+    assert fused.get((MyTask('x').type,)) == 0
+
+
+def test_fused_tasks_unmatched():
+    class Runner(BaseTaskRunner):
+        def match(self, task):
+            return isinstance(task, MyTask)
+
+        def __call__(self, task):
+            yield MyOtherTask('child')
+
+    spider = Spider(fuse=lambda task: True)
+    spider.add_runners([Runner()])
+    spider.queue_task(MyTask('parent'))
+    name, task = next(spider.yield_tasks())
+    spider.run_task(task)
+
+    ## Nobody here runs MyOtherTask: queue it for someone else
+    assert len(spider._task_queue) == 1
+
+
+class _TreeRunner(BaseTaskRunner):
+    """Each task yields ``fanout`` children, up to ``size`` tasks"""
+
+    def __init__(self, size, fanout, **kwargs):
+        super(_TreeRunner, self).__init__(**kwargs)
+        self.size = size
+        self.fanout = fanout
+        self.executed = []
+        self.max_queued = 0
+
+    def __call__(self, task):
+        self.executed.append(task.id)
+        self.max_queued = max(self.max_queued, len(self.spider._task_queue))
+        n = int(task.id)
+        for child in xrange(n * self.fanout + 1, n * self.fanout + 1 +
+                            self.fanout):
+            if child < self.size:
+                yield MyTask(str(child))
+
+
+def test_bounded_frontier(tmpdir):
+    spider = Spider(frontier_high_water=50, frontier_low_water=10,
+                    frontier_check_every=1,
+                    frontier_spill_dir=str(tmpdir))
+    runner = _TreeRunner(2000, 10)
+    runner.spider = spider
+    spider.add_runners([runner])
+    spider.queue_task(MyTask('0'))
+    spider.run()
+
+    assert sorted(runner.executed, key=int) == \
+        [str(i) for i in xrange(2000)]
+    ## One task can go over the mark by its fan-out at most
+    assert runner.max_queued <= 50 + 10
+    assert len(spider._spilled) == 0
+
+
+def test_bounded_frontier_spills_new_tasks_only(tmpdir):
+    ## Every page links to the same 100 pages
+    class Runner(BaseTaskRunner):
+        def __call__(self, task):
+            executed.append(task.id)
+            peak.append(len(spider._spilled))
+            for i in xrange(100):
+                yield MyTask(str(i))
+
+    executed = []
+    peak = [0]
+    spider = Spider(frontier_high_water=5, frontier_low_water=1,
+                    frontier_check_every=1,
+                    frontier_spill_dir=str(tmpdir))
+    spider.add_runners([Runner()])
+    spider.queue_task(MyTask('0'))
+    spider.run()
+
+    assert sorted(executed, key=int) == [str(i) for i in xrange(100)]
+    assert max(peak) < 100
+    assert len(spider._spilled) == 0
+    assert spider._spilled_names == set()
+
+
+def test_bounded_frontier_pause(tmpdir):
+    class Runner(BaseTaskRunner):
+        def __call__(self, task):
+            executed.append(task.id)
+            if isinstance(task, MyTask) and task.id.count('.') < 3:
+                for i in xrange(4):
+                    yield MyTask('{0}.{1}'.format(task.id, i))
+                    yield MyOtherTask('{0}.{1}.other'.format(task.id, i))
+
+    executed = []
+    spider = Spider(frontier_high_water=10, frontier_low_water=2,
+                    frontier_check_every=1, frontier_pause=[MyTask],
+                    frontier_spill_dir=str(tmpdir))
+    spider.add_runners([Runner()])
+    spider.queue_task(MyTask('0'))
+    spider.run()
+
+    ## Tasks are all run once, but the "fan-out" ones are put
+    ## off while there are too many tasks around
+    assert len(executed) == len(set(executed)) == 85 + 84
+    assert executed.index('0.0.0') > executed.index('0.3')
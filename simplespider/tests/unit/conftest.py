@@ -0,0 +1,44 @@
+import pytest
+import requests
+
+## Skip the tests of the optional backends whose
+## dependencies are missing
+collect_ignore = []
+
+try:
+    import kombu  # noqa
+except ImportError:  # pragma: no cover
+    collect_ignore.append('test_kombu_queue.py')
+
+
+class FakeResponse(object):
+    def __init__(self, url, status_code=200, content='<html></html>'):
+        self.url = url
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.reason = 'OK' if self.ok else 'Error'
+        self.content = content
+        self.encoding = 'utf-8'
+        self.headers = {'content-type': 'text/html'}
+
+
+@pytest.fixture
+def fake_get(monkeypatch):
+    """Replace ``requests.get``, recording the calls"""
+    calls = []
+    failing = set()
+
+    def get(url, **kwargs):
+        calls.append((url, kwargs))
+        if url in failing:
+            raise requests.ConnectionError("Connection refused")
+        if '/loop' in url:
+            raise requests.TooManyRedirects("Exceeded 30 redirects")
+        if '/error' in url:
+            return FakeResponse(url, status_code=503)
+        return FakeResponse(url)
+
+    get.calls = calls
+    get.failing = failing
+    monkeypatch.setattr(requests, 'get', get)
+    return get
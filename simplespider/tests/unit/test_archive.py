@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import zlib
+
+import pytest
+
+from simplespider import AbortTask
+from simplespider.archive import HttpArchive, parse_response, \
+    serialize_response
+from simplespider.web import Downloader, DownloadTask, HttpResponse
+
+
+def _response(url, content='<html>hello</html>', **kwargs):
+    kwargs.setdefault('headers', {'content-type': 'text/html'})
+    return HttpResponse(url=url, content=content, status_code=200,
+                        reason='OK', encoding='utf-8', **kwargs)
+
+
+def test_serialize_response():
+    response = _response(u'http://example.com/b\xe8',
+                         content='\x00\r\n\r\nbinary\xff')
+    record = serialize_response('http://example.com/a', response)
+    assert record.startswith('WARC/1.0\r\nWARC-Type: response\r\n')
+    url, parsed = parse_response(record)
+    assert url == 'http://example.com/a'
+    assert parsed == response
+
+    response = HttpResponse(url='http://example.com/x', status_code=404,
+                            reason='Not Found', ok=False)
+    url, parsed = parse_response(
+        serialize_response('http://example.com/x', response))
+    assert parsed == response
+
+
+def test_http_archive(tmpdir):
+    path = str(tmpdir.join('crawl.warc.gz'))
+    archive = HttpArchive(path, 'a')
+    for i in xrange(10):
+        url = 'http://example.com/{0}'.format(i)
+        archive.record(url, _response(url, content='page {0}'.format(i)))
+    assert archive.get('http://example.com/3')['content'] == 'page 3'
+    archive.record('http://example.com/3', _response(
+        'http://example.com/3', content='page 3, again'))
+    archive.close()
+
+    archive = HttpArchive(path)
+    assert len(archive) == 10
+    assert list(archive)[:3] == ['http://example.com/0',
+                                 'http://example.com/1',
+                                 'http://example.com/2']
+    assert 'http://example.com/9' in archive
+    assert archive.get('http://example.com/9')['content'] == 'page 9'
+    assert archive.get('http://example.com/3')['content'] == 'page 3, again'
+    assert archive.get('http://example.com/10') is None
+    with pytest.raises(IOError):
+        archive.record('http://example.com/', _response('x'))
+    archive.close()
+
+
+def test_http_archive_rebuild_index(tmpdir):
+    path = str(tmpdir.join('crawl.warc.gz'))
+    archive = HttpArchive(path, 'a')
+    for i in xrange(5):
+        url = 'http://example.com/{0}'.format(i)
+        archive.record(url, _response(url, content='x' * i * 1000))
+    archive.close()
+
+    ## Lose the last entries of the index, and half of the last record
+    lines = tmpdir.join('crawl.warc.gz.idx').readlines()
+    tmpdir.join('crawl.warc.gz.idx').write(''.join(lines[:2]))
+    data = tmpdir.join('crawl.warc.gz').read('rb')
+    tmpdir.join('crawl.warc.gz').write(data[:-50], 'wb')
+
+    archive = HttpArchive(path, 'a')
+    assert list(archive) == ['http://example.com/{0}'.format(i)
+                             for i in xrange(4)]
+    assert archive.get('http://example.com/3')['content'] == 'x' * 3000
+    archive.close()
+
+    ## Scan with small reads too
+    archive = HttpArchive(path)
+    assert [url for offset, length, url in archive._scan(0, 64)] == \
+        ['http://example.com/{0}'.format(i) for i in xrange(4)]
+    archive.close()
+
+
+def test_downloader_record_replay(tmpdir, fake_get):
+    path = str(tmpdir.join('crawl.warc.gz'))
+    archive = HttpArchive(path, 'a')
+    downloader = Downloader(archive=archive)
+    recorded = [list(downloader(DownloadTask(url=url)))[0]['response']
+                for url in ('http://example.com/', 'http://example.com/a')]
+    archive.close()
+    assert len(fake_get.calls) == 2
+
+    downloader = Downloader(replay=HttpArchive(path))
+    task, = downloader(DownloadTask(url='http://example.com/a'))
+    assert task['response'] == recorded[1]
+    assert task['url'] == 'http://example.com/a'
+    with pytest.raises(AbortTask):
+        list(downloader(DownloadTask(url='http://example.com/b')))
+    assert len(fake_get.calls) == 2  # no requests made
+
+
+def test_http_archive_truncated_headers(tmpdir):
+    path = str(tmpdir.join('crawl.warc.gz'))
+    archive = HttpArchive(path, 'a')
+    archive.record('http://example.com/', _response('http://example.com/'))
+    archive.close()
+
+    ## Keep only the WARC headers of the record
+    record = zlib.decompress(tmpdir.join('crawl.warc.gz').read('rb'),
+                             16 + zlib.MAX_WBITS)
+    head = record.partition('\r\n\r\n')[0] + '\r\n\r\n'
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    tmpdir.join('crawl.warc.gz').write(
+        compressor.compress(head) + compressor.flush(), 'wb')
+    tmpdir.join('crawl.warc.gz.idx').remove()
+
+    archive = HttpArchive(path)
+    assert list(archive) == []
+    archive.close()
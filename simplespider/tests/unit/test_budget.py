@@ -0,0 +1,138 @@
+from simplespider import BaseTask, BaseTaskRunner, DeferTask, \
+    ListQueueManager, Spider
+from simplespider.budget import CrawlBudget
+from simplespider.metrics import Registry
+from simplespider.transports import DictTransport
+from simplespider.web import Downloader, DownloadTask, LinkExtractor
+
+
+def calendar_site():
+    """A small site, plus a host with infinitely many pages"""
+    pages = {
+        'http://example.com/': '<a href="http://example.com/a">a</a>'
+                               '<a href="http://calendar.com/day/0">0</a>',
+        'http://example.com/a': 'A' * 1000,
+    }
+    for day in xrange(1000):
+        pages['http://calendar.com/day/{0}'.format(day)] = \
+            '<a href="http://calendar.com/day/{0}">next</a>'.format(day + 1)
+    return DictTransport(pages)
+
+
+def crawl(budget, registry=None):
+    spider = Spider(queue=ListQueueManager(), budget=budget,
+                    metrics=registry)
+    spider.add_runners([
+        Downloader(transport=calendar_site(), budget=budget,
+                   circuit_breaker=None),
+        LinkExtractor(),
+    ])
+    spider.queue_task(DownloadTask(url='http://example.com/'))
+    spider.run()
+    return spider
+
+
+def test_pages_per_host():
+    registry = Registry()
+    budget = CrawlBudget(max_pages_per_host=5, metrics=registry)
+    spider = crawl(budget, registry)
+
+    assert budget.pages('example.com') == 2
+    assert budget.pages('calendar.com') == 5
+    assert budget.exhausted_hosts() == ['calendar.com']
+    assert budget.rejected == {'max_pages_per_host': 1}
+    assert len(spider._task_queue) == 0
+    tasks = registry.get('simplespider_tasks_total')
+    assert tasks.get((DownloadTask(url='x').type, 'over_budget')) == 1
+    assert registry.get('simplespider_budget_rejected_total').get(
+        ('max_pages_per_host',)) == 1
+    assert registry.get('simplespider_budget_hosts_exhausted').get() == 1
+
+    stats = budget.stats()
+    assert stats['hosts']['calendar.com']['pages'] == 5
+    assert stats['seconds_left'] is None
+
+
+def test_bytes_per_host():
+    budget = CrawlBudget(max_bytes_per_host=60)
+    crawl(budget)
+    ## The pages crossing the limit are kept
+    assert budget.pages('example.com') == 1
+    assert budget.bytes('example.com') > 60
+    assert budget.pages('calendar.com') == 2
+    assert budget.rejected == {'max_bytes_per_host': 2}
+
+
+def test_max_tasks():
+    budget = CrawlBudget(max_tasks=10)
+    spider = crawl(budget)
+    assert budget.tasks == 10
+    assert budget.exhausted() == 'max_tasks'
+    ## The other tasks are left in the queue
+    assert len(spider._task_queue) > 0
+
+
+def test_max_seconds():
+    budget = CrawlBudget(max_seconds=60)
+    assert budget.exhausted() is None
+    assert budget.seconds_left() is None  # not started
+
+    budget.start(now=1000)
+    budget.start(now=2000)  # already running
+    assert budget.seconds_left(now=1030) == 30
+    assert budget.exhausted(now=1030) is None
+    assert budget.exhausted(now=1060) == 'max_seconds'
+    assert budget.admit(DownloadTask(url='http://example.com/'),
+                        now=1070) == 'max_seconds'
+    assert budget.tasks == 0
+
+    ## Past the deadline, the spider doesn't even start
+    budget = CrawlBudget(max_seconds=0)
+    spider = crawl(budget)
+    assert budget.tasks == 0
+    assert len(spider._task_queue) == 1
+
+
+def test_fused_tasks_are_checked():
+    class Runner(BaseTaskRunner):
+        def match(self, task):
+            return True
+
+        def __call__(self, task):
+            for i in xrange(5):
+                yield BaseTask('{0}.{1}'.format(task.id, i))
+
+    budget = CrawlBudget(max_tasks=3)
+    spider = Spider(budget=budget, fuse=BaseTask, fuse_max_depth=1)
+    spider.add_runners([Runner()])
+    spider.queue_task(BaseTask('root'))
+    spider.run()
+    assert budget.tasks == 3
+    assert budget.rejected == {'max_tasks': 3}
+
+
+def test_deferred_tasks_are_not_counted():
+    class Runner(BaseTaskRunner):
+        def __init__(self):
+            self.runs = []
+
+        def match(self, task):
+            return True
+
+        def __call__(self, task):
+            self.runs.append(task.id)
+            ## Deferred twice (eg. the host is busy), then run
+            if self.runs.count(task.id) < 3:
+                raise DeferTask(retry_after=0)
+            return []
+
+    budget = CrawlBudget(max_tasks=2)
+    runner = Runner()
+    spider = Spider(queue=ListQueueManager(), budget=budget)
+    spider.add_runners([runner])
+    spider.queue_task(BaseTask('a'))
+    spider.queue_task(BaseTask('b'))
+    spider.run()
+    assert sorted(runner.runs) == ['a'] * 3 + ['b'] * 3
+    assert budget.tasks == 2
+    assert budget.rejected == {}
@@ -0,0 +1,109 @@
+import random
+
+import pytest
+
+from simplespider import ListQueueManager, Spider
+from simplespider.dedup import NearDuplicateFilter, SimHashIndex, \
+    hamming_distance, page_tokens, simhash
+from simplespider.metrics import Registry
+from simplespider.storage import DictStorage
+from simplespider.transports import DictTransport
+from simplespider.web import Downloader, DownloadTask, HttpResponse, \
+    LinkExtractor, ScrapingTask
+
+
+def _text(seed, words=300):
+    rnd = random.Random(seed)
+    return ' '.join('word{0}'.format(rnd.randint(0, 5000))
+                    for _ in xrange(words))
+
+
+def _page(text, extra=''):
+    return ('<html><head><style>body {{ color: red }}</style></head>'
+            '<body>{0}<p>{1}</p></body></html>').format(extra, text)
+
+
+def test_page_tokens():
+    response = HttpResponse(
+        content='<p>Hello <b>W\xc3\xb6rld</b>&amp;co</p>'
+        '<script>var x = 1;</script>', encoding='utf-8')
+    assert page_tokens(response) == [u'hello', u'w\xf6rld', u'co']
+
+
+def test_simhash():
+    text = _text(1)
+    fingerprint, shingles = simhash(text.split())
+    assert shingles == 298
+    assert simhash(text.split())[0] == fingerprint
+
+    ## A small change moves the fingerprint only a little
+    changed = text.split()
+    changed[100] = 'something'
+    assert hamming_distance(simhash(changed)[0], fingerprint) <= 3
+
+    assert hamming_distance(simhash(_text(2).split())[0], fingerprint) > 10
+    assert simhash([]) == (0, 0)
+
+
+def test_simhash_index():
+    index = SimHashIndex(max_distance=3)
+    assert [mask for shift, mask in index._bands] == [0xffff] * 4
+    index.add(0, 'zero')
+    index.add(0b1011 << 40, 'far')
+    assert index.find(0) == ('zero', 0)
+    assert index.find(0b111 << 60) == ('zero', 3)
+    assert index.find((0b111 << 60) | 1) is None
+    assert index.find(0b1001 << 40) == ('far', 1)
+    assert len(index) == 2
+
+    with pytest.raises(ValueError):
+        SimHashIndex(bits=8, max_distance=8)
+
+
+def test_near_duplicate_filter():
+    text = _text(1)
+    pages = {
+        'http://example.com/': _page(text, '<a href="/a">a</a>'),
+        ## Same content, different URL and a slightly different page
+        'http://example.com/?session=1': _page(
+            text, '<a href="/b">b</a> Printed'),
+        'http://example.com/other': _page(_text(2), '<a href="/c">c</a>'),
+        'http://example.com/short': 'short',
+        'http://example.com/short?x': 'short',
+    }
+    registry = Registry()
+    storage = DictStorage()
+    spider = Spider(queue=ListQueueManager())
+    spider.add_runners([
+        Downloader(transport=DictTransport(pages)),
+        NearDuplicateFilter(metrics=registry),
+        LinkExtractor(),
+        storage,
+    ])
+    for url in sorted(pages):
+        spider.queue_task(DownloadTask(url=url))
+    spider.run()
+
+    assert storage._storage['duplicate'] == [{
+        '_type': 'duplicate',
+        '_id': 'http://example.com/?session=1',
+        'url': 'http://example.com/?session=1',
+        'canonical_url': 'http://example.com/',
+        'distance': storage._storage['duplicate'][0]['distance'],
+    }]
+
+    ## No links were extracted from the duplicate page
+    downloads = spider.metrics.get('simplespider_tasks_total').snapshot()
+    download_type = DownloadTask(url='x').type
+    assert sum(count for (task_type, outcome), count in downloads.iteritems()
+               if task_type == download_type) == 5 + 2  # /a and /c
+    assert registry.get('simplespider_near_duplicates_total').total() == 1
+
+
+def test_near_duplicate_filter_same_url():
+    dedup = NearDuplicateFilter(store_duplicates=False)
+    response = HttpResponse(url='http://example.com/', content=_text(3))
+    task = ScrapingTask(url='http://example.com/', response=response)
+    assert list(dedup(task)) == []
+    assert list(dedup(task)) == []  # fetched again: not a duplicate
+    assert len(dedup.conf['index']) == 1
@@ -0,0 +1,177 @@
+"""
+Tests for the Downloader runner, with a fake ``requests.get`` (the
+``fake_get`` fixture, from conftest.py).
+"""
+
+import pytest
+import requests
+
+from simplespider import AbortTask, DeferTask
+from simplespider.hosts import CircuitBreaker, AdaptiveConcurrency
+from simplespider.metrics import Registry
+from simplespider.transports import DictTransport
+from simplespider.web import Downloader, DownloadTask, ScrapingTask
+
+
+def test_downloader_timeouts(fake_get):
+    downloader = Downloader(timeout=(1, 2),
+                            host_timeouts={'slow.example.com': (5, 60)})
+
+    tasks = list(downloader(DownloadTask(url='http://example.com/')))
+    assert len(tasks) == 1
+    assert isinstance(tasks[0], ScrapingTask)
+    assert tasks[0]['response']['status_code'] == 200
+
+    list(downloader(DownloadTask(url='http://slow.example.com/')))
+    list(downloader(DownloadTask(url='http://example.com/a', timeout=7)))
+
+    assert [c[1]['timeout'] for c in fake_get.calls] == [
+        (1, 2), (5, 60), 7]
+    assert all(c[1]['allow_redirects'] for c in fake_get.calls)
+
+
+def test_downloader_circuit_breaker(fake_get):
+    breaker = CircuitBreaker(failure_threshold=2, cooldown=60)
+    downloader = Downloader(circuit_breaker=breaker)
+    fake_get.failing.add('http://down.example.com/')
+
+    for _ in xrange(2):
+        with pytest.raises(requests.ConnectionError):
+            list(downloader(DownloadTask(url='http://down.example.com/')))
+    assert len(fake_get.calls) == 2
+
+    ## No more requests to this host: tasks get deferred
+    with pytest.raises(DeferTask) as excinfo:
+        list(downloader(DownloadTask(url='http://down.example.com/other')))
+    assert 0 < excinfo.value.retry_after <= 60
+    assert len(fake_get.calls) == 2
+
+    ## Other hosts are not affected
+    list(downloader(DownloadTask(url='http://example.com/')))
+    assert len(fake_get.calls) == 3
+
+    ## Server errors count as failures too
+    for _ in xrange(2):
+        list(downloader(DownloadTask(url='http://bad.example.com/error')))
+    assert breaker.state('bad.example.com') == CircuitBreaker.OPEN
+
+
+def test_downloader_circuit_probe_other_errors(fake_get):
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=0)
+    breaker.record_failure('example.com')
+    downloader = Downloader(circuit_breaker=breaker)
+
+    ## The probe failed for reasons unrelated to the host
+    with pytest.raises(requests.TooManyRedirects):
+        list(downloader(DownloadTask(url='http://example.com/loop')))
+    assert breaker.state('example.com') == CircuitBreaker.HALF_OPEN
+
+    ## ..so another probe is sent
+    list(downloader(DownloadTask(url='http://example.com/')))
+    assert breaker.state('example.com') == CircuitBreaker.CLOSED
+
+
+def test_downloader_dead_host(fake_get):
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=60,
+                             max_cooldown=60)
+    breaker.record_failure('down.example.com', now=0)
+    assert breaker.allow('down.example.com', now=60)[0]  # the probe..
+    breaker.record_failure('down.example.com')  # ..failed
+    downloader = Downloader(circuit_breaker=breaker)
+    with pytest.raises(AbortTask):
+        list(downloader(DownloadTask(url='http://down.example.com/')))
+    assert fake_get.calls == []
+
+
+def test_downloader_circuit_open_fail(fake_get):
+    breaker = CircuitBreaker(failure_threshold=1)
+    breaker.record_failure('down.example.com')
+    downloader = Downloader(circuit_breaker=breaker, circuit_open='fail')
+    with pytest.raises(AbortTask):
+        list(downloader(DownloadTask(url='http://down.example.com/')))
+    assert fake_get.calls == []
+
+
+def test_downloader_no_circuit_breaker(fake_get):
+    downloader = Downloader(circuit_breaker=None)
+    fake_get.failing.add('http://down.example.com/')
+    for _ in xrange(10):
+        with pytest.raises(requests.ConnectionError):
+            list(downloader(DownloadTask(url='http://down.example.com/')))
+    assert len(fake_get.calls) == 10
+
+
+def test_downloader_adaptive_concurrency(fake_get, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr('time.time', lambda: clock[0])
+
+    concurrency = AdaptiveConcurrency(initial_window=1, min_interval=5)
+    downloader = Downloader(concurrency=concurrency)
+
+    list(downloader(DownloadTask(url='http://example.com/1')))
+    assert concurrency.windows()['example.com']['in_flight'] == 0
+    assert concurrency.window('example.com') == 2
+
+    ## Too early for another request to the same host
+    with pytest.raises(DeferTask) as excinfo:
+        list(downloader(DownloadTask(url='http://example.com/2')))
+    assert excinfo.value.retry_after == 5
+    list(downloader(DownloadTask(url='http://other.example.com/')))
+
+    clock[0] += 5
+    list(downloader(DownloadTask(url='http://example.com/2')))
+    clock[0] += 5
+    list(downloader(DownloadTask(url='http://example.com/error')))
+    assert concurrency.window('example.com') < 2
+    assert len(fake_get.calls) == 4
+
+
+def test_downloader_probe_deferred_by_pacing(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr('time.time', lambda: clock[0])
+    transport = DictTransport({'http://example.com/1': 'ok'})
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=10)
+    concurrency = AdaptiveConcurrency(initial_window=1, min_interval=5)
+    downloader = Downloader(transport=transport, circuit_breaker=breaker,
+                            concurrency=concurrency)
+
+    list(downloader(DownloadTask(url='http://example.com/error')))  # 404
+    breaker.record_failure('example.com')  # the circuit opens
+    clock[0] += 1
+    with pytest.raises(DeferTask):
+        list(downloader(DownloadTask(url='http://example.com/1')))
+
+    ## The cooldown is over, but the probe is held back by pacing..
+    clock[0] += 9.5
+    concurrency.set_min_interval('example.com', 20)
+    with pytest.raises(DeferTask):
+        list(downloader(DownloadTask(url='http://example.com/1')))
+    assert breaker.state('example.com', now=clock[0]) == \
+        CircuitBreaker.HALF_OPEN
+
+    ## ..so it's sent once the pacing interval has passed
+    clock[0] += 20
+    tasks = list(downloader(DownloadTask(url='http://example.com/1')))
+    assert tasks[0]['response']['status_code'] == 200
+    assert breaker.state('example.com') == CircuitBreaker.CLOSED
+
+
+def test_downloader_metrics(fake_get):
+    registry = Registry()
+    downloader = Downloader(metrics=registry)
+    fake_get.failing.add('http://down.example.com/')
+
+    list(downloader(DownloadTask(url='http://example.com/')))
+    list(downloader(DownloadTask(url='http://example.com/error')))
+    with pytest.raises(requests.ConnectionError):
+        list(downloader(DownloadTask(url='http://down.example.com/')))
+
+    snapshot = registry.snapshot()
+    assert snapshot['simplespider_fetched_bytes_total'] == {
+        ('example.com',): 2 * len('<html></html>')}
+    assert snapshot['simplespider_responses_total'] == {
+        ('example.com', 200): 1, ('example.com', 503): 1}
+    assert snapshot['simplespider_fetch_errors_total'] == {
+        ('down.example.com',): 1}
+    assert snapshot['simplespider_fetch_seconds'][
+        ('example.com',)]['count'] == 2
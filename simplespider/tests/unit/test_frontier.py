@@ -0,0 +1,29 @@
+from simplespider import BaseTask
+from simplespider.frontier import SpillFile
+
+
+def test_spill_file(tmpdir):
+    spill = SpillFile(dir=str(tmpdir))
+    assert len(spill) == 0
+    assert spill.pop_many(10) == []
+
+    for i in xrange(10):
+        spill.append('task-{0}'.format(i), BaseTask('task-{0}'.format(i)))
+    assert len(spill) == 10
+    assert tmpdir.listdir() == []  # unlinked right away
+
+    items = spill.pop_many(3)
+    assert [name for name, task in items] == ['task-0', 'task-1', 'task-2']
+    assert items[0][1] == BaseTask('task-0')
+
+    spill.append('task-10', BaseTask('task-10'))
+    items = spill.pop_many(100)
+    assert [name for name, task in items] == \
+        ['task-{0}'.format(i) for i in xrange(3, 11)]
+    assert len(spill) == 0
+
+    ## The file is truncated once drained
+    assert spill._write_pos == 0
+    spill.append('task-11', BaseTask('task-11'))
+    assert spill.pop_many(1)[0][0] == 'task-11'
+    spill.close()
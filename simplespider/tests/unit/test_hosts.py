@@ -0,0 +1,124 @@
+from simplespider.hosts import CircuitBreaker, AdaptiveConcurrency
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(failure_threshold=3, cooldown=10,
+                             max_cooldown=25)
+    host = 'example.com'
+
+    assert breaker.allow(host) == (True, None)
+    assert breaker.state(host) == CircuitBreaker.CLOSED
+
+    breaker.record_failure(host, now=100)
+    breaker.record_failure(host, now=100)
+    breaker.record_success(host)  # resets the failures count
+    breaker.record_failure(host, now=100)
+    breaker.record_failure(host, now=100)
+    assert breaker.allow(host, now=100) == (True, None)
+
+    breaker.record_failure(host, now=100)
+    assert breaker.state(host, now=101) == CircuitBreaker.OPEN
+    assert breaker.allow(host, now=104) == (False, 6)
+    assert breaker.allow('other.example.com', now=104) == (True, None)
+    assert breaker.stats().keys() == [host]
+
+    ## After the cooldown, only a single probe is allowed
+    assert breaker.allow(host, now=110) == (True, None)
+    assert breaker.state(host, now=110) == CircuitBreaker.HALF_OPEN
+    assert breaker.allow(host, now=110)[0] is False
+
+    ## The probe failed: the cooldown is doubled
+    breaker.record_failure(host, now=111)
+    assert breaker.allow(host, now=121) == (False, 10)
+    assert breaker.allow(host, now=131) == (True, None)
+
+    ## ..up to max_cooldown
+    breaker.record_failure(host, now=131)
+    assert breaker.allow(host, now=131) == (False, 25)
+
+    ## Probes can be given back, eg. if they couldn't be sent
+    assert breaker.allow(host, now=156) == (True, None)
+    breaker.cancel_probe(host)
+    assert breaker.allow(host, now=156) == (True, None)
+
+    ## A probe failing after max_cooldown: the host is dead
+    assert not breaker.dead(host)
+    breaker.record_failure(host, now=156)
+    assert breaker.allow(host, now=156) == (False, 25)
+    assert breaker.dead(host)
+    assert not breaker.dead('other.example.com')
+
+    ## A successful probe closes the circuit
+    assert breaker.allow(host, now=181) == (True, None)
+    breaker.record_success(host)
+    assert breaker.state(host) == CircuitBreaker.CLOSED
+    assert breaker.allow(host) == (True, None)
+    assert breaker.stats() == {}
+    assert not breaker.dead(host)
+
+
+def test_adaptive_concurrency_window():
+    aimd = AdaptiveConcurrency(initial_window=2, max_window=4)
+    host = 'example.com'
+
+    assert aimd.acquire(host, now=0) == (True, None)
+    assert aimd.acquire(host, now=0) == (True, None)
+    allowed, retry_after = aimd.acquire(host, now=0)
+    assert not allowed and retry_after > 0
+    assert aimd.windows()[host]['in_flight'] == 2
+
+    ## Healthy responses grow the window additively
+    aimd.release(host, latency=.1, status_code=200, now=1)
+    aimd.release(host, latency=.1, status_code=200, now=1)
+    assert 2.5 < aimd.window(host) < 3
+
+    for i in xrange(100):
+        aimd.release(host, latency=.1, status_code=200, now=1)
+    assert aimd.window(host) == 4
+
+    ## Throttling cuts it in half, once per round-trip
+    aimd.release(host, latency=.1, status_code=503, now=10)
+    assert aimd.window(host) == 2
+    aimd.release(host, latency=.1, status_code=429, now=10.01)
+    assert aimd.window(host) == 2
+    aimd.release(host, error=True, now=11)
+    assert aimd.window(host) == 1
+    aimd.release(host, error=True, now=12)
+    assert aimd.window(host) == 1  # min_window
+
+    ## Unknown outcomes leave the window alone
+    aimd.release(host, now=13)
+    assert aimd.window(host) == 1
+
+    assert aimd.window('other.example.com') == 2
+    assert aimd.windows()[host]['in_flight'] == 0
+
+
+def test_adaptive_concurrency_latency_spike():
+    aimd = AdaptiveConcurrency(initial_window=8, latency_spike=3)
+    host = 'example.com'
+    aimd.release(host, latency=.1, status_code=200, now=0)
+    aimd.release(host, latency=.1, status_code=200, now=1)
+    window = aimd.window(host)
+    aimd.release(host, latency=1, status_code=200, now=2)
+    assert aimd.window(host) == window / 2
+
+
+def test_adaptive_concurrency_pacing():
+    aimd = AdaptiveConcurrency(initial_window=2)
+    host = 'example.com'
+    assert aimd.acquire(host, now=100) == (True, None)
+    aimd.release(host, latency=1.0, status_code=200, now=101)
+    window = aimd.window(host)
+
+    ## No more than `window` requests per round-trip time
+    allowed, retry_after = aimd.acquire(host, now=100.1)
+    assert not allowed
+    assert abs(retry_after - (1.0 / window - .1)) < 1e-6
+    assert aimd.acquire(host, now=101) == (True, None)
+    aimd.release(host, now=101)
+
+    ## Explicit minimum interval, eg. from robots.txt
+    aimd.set_min_interval(host, 10)
+    assert aimd.acquire(host, now=105)[0] is False
+    assert aimd.acquire(host, now=111) == (True, None)
@@ -0,0 +1,158 @@
+import time
+
+import pytest
+
+from simplespider import BaseTask, BaseTaskRunner, RetryTask
+from simplespider.budget import CrawlBudget
+from simplespider.jobs import CrawlJob, JobPool
+from simplespider.metrics import Registry
+from simplespider.transports import DictTransport
+from simplespider.web import Downloader, DownloadTask, LinkExtractor
+
+
+class Recorder(BaseTaskRunner):
+    """Record the order the tasks of all the jobs are run in"""
+
+    def __init__(self, log, delay=0.0, **kwargs):
+        super(Recorder, self).__init__(**kwargs)
+        self.log = log
+        self.delay = delay
+
+    def match(self, task):
+        return True
+
+    def __call__(self, task):
+        if self.delay:
+            time.sleep(self.delay)
+        self.log.append(task.id.split(':')[0])
+
+
+def make_job(name, log, tasks, weight=1.0, delay=0.0):
+    job = CrawlJob(name=name, weight=weight)
+    job.add_runners([Recorder(log, delay)])
+    job.queue_tasks(BaseTask('{0}:{1}'.format(name, i))
+                    for i in xrange(tasks))
+    return job
+
+
+def test_crawl_job_arguments():
+    with pytest.raises(TypeError):
+        CrawlJob()
+    with pytest.raises(ValueError):
+        CrawlJob(name='x', weight=0)
+    job = CrawlJob(name='x')
+    assert job.name == 'x'
+    assert job.conf['weight'] == 1.0
+
+
+def test_small_jobs_are_not_starved():
+    log = []
+    pool = JobPool(workers=1, transport=DictTransport())
+    pool.add_job(make_job('big', log, 1000))
+    pool.add_job(make_job('small', log, 10))
+    pool.run()
+
+    assert len(log) == 1010
+    ## Both jobs take turns, until the small one is done
+    assert log[:40].count('small') == 10
+
+    stats = pool.stats()
+    assert stats['big']['tasks'] == 1000
+    assert stats['small']['tasks'] == 10
+    assert stats['small']['done'] and stats['big']['done']
+
+
+def test_weights():
+    log = []
+    pool = JobPool(workers=1, transport=DictTransport())
+    pool.add_job(make_job('light', log, 100, weight=1, delay=0.002))
+    pool.add_job(make_job('heavy', log, 100, weight=3, delay=0.002))
+    pool.run()
+
+    first = log[:40]
+    ratio = first.count('heavy') / float(first.count('light'))
+    assert 2 <= ratio <= 4.5
+
+
+def test_waiting_jobs_dont_hold_workers():
+    class Flaky(Recorder):
+        def __call__(self, task):
+            super(Flaky, self).__call__(task)
+            if not task.get('retries'):
+                raise RetryTask(retry_after=0.5)
+
+    log = []
+    flaky = CrawlJob(name='flaky')
+    flaky.add_runners([Flaky(log)])
+    flaky.queue_task(BaseTask('flaky:0'))
+    pool = JobPool(workers=1, transport=DictTransport())
+    pool.add_job(flaky)
+    pool.add_job(make_job('other', log, 20, delay=0.01))
+    start = time.time()
+    pool.run()
+
+    ## The other job ran while the retry wasn't due yet
+    assert log == ['flaky'] + ['other'] * 20 + ['flaky']
+    assert time.time() - start < 1
+    stats = pool.stats()
+    assert stats['flaky']['tasks'] == 2
+    assert stats['flaky']['seconds'] < 0.1
+
+
+def test_shared_workers_and_transport():
+    pages = {}
+    for site in ('a', 'b', 'c'):
+        for i in xrange(10):
+            pages['http://{0}.com/{1}'.format(site, i)] = \
+                '<a href="http://{0}.com/{1}">next</a>'.format(site, i + 1)
+    transport = DictTransport(pages)
+
+    registry = Registry()
+    pool = JobPool(workers=3, transport=transport, metrics=registry)
+    for site in ('a', 'b', 'c'):
+        budget = CrawlBudget(max_pages_per_host=5) if site == 'c' else None
+        job = CrawlJob(name=site, budget=budget)
+        job.add_runners([
+            Downloader(transport=pool.transport, budget=budget,
+                       circuit_breaker=None),
+            LinkExtractor(),
+        ])
+        job.queue_task(DownloadTask(url='http://{0}.com/0'.format(site)))
+        pool.add_job(job)
+    assert pool.transport is transport
+    assert registry.get('simplespider_jobs_active').get() == 3
+    pool.run()
+
+    stats = pool.stats()
+    ## 10 pages + the 404 at the end, each scraped
+    assert stats['a']['tasks'] == stats['b']['tasks'] == 22
+    assert stats['c']['tasks'] == 11  # 5 pages scraped, and 1 over budget
+    assert registry.get('simplespider_job_tasks_total').get(('a',)) == 22
+    assert registry.get('simplespider_jobs_active').get() == 0
+
+
+def test_failing_job():
+    class Broken(CrawlJob):
+        def run_task(self, task):
+            raise RuntimeError("Broken")
+
+    log = []
+    pool = JobPool(workers=2, transport=DictTransport())
+    broken = Broken(name='broken')
+    broken.queue_task(BaseTask('broken:0'))
+    pool.add_job(broken)
+    pool.add_job(make_job('ok', log, 5))
+    pool.run()
+
+    stats = pool.stats()
+    assert isinstance(stats['broken']['error'], RuntimeError)
+    assert stats['ok']['tasks'] == 5
+    assert stats['ok']['error'] is None
+
+
+def test_default_transport():
+    pytest.importorskip('urllib3')
+    from simplespider.transports import Urllib3Transport
+    pool = JobPool(workers=2)
+    assert isinstance(pool.transport, Urllib3Transport)
+    pool.run()  # no jobs
@@ -0,0 +1,273 @@
+"""
+Tests for the kombu-based queues, using the in-memory transport.
+"""
+
+from collections import deque
+import uuid
+
+import pytest
+
+from simplespider import BaseTask, Spider, BaseTaskRunner
+from simplespider.web import DownloadTask, ScrapingTask
+from simplespider.queues.kombu import KombuQueueSimple, KombuQueueBatched
+
+
+def _queue_name():
+    ## The memory transport is shared by the whole process
+    return 'test_{0}'.format(uuid.uuid4().hex)
+
+
+def test_kombu_simple_empty():
+    queue = KombuQueueSimple(connection='memory://', queue_name=_queue_name(),
+                             timeout=0.01)
+    queue.push('task-1', BaseTask('task-1'))
+    name, task = queue.pop()
+    assert name == 'task-1'
+    with pytest.raises(IndexError):
+        queue.pop()
+
+
+def test_kombu_batched_push_pop():
+    queue = KombuQueueBatched(connection='memory://',
+                              queue_name=_queue_name(),
+                              publish_batch_size=3, timeout=0.01)
+
+    for i in xrange(7):
+        queue.push('task-{0}'.format(i), BaseTask('task-{0}'.format(i)))
+
+    ## Two full batches were published, one task is still in the outbox
+    assert len(queue._outbox[queue.conf['queue_name']]) == 1
+    assert len(queue.queue) == 2
+
+    names = []
+    while True:
+        try:
+            name, task = queue.pop()
+        except IndexError:
+            break
+        assert name == task.id
+        names.append(name)
+        queue.task_done(name)
+
+    assert names == ['task-{0}'.format(i) for i in xrange(7)]
+    assert queue._unacked == {}
+    assert queue._pending == {}
+
+
+def test_kombu_batched_push_many():
+    queue = KombuQueueBatched(connection='memory://',
+                              queue_name=_queue_name(),
+                              publish_batch_size=3, timeout=0.01)
+    queue.push('task-0', BaseTask('task-0'))
+    queue.push_many(('task-{0}'.format(i), BaseTask('task-{0}'.format(i)))
+                    for i in xrange(1, 8))
+
+    ## Two full batches were published, two tasks are still in the outbox
+    assert len(queue._outbox[queue.conf['queue_name']]) == 2
+    assert len(queue.queue) == 2
+
+    names = []
+    while True:
+        try:
+            name, task = queue.pop()
+        except IndexError:
+            break
+        names.append(name)
+        queue.task_done(name)
+    assert names == ['task-{0}'.format(i) for i in xrange(8)]
+
+
+def test_kombu_batched_ack_after_completion():
+    queue_name = _queue_name()
+    queue = KombuQueueBatched(connection='memory://', queue_name=queue_name,
+                              timeout=0.01)
+    queue.push('task-1', BaseTask('task-1'))
+    queue.push('task-2', BaseTask('task-2'))
+    queue.flush()
+
+    queue.pop()
+    assert len(queue._unacked) == 1
+    queue.task_done('task-1')
+    assert len(queue._unacked) == 1  # task-2 not done yet
+    queue.pop()
+    queue.task_done('task-2')
+    assert len(queue._unacked) == 0
+
+
+def test_kombu_batched_reads_simple_messages():
+    queue_name = _queue_name()
+    simple = KombuQueueSimple(connection='memory://', queue_name=queue_name)
+    simple.push('task-1', BaseTask('task-1', foo='bar'))
+
+    queue = KombuQueueBatched(connection='memory://', queue_name=queue_name,
+                              timeout=0.01)
+    name, task = queue.pop()
+    assert name == 'task-1'
+    assert task['foo'] == 'bar'
+
+
+def test_kombu_batched_skips_empty_messages():
+    queue = KombuQueueBatched(connection='memory://',
+                              queue_name=_queue_name(),
+                              prefetch_count=1, timeout=0.01)
+    queue.get_queue(queue.conf['queue_name']).put([])
+    queue.push('task-1', BaseTask('task-1'))
+    queue.flush()
+    name, task = queue.pop()
+    assert name == 'task-1'
+
+    queue.get_queue(queue.conf['queue_name']).put([])
+    with pytest.raises(IndexError):
+        queue.pop()
+
+
+def test_kombu_batched_cached_length():
+    queue = KombuQueueBatched(connection='memory://',
+                              queue_name=_queue_name(),
+                              publish_batch_size=2, length_ttl=3600)
+    assert len(queue) == 0
+    queue.push('task-1', BaseTask('task-1'))
+    assert len(queue) == 1  # only the outbox is counted
+    queue.flush()
+    assert len(queue) == 0  # broker length is cached
+
+
+def test_kombu_batched_release():
+    queue_name = _queue_name()
+    old = KombuQueueBatched(connection='memory://', queue_name=queue_name,
+                            publish_batch_size=1, timeout=0.01)
+    for i in xrange(3):
+        old.push('task-{0}'.format(i), BaseTask('task-{0}'.format(i)))
+    name, task = old.pop()
+    old.task_done(name)
+    consumer = old.get_queue(queue_name).consumer
+    assert consumer._active_tags
+
+    ## The buffered messages go back to the broker, and the
+    ## consumer is cancelled
+    old.release()
+    assert not consumer._active_tags
+    assert old._buffer == deque() and old._unacked == {}
+
+    ## Pushing doesn't start consuming again
+    old.push('task-3', BaseTask('task-3'))
+    assert old._queues == {}
+
+    new = KombuQueueBatched(connection='memory://', queue_name=queue_name,
+                            timeout=0.01)
+    names = []
+    while True:
+        try:
+            name, task = new.pop()
+        except IndexError:
+            break
+        names.append(name)
+        new.task_done(name)
+    assert sorted(names) == ['task-1', 'task-2', 'task-3']
+
+
+def test_kombu_batched_spider_run():
+    execution_log = []
+
+    class MyRunner(BaseTaskRunner):
+        def __call__(self, task):
+            execution_log.append(task.id)
+            if task.get('children'):
+                for i in xrange(task['children']):
+                    yield BaseTask('{0}.{1}'.format(task.id, i))
+
+    queue = KombuQueueBatched(connection='memory://',
+                              queue_name=_queue_name(), timeout=0.01)
+    spider = Spider(queue=queue)
+    spider.add_runners([MyRunner()])
+    spider.queue_task(BaseTask('root', children=3))
+    spider.run()
+
+    assert execution_log == ['root', 'root.0', 'root.1', 'root.2']
+    assert queue._unacked == {}
+
+
+class MyDownloadTask(DownloadTask):
+    pass
+
+
+def test_kombu_routing_by_type():
+    prefix = _queue_name()
+    routes = {
+        DownloadTask: prefix + '_fetch',
+        'simplespider.web:ScrapingTask': prefix + '_parse',
+    }
+    queue = KombuQueueSimple(connection='memory://', queue_name=prefix,
+                             routes=routes, timeout=0.01)
+    assert queue.conf['consume_from'][0] == prefix
+    assert sorted(queue.conf['consume_from'][1:]) == sorted(routes.values())
+
+    assert queue.route(DownloadTask(url='http://example.com')) == \
+        prefix + '_fetch'
+    assert queue.route(MyDownloadTask(url='http://example.com')) == \
+        prefix + '_fetch'
+    assert queue.route(ScrapingTask(url='http://example.com')) == \
+        prefix + '_parse'
+    assert queue.route(BaseTask('task-1')) == prefix
+
+    queue.push('task-1', BaseTask('task-1'))
+    queue.push(*_named(DownloadTask(url='http://example.com/1')))
+    queue.push(*_named(ScrapingTask(url='http://example.com/2')))
+
+    assert len(queue.get_queue(prefix)) == 1
+    assert len(queue.get_queue(prefix + '_fetch')) == 1
+    assert len(queue.get_queue(prefix + '_parse')) == 1
+    assert len(queue) == 3
+
+    ## A worker only doing the fetching
+    fetcher = KombuQueueSimple(connection='memory://', queue_name=prefix,
+                               routes=routes, consume_from=[prefix + '_fetch'],
+                               timeout=0.01)
+    name, task = fetcher.pop()
+    assert isinstance(task, DownloadTask)
+    with pytest.raises(IndexError):
+        fetcher.pop()
+
+    ## All the rest
+    popped = set()
+    for _ in xrange(2):
+        popped.add(type(queue.pop()[1]))
+    assert popped == set([BaseTask, ScrapingTask])
+    with pytest.raises(IndexError):
+        queue.pop()
+
+
+def test_kombu_routing_callable():
+    prefix = _queue_name()
+
+    def by_host(task):
+        if task.get('url'):
+            return prefix + '_' + task['url'].split('/')[2]
+
+    queue = KombuQueueBatched(
+        connection='memory://', queue_name=prefix, routes=by_host,
+        consume_from=[prefix + '_a.example.com', prefix + '_b.example.com'],
+        timeout=0.01)
+
+    for url in ('http://a.example.com/1', 'http://b.example.com/1',
+                'http://a.example.com/2', 'http://c.example.com/1'):
+        queue.push(*_named(DownloadTask(url=url)))
+    queue.flush()
+
+    assert len(queue.get_queue(prefix + '_a.example.com')) == 1  # 1 batch
+    assert len(queue.get_queue(prefix + '_c.example.com')) == 1
+
+    urls = []
+    while True:
+        try:
+            name, task = queue.pop()
+        except IndexError:
+            break
+        urls.append(task['url'])
+        queue.task_done(name)
+    assert sorted(urls) == ['http://a.example.com/1', 'http://a.example.com/2',
+                            'http://b.example.com/1']
+
+
+def _named(task):
+    return task.id, task
@@ -0,0 +1,146 @@
+"""
+Tests for the metrics registry
+"""
+
+import random
+import sys
+import threading
+import urllib2
+
+import pytest
+
+from simplespider import Spider, BaseTask, BaseTaskRunner, RetryTask
+from simplespider.metrics import Registry, HistogramData, start_http_server
+
+
+def test_counter():
+    registry = Registry()
+    counter = registry.counter('requests_total', 'Requests', ['host'])
+    assert registry.counter('requests_total') is counter
+
+    counter.inc(labels=('example.com',))
+    counter.inc(2, ('example.com',))
+    counter.inc(labels=('example.org',))
+    assert counter.get(('example.com',)) == 3
+    assert counter.get(('example.net',)) == 0
+    assert counter.total() == 4
+
+    with pytest.raises(ValueError):
+        registry.histogram('requests_total')
+
+
+def test_metrics_threads():
+    registry = Registry()
+    counter = registry.counter('tasks_total')
+    histogram = registry.histogram('task_seconds')
+
+    def work():
+        for _ in xrange(5000):
+            counter.inc()
+            histogram.observe(0.001)
+
+    interval = sys.getcheckinterval()
+    sys.setcheckinterval(1)  # switch threads as often as possible
+    try:
+        threads = [threading.Thread(target=work) for _ in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setcheckinterval(interval)
+    assert counter.get() == 40000
+    assert histogram.get().count == 40000
+
+
+def test_histogram_buckets():
+    ## Same buckets as with int.bit_length()
+    data = HistogramData(unit=1, sub_bits=4)
+    for v in (32, 33, 63, 64, 1000, 2 ** 40 + 12345):
+        shift = v.bit_length() - 5
+        assert data._bucket(v) == (shift << 4) + (v >> shift)
+
+
+def test_histogram_percentiles():
+    data = HistogramData(unit=1e-6)
+    values = [random.uniform(0.001, 2) for _ in xrange(10000)]
+    for value in values:
+        data.record(value)
+    values.sort()
+
+    assert data.count == 10000
+    assert data.min == values[0]
+    assert data.max == values[-1]
+    for p in (50, 90, 99):
+        exact = values[int(p / 100.0 * len(values)) - 1]
+        assert abs(data.percentile(p) - exact) / exact < 0.07
+
+    ## Small values are exact
+    data = HistogramData(unit=1)
+    for value in xrange(20):
+        data.record(value)
+    assert data.percentile(50) == 9.5
+
+    assert HistogramData().percentile(50) is None
+
+
+def test_render_text():
+    registry = Registry()
+    registry.counter('tasks_total', 'Tasks run', ['type']).inc(
+        3, ('my:"Task"',))
+    registry.gauge('queue_depth', 'Queue depth', lambda: 42)
+    hist = registry.histogram('task_seconds', '', ['type'])
+    hist.observe(0.5, ('a',))
+
+    text = registry.render_text()
+    assert '# HELP tasks_total Tasks run\n' in text
+    assert '# TYPE tasks_total counter\n' in text
+    assert 'tasks_total{type="my:\\"Task\\""} 3\n' in text
+    assert 'queue_depth 42\n' in text
+    assert '# TYPE task_seconds summary\n' in text
+    assert 'task_seconds{type="a",quantile="0.5"} 0.5' in text
+    assert 'task_seconds_count{type="a"} 1\n' in text
+
+
+def test_http_server():
+    registry = Registry()
+    registry.counter('tasks_total').inc(5)
+    server = start_http_server(registry, port=0)
+    try:
+        url = 'http://127.0.0.1:{0}/metrics'.format(server.server_port)
+        body = urllib2.urlopen(url).read()
+    finally:
+        server.shutdown()
+    assert 'tasks_total 5\n' in body
+
+
+def test_spider_metrics():
+    class MyRunner(BaseTaskRunner):
+        def __call__(self, task):
+            if task.get('fail'):
+                raise RetryTask()
+            if task.get('children'):
+                for i in xrange(task['children']):
+                    yield BaseTask('{0}.{1}'.format(task.id, i))
+
+    registry = Registry()
+    spider = Spider(metrics=registry, retry_delay=0)
+    spider.add_runners([MyRunner()])
+    spider.queue_task(BaseTask('task-1', children=3))
+    spider.queue_task(BaseTask('task-2', fail=True, retry=1))
+    assert registry.get('simplespider_queue_depth').get() == 2
+    spider.run()
+
+    snapshot = registry.snapshot()
+    tasks = snapshot['simplespider_tasks_total']
+    assert tasks[('simplespider:BaseTask', 'success')] == 4
+    assert tasks[('simplespider:BaseTask', 'retried')] == 1
+    assert tasks[('simplespider:BaseTask', 'failed')] == 1
+    assert snapshot['simplespider_tasks_queued_total'] == {
+        ('simplespider:BaseTask',): 5}
+    assert snapshot['simplespider_retries_total'] == {
+        ('simplespider:BaseTask',): 1}
+    assert snapshot['simplespider_runner_seconds'][
+        ('MyRunner',)]['count'] == 6
+    assert snapshot['simplespider_queue_depth'] == {(): 0}
+    assert registry.get('simplespider_tasks_per_second').get() > 0
@@ -0,0 +1,51 @@
+import json
+
+from simplespider.benchmarks import micro
+
+
+def test_run_benchmarks():
+    report = micro.run_benchmarks(scale=0.0001, repeat=1)
+    report = json.loads(json.dumps(report))
+    assert sorted(report['results']) == \
+        sorted(name for name, n, setup in micro.BENCHMARKS)
+    for result in report['results'].itervalues():
+        assert result['n'] >= 1
+        assert result['seconds_per_op'] > 0
+
+
+def test_run_benchmarks_only():
+    report = micro.run_benchmarks(scale=0.001, repeat=1,
+                                  only=['task_init', 'list_queue_dedup'])
+    assert sorted(report['results']) == ['list_queue_dedup', 'task_init']
+    assert report['results']['task_init']['n'] == 100
+
+
+def _report(**times):
+    return {'results': dict((name, {'n': 1, 'seconds_per_op': t})
+                            for name, t in times.iteritems())}
+
+
+def test_compare():
+    baseline = _report(a=1.0, b=1.0, c=1.0)
+    report = _report(a=1.1, b=1.5, c=0.5, d=10.0)
+    assert micro.compare(report, baseline, 0.2) == [('b', 1.0, 1.5, 0.5)]
+    assert [r[0] for r in micro.compare(report, baseline, 0.05)] == \
+        ['a', 'b']
+    assert micro.compare(report, baseline, 1) == []
+
+
+def test_main_fails_on_regression(tmpdir):
+    baseline = tmpdir.join('baseline.json')
+    assert micro.main(['--scale', '0.001', '--repeat', '1',
+                       '--only', 'task_to_dict',
+                       '--output', str(baseline)]) == 0
+    data = json.loads(baseline.read())
+    data['results']['task_to_dict']['seconds_per_op'] /= 10.0
+    baseline.write(json.dumps(data))
+    assert micro.main(['--scale', '0.001', '--repeat', '1',
+                       '--only', 'task_to_dict',
+                       '--baseline', str(baseline)]) == 1
+    assert micro.main(['--scale', '0.001', '--repeat', '1',
+                       '--only', 'task_to_dict',
+                       '--baseline', str(baseline),
+                       '--max-regression', '100']) == 0
@@ -0,0 +1,135 @@
+"""
+Tests for the profiling hooks
+"""
+
+import os
+import pstats
+import signal
+
+import pytest
+
+from simplespider import Spider, BaseTask, BaseTaskRunner
+from simplespider import profiling
+from simplespider.profiling import Profiler
+
+
+def busy_function(n):
+    return sum(x * x for x in xrange(n))
+
+
+class BusyRunner(BaseTaskRunner):
+    def __call__(self, task):
+        busy_function(1000)
+        return iter([])
+
+
+class IdleRunner(BaseTaskRunner):
+    def __call__(self, task):
+        return iter([])
+
+
+def _run_spider(profiler, tasks=10):
+    spider = Spider(profiler=profiler)
+    spider.add_runners([BusyRunner(), IdleRunner()])
+    for i in xrange(tasks):
+        spider.queue_task(BaseTask('task-{0}'.format(i)))
+    spider.run()
+
+
+def test_profiler_per_runner(tmpdir):
+    profiler = Profiler(output_dir=str(tmpdir), sample_rate=1.0,
+                        dump_every=10, dump_signal=None, toggle_signal=None)
+    _run_spider(profiler)
+
+    assert profiler.samples == {'BusyRunner': 10, 'IdleRunner': 10}
+    files = sorted(os.listdir(str(tmpdir)))
+    assert len(files) == 4
+    assert files[0].startswith('profile-BusyRunner-')
+
+    stats = pstats.Stats(str(tmpdir.join(files[0])))
+    functions = [func[2] for func in stats.stats]
+    assert 'busy_function' in functions
+    with open(str(tmpdir.join(files[1]))) as fp:
+        assert fp.readline().startswith('10 profiled executions')
+
+
+def test_profiler_sampling(tmpdir):
+    profiler = Profiler(output_dir=str(tmpdir), sample_rate=0.0,
+                        dump_signal=None, toggle_signal=None)
+    _run_spider(profiler)
+    assert profiler.samples == {}
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_profiler_signals(tmpdir):
+    profiler = Profiler(output_dir=str(tmpdir), sample_rate=1.0,
+                        active=False, dump_signal=signal.SIGUSR1,
+                        toggle_signal=signal.SIGUSR2)
+    try:
+        _run_spider(profiler, tasks=2)
+        assert profiler.samples == {}
+
+        os.kill(os.getpid(), signal.SIGUSR2)
+        assert profiler.active
+        _run_spider(profiler, tasks=2)
+        assert profiler.samples['BusyRunner'] == 2
+        assert os.listdir(str(tmpdir)) == []
+
+        ## The dump happens when the next task is done
+        os.kill(os.getpid(), signal.SIGUSR1)
+        _run_spider(profiler, tasks=1)
+        assert len(os.listdir(str(tmpdir))) == 4
+    finally:
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+
+
+def test_profiler_no_signals_by_default():
+    handler = signal.getsignal(signal.SIGUSR1)
+    Profiler()
+    assert signal.getsignal(signal.SIGUSR1) == handler
+
+
+def test_profiler_object_counts(tmpdir, monkeypatch):
+    monkeypatch.setattr(profiling, 'tracemalloc', None)
+    leaked = []
+
+    class LeakyRunner(BaseTaskRunner):
+        def __call__(self, task):
+            leaked.extend(LeakedObject() for _ in xrange(100))
+            return iter([])
+
+    profiler = Profiler(output_dir=str(tmpdir), sample_rate=0.0,
+                        snapshot_every=5)
+    spider = Spider(profiler=profiler)
+    spider.add_runners([LeakyRunner()])
+    for i in xrange(10):
+        spider.queue_task(BaseTask('task-{0}'.format(i)))
+    spider.run()
+
+    files = os.listdir(str(tmpdir))
+    assert len(files) == 1
+    assert files[0].startswith('objects-')
+    with open(str(tmpdir.join(files[0]))) as fp:
+        report = fp.read()
+    assert report.startswith('RSS: ')
+    assert '{0}.LeakedObject: 1000 (+500)'.format(__name__) in report
+
+
+class LeakedObject(object):
+    pass
+
+
+def test_profiler_tracemalloc(tmpdir):
+    if profiling.tracemalloc is None:
+        pytest.skip("tracemalloc not available")
+    profiler = Profiler(output_dir=str(tmpdir), sample_rate=0.0,
+                        snapshot_every=5, dump_signal=None,
+                        toggle_signal=None)
+    try:
+        _run_spider(profiler, tasks=10)
+    finally:
+        profiling.tracemalloc.stop()
+    files = os.listdir(str(tmpdir))
+    assert len(files) == 1
+    assert files[0].startswith('tracemalloc-')
@@ -0,0 +1,186 @@
+import time
+
+import pytest
+
+from simplespider import ListQueueManager, Spider
+from simplespider.recrawl import RecrawlIndex, RecrawlTracker
+from simplespider.storage import DictStorage, StoreObjectTask
+from simplespider.transports import BaseTransport, make_response
+from simplespider.web import BaseScraper, Downloader, DownloadTask, \
+    LinkExtractor, ScrapingTask
+
+
+def test_recrawl_index_intervals():
+    index = RecrawlIndex(initial_interval=100, min_interval=30,
+                         max_interval=300, backoff=2)
+    url = 'http://example.com/'
+    assert index.record(url, 'hash1', now=1000) is True
+    assert index.get(url)['due'] == 1100
+
+    ## Unchanged: the interval grows, up to max_interval
+    assert index.record(url, 'hash1', now=1100) is False
+    assert index.get(url)['interval'] == 200
+    assert index.record(url, not_modified=True, now=1300) is False
+    assert index.get(url)['interval'] == 300
+    assert index.get(url)['hash'] == 'hash1'  # kept on 304s
+
+    ## Changed: the interval shrinks, down to min_interval
+    for now, interval in ((1600, 150), (1750, 75), (1825, 37.5),
+                          (1862.5, 30)):
+        assert index.record(url, 'hash-{0}'.format(now), now=now) is True
+        assert index.get(url)['interval'] == interval
+    state = index.get(url)
+    assert state['visits'] == 7
+    assert state['changes'] == 4
+    assert state['due'] == 1892.5
+
+
+def test_recrawl_index_due(tmpdir):
+    path = str(tmpdir.join('recrawl.db'))
+    index = RecrawlIndex(path=path, initial_interval=100, min_interval=10)
+    for i in xrange(5):
+        index.record('http://example.com/{0}'.format(i), 'x', now=1000 + i)
+    index.reschedule('http://example.com/4', 50, now=900)
+    assert index.next_due() == 950
+    assert index.pop_due(now=999) == [('http://example.com/4',
+                                       index.get('http://example.com/4'))]
+    ## Due again after its interval, unless recorded
+    assert index.get('http://example.com/4')['due'] == 1099
+    assert index.next_due() == 1099
+    index.record('http://example.com/4', 'x', now=999)
+    assert index.get('http://example.com/4')['due'] == 1199
+    assert index.next_due() == 1100
+
+    tasks = index.pop_due_tasks(now=1102, limit=2)
+    assert [t['url'] for t in tasks] == ['http://example.com/0',
+                                         'http://example.com/1']
+    assert tasks[0]['revisit'] == 1
+    assert tasks[0].id.endswith('http://example.com/0#1')
+    assert index.pop_due(now=1102) == [('http://example.com/2',
+                                        index.get('http://example.com/2'))]
+    assert index.pop_due(now=1102) == []
+    assert index.next_due() == 1103
+    index.close()
+
+    ## The due times are persistent; URLs popped but never
+    ## recorded are due again, after their interval
+    index = RecrawlIndex(path=path)
+    assert len(index) == 5
+    assert 'http://example.com/3' in index
+    assert index.pop_due(now=1102) == []
+    assert [url for url, state in index.pop_due(now=1202)] == \
+        ['http://example.com/3', 'http://example.com/4',
+         'http://example.com/0', 'http://example.com/1',
+         'http://example.com/2']
+    index.close()
+
+
+def test_recrawl_failed_revisit():
+    index = RecrawlIndex(initial_interval=100, min_interval=10)
+    queue = ListQueueManager()
+    url = 'http://example.com/'
+    index.record(url, 'x', now=1000)
+
+    ## The first revisit fails before being recorded: the URL
+    ## comes due again, with a new task id the queue doesn't drop
+    ids = []
+    for now in (1100, 1200):
+        task, = index.pop_due_tasks(now=now)
+        ids.append(task.id)
+        queue.push(task.id, task)
+        assert queue.pop() == (task.id, task)
+    assert ids == ['simplespider.web:DownloadTask:http://example.com/#1',
+                   'simplespider.web:DownloadTask:http://example.com/#2']
+
+    ## Records from before the revisits counter keep going up too
+    state = index.get(url)
+    state['visits'] = 5
+    del state['revisits']
+    index._put(url, state)
+    task, = index.pop_due_tasks(now=1300)
+    assert task['revisit'] == 6
+
+
+class _VersionedSite(BaseTransport):
+    """Pages with ETags, answering conditional requests"""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.requests = []
+
+    def fetch(self, url, headers=None, timeout=None, allow_redirects=True):
+        self.requests.append((url, dict(headers)))
+        version, content = self.pages[url]
+        etag = '"{0}"'.format(version)
+        if headers.get('If-None-Match') == etag:
+            return make_response(url, 304, {'ETag': etag}, '')
+        return make_response(url, 200, {'Content-Type': 'text/html',
+                                        'ETag': etag}, content)
+
+
+class _PageCounter(BaseScraper):
+    def __call__(self, task):
+        yield StoreObjectTask(data={'_type': 'visit', '_id': task.id,
+                                    'url': task['url']})
+
+
+def test_recrawl_spider():
+    site = _VersionedSite({
+        'http://example.com/': (1, '<a href="/a">a</a>'),
+        'http://example.com/a': (1, 'A'),
+    })
+    index = RecrawlIndex(initial_interval=60, min_interval=1)
+    storage = DictStorage()
+
+    def crawl(seed):
+        spider = Spider(queue=ListQueueManager(), recrawl=index,
+                        recrawl_wait=0)
+        spider.add_runners([Downloader(transport=site),
+                            RecrawlTracker(index=index),
+                            LinkExtractor(), _PageCounter(), storage])
+        if seed:
+            spider.queue_task(DownloadTask(url='http://example.com/'))
+        spider.run()
+
+    crawl(True)
+    assert len(index) == 2
+    assert len(storage._storage['visit']) == 2
+    assert site.requests[0][1].get('If-None-Match') is None
+
+    ## Make everything due again, and change one of the pages
+    for url in ('http://example.com/', 'http://example.com/a'):
+        index.reschedule(url, 0)
+    site.pages['http://example.com/a'] = (2, 'Changed A')
+    del site.requests[:]
+    crawl(False)
+
+    ## Both pages were revisited, with conditional requests; only
+    ## the changed one was scraped again.
+    assert sorted(url for url, headers in site.requests
+                  if headers.get('If-None-Match') == '"1"') == \
+        ['http://example.com/', 'http://example.com/a']
+    assert sorted(v['_id'] for v in storage._storage['visit']) == [
+        'simplespider.web:ScrapingTask:http://example.com/',
+        'simplespider.web:ScrapingTask:http://example.com/a',
+        'simplespider.web:ScrapingTask:http://example.com/a#1',
+    ]
+    assert index.get('http://example.com/')['interval'] == 120
+    assert index.get('http://example.com/a')['interval'] == 30
+    assert index.get('http://example.com/a')['etag'] == '"2"'
+
+
+def test_recrawl_tracker_errors():
+    index = RecrawlIndex()
+    tracker = RecrawlTracker(index=index, error_delay=10)
+    task = ScrapingTask(url='http://example.com/', response=make_response(
+        'http://example.com/', 503, {}, 'Unavailable'))
+    tracker(task)
+    assert len(index) == 0  # never fetched successfully
+
+    index.record('http://example.com/', 'x', now=1000)
+    start = time.time()
+    tracker(task)
+    assert start + 10 <= index.next_due() <= time.time() + 10
+    assert index.get('http://example.com/')['visits'] == 1
+    with pytest.raises(TypeError):
+        RecrawlTracker()
@@ -0,0 +1,39 @@
+from simplespider import BaseTask, RetryTask
+from simplespider.retry import RetryScheduler, backoff_delay
+
+
+def test_backoff_delay():
+    assert backoff_delay(1, base=1, factor=2, jitter=0) == 1
+    assert backoff_delay(2, base=1, factor=2, jitter=0) == 2
+    assert backoff_delay(5, base=1, factor=2, jitter=0) == 16
+    assert backoff_delay(20, base=1, factor=2, max_delay=60, jitter=0) == 60
+
+    for _ in xrange(100):
+        delay = backoff_delay(3, base=1, factor=2, jitter=0.5)
+        assert 2 <= delay <= 4
+
+
+def test_retry_scheduler():
+    scheduler = RetryScheduler()
+    assert scheduler.next_due() is None
+    assert scheduler.pop_due() is None
+
+    scheduler.schedule(BaseTask('task-1'), 10, now=100)
+    scheduler.schedule(BaseTask('task-2'), 5, now=100)
+    scheduler.schedule(BaseTask('task-3'), 5, now=100)
+    assert len(scheduler) == 3
+    assert scheduler.next_due() == 105
+
+    assert scheduler.pop_due(now=104) is None
+    assert scheduler.pop_due(now=105).id == 'task-2'
+    assert scheduler.pop_due(now=105).id == 'task-3'
+    assert scheduler.pop_due(now=109) is None
+    assert scheduler.pop_due(now=200).id == 'task-1'
+    assert len(scheduler) == 0
+
+
+def test_retry_task_exception():
+    assert RetryTask().retry_after is None
+    exc = RetryTask("Slow down", retry_after=30)
+    assert exc.retry_after == 30
+    assert exc.args == ("Slow down",)
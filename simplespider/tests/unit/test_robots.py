@@ -0,0 +1,211 @@
+import BaseHTTPServer
+import threading
+
+import pytest
+
+from simplespider import AbortTask, DeferTask, RetryTask, Spider, \
+    ListQueueManager
+from simplespider.hosts import AdaptiveConcurrency, CircuitBreaker
+from simplespider.metrics import Registry
+from simplespider.robots import RobotsCache, RobotsRules
+from simplespider.transports import DictTransport
+from simplespider.web import Downloader, DownloadTask
+
+ROBOTS = """
+# Comments are ignored
+User-agent: *
+Disallow: /private
+Allow: /private/public
+Disallow: /*.pdf$
+Disallow: /search*q=
+Crawl-delay: 2
+
+User-agent: simplespider
+User-agent: otherbot
+Disallow: /not-for-spiders  # inline comment
+Crawl-delay: 0.5
+
+User-agent: badbot
+Disallow: /
+
+Sitemap: http://example.com/sitemap.xml
+"""
+
+
+def test_robots_rules():
+    rules = RobotsRules.parse(ROBOTS, 'otherbot/1.0')
+    assert rules.crawl_delay == 0.5
+    assert rules.sitemaps == ['http://example.com/sitemap.xml']
+    assert rules.allowed('http://example.com/private')
+    assert not rules.allowed('http://example.com/not-for-spiders/a')
+
+    rules = RobotsRules.parse(ROBOTS, 'somebot')
+    assert rules.crawl_delay == 2
+    assert rules.allowed('http://example.com/')
+    assert not rules.allowed('http://example.com/private/x')
+    assert rules.allowed('http://example.com/private/public/x')  # longer
+    assert not rules.allowed('http://example.com/docs/a.pdf')
+    assert rules.allowed('http://example.com/docs/a.pdf?download=1')
+    assert not rules.allowed('http://example.com/search?lang=en&q=x')
+    assert rules.allowed('http://example.com/search?lang=en')
+    assert not rules.allowed('http://example.com/%70rivate')
+
+    assert not RobotsRules.parse(ROBOTS, 'BadBot').allowed('/anything')
+    assert RobotsRules.parse('Disallow: /\n').allowed('/x')  # no group
+    assert RobotsRules.parse('User-agent: *\nDisallow:\n').allowed('/x')
+
+    ## Ties go to "Allow"
+    rules = RobotsRules([('/page', False), ('/page', True)])
+    assert rules.allowed('/page')
+
+
+@pytest.fixture
+def server(request):
+    hits = []
+    robots = {'/robots.txt': (200, ROBOTS)}
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            hits.append(self.path)
+            status, body = robots.get(self.path, (200, '<html></html>'))
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    request.addfinalizer(server.shutdown)
+    server.url = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+    server.hits = hits
+    server.robots = robots
+    return server
+
+
+def test_downloader_robots(server):
+    concurrency = AdaptiveConcurrency()
+    registry = Registry()
+    robots = RobotsCache(user_agent='somebot', max_crawl_delay=1)
+    downloader = Downloader(robots=robots, concurrency=concurrency,
+                            metrics=registry)
+    assert robots.concurrency is concurrency
+    assert robots.transport is downloader.conf['transport']
+
+    task, = downloader(DownloadTask(url=server.url + '/page'))
+    assert task['response']['status_code'] == 200
+    with pytest.raises(AbortTask):
+        list(downloader(DownloadTask(url=server.url + '/private/page')))
+
+    ## robots.txt was fetched only once
+    assert server.hits == ['/robots.txt', '/page']
+    assert registry.get('simplespider_robots_disallowed_total').total() == 1
+
+    ## The crawl delay (capped) reached the scheduler
+    assert concurrency._hosts['127.0.0.1'].min_interval == 1
+
+
+def test_robots_cache_errors(server):
+    robots = RobotsCache()
+    server.robots['/robots.txt'] = (404, 'Not found')
+    assert robots.allowed(server.url + '/private')
+
+    assert robots.retry_after(server.url + '/private') is None
+
+    ## Server errors make the host unavailable, for a while
+    server.robots['/robots.txt'] = (503, 'Unavailable')
+    other = server.url.replace('127.0.0.1', 'localhost')
+    assert not robots.allowed(other + '/page')
+    assert robots.rules(other + '/page').unavailable
+    assert robots._cache[other][0] < robots._cache[server.url][0]
+    assert 0 < robots.retry_after(other + '/page') <= 600
+
+    ## So do connection errors
+    assert not robots.allowed('http://127.0.0.1:1/page')
+    assert robots.rules('http://127.0.0.1:1/page').unavailable
+
+
+def test_downloader_robots_unavailable():
+    transport = DictTransport({
+        'http://down.example.com/robots.txt': (503, {}, 'Unavailable'),
+        'http://down.example.com/page': 'Page',
+    })
+    robots = RobotsCache(error_ttl=120)
+    breaker = CircuitBreaker()
+    downloader = Downloader(robots=robots, transport=transport,
+                            circuit_breaker=breaker)
+    assert robots.transport is transport
+
+    ## Deferred, not aborted: the page may well be allowed
+    with pytest.raises(DeferTask) as excinfo:
+        list(downloader(DownloadTask(url='http://down.example.com/page')))
+    assert 0 < excinfo.value.retry_after <= 120
+    assert robots.fetches == 1
+
+    ## The failed robots.txt fetch went to the circuit breaker
+    assert breaker._hosts['down.example.com'].failures == 1
+
+    ## Without a circuit breaker, the task retries are used instead
+    downloader = Downloader(robots=RobotsCache(), transport=transport,
+                            circuit_breaker=None)
+    with pytest.raises(RetryTask) as excinfo:
+        list(downloader(DownloadTask(url='http://down.example.com/page')))
+    assert not isinstance(excinfo.value, DeferTask)
+
+
+def test_spider_robots_host_down():
+    transport = DictTransport({
+        'http://down.example.com/robots.txt': (503, {}, 'Unavailable'),
+        'http://down.example.com/page': 'Page',
+    })
+    robots = RobotsCache(error_ttl=0.01)
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=0.01,
+                             max_cooldown=0.02)
+    spider = Spider(queue=ListQueueManager())
+    spider.add_runners([
+        Downloader(robots=robots, transport=transport,
+                   circuit_breaker=breaker),
+    ])
+    task = DownloadTask(url='http://down.example.com/page')
+    spider.queue_task(task)
+
+    ## The run ends: the host is given up on, once it's dead
+    thread = threading.Thread(target=spider.run)
+    thread.daemon = True
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+
+    assert breaker.dead('down.example.com')
+    tasks = spider.metrics.get('simplespider_tasks_total').snapshot()
+    assert tasks[(task.type, 'aborted')] == 1
+    assert robots.fetches <= 3
+
+
+def test_robots_cache_ttl_lru():
+    transport = DictTransport(dict(
+        ('http://host{0}.example.com/robots.txt'.format(i),
+         (200, {}, 'User-agent: *\nDisallow: /private\n'))
+        for i in xrange(3)))
+    robots = RobotsCache(transport=transport, ttl=100, max_hosts=2)
+    rules = robots.rules('http://host0.example.com/a', now=1000)
+    assert not rules.allowed('http://host0.example.com/private')
+    assert robots.rules('http://HOST0.example.com/b', now=1099) is rules
+    assert robots.fetches == 1
+
+    ## Expired
+    assert robots.rules('http://host0.example.com/a', now=1100) is not rules
+    assert robots.fetches == 2
+
+    ## host1 is the least recently used: evicted
+    robots.rules('http://host1.example.com/', now=1100)
+    robots.rules('http://host0.example.com/', now=1100)
+    robots.rules('http://host2.example.com/', now=1100)
+    assert list(robots._cache) == ['http://host0.example.com',
+                                   'http://host2.example.com']
+    assert robots.fetches == 4
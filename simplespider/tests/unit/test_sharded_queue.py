@@ -0,0 +1,228 @@
+"""
+Tests for the host-sharded queue manager
+"""
+
+import uuid
+
+import pytest
+
+from simplespider import BaseTask, ListQueueManager
+from simplespider.queues.sharded import HashRing, ShardedQueueManager, \
+    assign_shards, task_host
+from simplespider.web import DownloadTask
+
+
+def _urls(hosts=20, pages=5):
+    for h in xrange(hosts):
+        for p in xrange(pages):
+            yield 'http://host{0}.example.com/page{1}'.format(h, p)
+
+
+def _drain(queue):
+    tasks = []
+    while True:
+        try:
+            name, task = queue.pop()
+        except IndexError:
+            return tasks
+        tasks.append(task)
+        queue.task_done(name)
+
+
+def test_hash_ring():
+    ring = HashRing(xrange(8))
+    keys = ['host{0}.example.com'.format(i) for i in xrange(1000)]
+    before = dict((k, ring.get_node(k)) for k in keys)
+    assert set(before.itervalues()) == set(xrange(8))
+
+    ## Adding a node only moves keys to the new node
+    ring.add_node(8)
+    after = dict((k, ring.get_node(k)) for k in keys)
+    moved = [k for k in keys if before[k] != after[k]]
+    assert all(after[k] == 8 for k in moved)
+    assert 0 < len(moved) < 300
+
+    with pytest.raises(ValueError):
+        HashRing([]).get_node('foo')
+
+
+def test_assign_shards():
+    workers = ['w1', 'w2', 'w3']
+    owned = [assign_shards(w, workers, range(32)) for w in workers]
+    assert sorted(sum(owned, [])) == range(32)
+
+    ## When a worker leaves, the others keep their shards
+    new_owned = [assign_shards(w, workers[:2], range(32))
+                 for w in workers[:2]]
+    assert set(owned[0]) <= set(new_owned[0])
+    assert set(owned[1]) <= set(new_owned[1])
+
+
+def test_task_host():
+    assert task_host(DownloadTask(url='http://Example.com:8080/a')) == \
+        'example.com'
+    assert task_host(BaseTask('task-1')) == 'task-1'
+
+
+def test_sharded_queue_two_workers():
+    shard_queues = {}
+
+    def shard_queue(n):
+        return shard_queues.setdefault(n, ListQueueManager())
+
+    workers = ['w1', 'w2']
+    queues = dict(
+        (w, ShardedQueueManager(
+            shards=8, shard_queue=shard_queue,
+            owned_shards=assign_shards(w, workers, range(8))))
+        for w in workers)
+
+    for url in _urls():
+        queues['w1'].push(*_named(DownloadTask(url=url)))
+
+    ## Tasks for w2 are kept back, to be forwarded in a batch
+    assert queues['w1']._outbox_size > 0
+    queues['w1'].flush()
+    assert queues['w1']._outbox_size == 0
+
+    got = dict((w, _drain(q)) for w, q in queues.iteritems())
+    assert len(got['w1']) + len(got['w2']) == 100
+
+    ## Each host is handled by a single worker
+    hosts = dict((w, set(task_host(t) for t in tasks))
+                 for w, tasks in got.iteritems())
+    assert hosts['w1'] and hosts['w2']
+    assert not hosts['w1'] & hosts['w2']
+
+
+def test_sharded_queue_forward_batch_size():
+    shard_queues = {}
+    queue = ShardedQueueManager(
+        shards=4, owned_shards=[],
+        shard_queue=lambda n: shard_queues.setdefault(n, ListQueueManager()),
+        forward_batch_size=10)
+    for i, url in enumerate(_urls(hosts=20, pages=1)):
+        queue.push(*_named(DownloadTask(url=url)))
+        assert queue._outbox_size == (i + 1) % 10
+    assert sum(len(q) for q in shard_queues.itervalues()) == 20
+
+
+def test_sharded_queue_push_many():
+    shard_queues = {}
+    queue = ShardedQueueManager(
+        shards=4, owned_shards=[0, 1],
+        shard_queue=lambda n: shard_queues.setdefault(n, ListQueueManager()),
+        forward_batch_size=1000)
+    tasks = [DownloadTask(url=url) for url in _urls(hosts=20, pages=2)]
+    queue.push_many(_named(task) for task in tasks)
+
+    ## Tasks for other workers' shards are kept back
+    owned = [t for t in tasks if queue.get_shard(t) in (0, 1)]
+    assert sum(len(shard_queues.get(n, ())) for n in (0, 1)) == len(owned)
+    assert queue._outbox_size == len(tasks) - len(owned)
+    queue.flush()
+    assert sum(len(q) for q in shard_queues.itervalues()) == 40
+    assert sorted(t['url'] for t in _drain(queue)) == \
+        sorted(t['url'] for t in owned)
+
+
+def test_sharded_queue_dedup():
+    queue = ShardedQueueManager(shards=4,
+                                shard_queue=lambda n: _NoDedupQueue())
+    task = DownloadTask(url='http://example.com')
+    assert not queue.seen(*_named(task))
+    for _ in xrange(3):
+        queue.push(*_named(task))
+    assert queue.seen(*_named(task))
+    queue.push_many([_named(task)] * 3)
+    assert len(queue) == 1  # not pushed again to the shard
+    assert len(_drain(queue)) == 1
+
+    ## Nor after being run
+    queue.push(*_named(task))
+    queue.push_many([_named(task)])
+    assert len(queue) == 0
+
+    ## Copies forwarded by other workers are dropped when popped
+    shard_queue = queue.get_queue(queue.get_shard(task))
+    shard_queue.push(*_named(task))
+    assert _drain(queue) == []
+
+
+def test_sharded_queue_shared_dedup_state():
+    shard_queues = {}
+    seen = {}
+
+    def make_queue(owned):
+        return ShardedQueueManager(
+            shards=4, owned_shards=owned,
+            shard_queue=lambda n: shard_queues.setdefault(
+                n, _NoDedupQueue()),
+            shard_seen=lambda n: seen.setdefault(n, {}))
+
+    w1 = make_queue(range(4))
+    for url in _urls(hosts=8, pages=2):
+        w1.push(*_named(DownloadTask(url=url)))
+    done = _drain(w1)
+    assert len(done) == 16
+
+    ## The same links are found again, and queued by w1 before
+    ## handing over all of its shards to w2
+    for url in _urls(hosts=8, pages=2):
+        shard_queues[w1.get_shard(DownloadTask(url=url))].push(
+            *_named(DownloadTask(url=url)))
+    w1.set_owned_shards([])
+    w2 = make_queue(range(4))
+    assert _drain(w2) == []
+
+
+def test_sharded_queue_rebalance():
+    pytest.importorskip('kombu')
+    from simplespider.queues.kombu import KombuQueueBatched
+
+    prefix = 'test_{0}'.format(uuid.uuid4().hex)
+
+    def shard_queue(n):
+        return KombuQueueBatched(connection='memory://',
+                                 queue_name='{0}.{1}'.format(prefix, n),
+                                 timeout=0.01)
+
+    w1 = ShardedQueueManager(shards=8, shard_queue=shard_queue)
+    for url in _urls():
+        w1.push(*_named(DownloadTask(url=url)))
+
+    ## Run a few tasks, then let another worker join
+    done = []
+    for _ in xrange(10):
+        name, task = w1.pop()
+        done.append(task['url'])
+        w1.task_done(name)
+
+    w2 = ShardedQueueManager(shards=8, shard_queue=shard_queue,
+                             owned_shards=[])
+    w1.rebalance('w1', ['w1', 'w2'])
+    w2.rebalance('w2', ['w1', 'w2'])
+    assert w1.owned_shards and w2.owned_shards
+    assert not set(w1.owned_shards) & set(w2.owned_shards)
+
+    done.extend(t['url'] for t in _drain(w1))
+    done.extend(t['url'] for t in _drain(w2))
+
+    ## No task was lost (some might be run twice after rebalancing)
+    assert set(done) == set(_urls())
+
+
+def test_sharded_queue_required_args():
+    with pytest.raises(TypeError):
+        ShardedQueueManager(shard_queue=ListQueueManager)
+    with pytest.raises(TypeError):
+        ShardedQueueManager(shards=4)
+
+
+class _NoDedupQueue(ListQueueManager):
+    def push(self, name, task):
+        self._queue.append((name, task))
+
+
+def _named(task):
+    return task.id, task
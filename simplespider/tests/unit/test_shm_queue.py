@@ -0,0 +1,169 @@
+"""
+Tests for the shared-memory queue manager
+"""
+
+import multiprocessing
+import os
+import threading
+
+import pytest
+
+from simplespider import BaseTask, BaseTaskRunner, Spider
+from simplespider.queues.shm import SharedMemoryQueueManager
+
+
+class FanOutTask(BaseTask):
+    __slots__ = []
+
+
+def _named(task):
+    return task.id, task
+
+
+def test_shm_queue_push_pop():
+    queue = SharedMemoryQueueManager(size=4096, dedup_bits=1024)
+    for i in xrange(10):
+        queue.push(*_named(BaseTask('task-{0}'.format(i), foo='bar')))
+    queue.push(*_named(BaseTask('task-1')))  # duplicate
+    assert len(queue) == 10
+    assert queue.seen('task-1', BaseTask('task-1'))
+    assert not queue.seen('task-10', BaseTask('task-10'))
+
+    for i in xrange(10):
+        name, task = queue.pop()
+        assert name == 'task-{0}'.format(i)
+        assert task['foo'] == 'bar'
+        queue.task_done(name)
+
+    with pytest.raises(IndexError):
+        queue.pop()
+
+
+def test_shm_queue_wraparound_and_overflow():
+    queue = SharedMemoryQueueManager(size=1024, dedup_bits=0)
+    payload = 'x' * 100
+
+    ## Fill the buffer beyond its capacity
+    for i in xrange(20):
+        queue.push(*_named(BaseTask('task-{0}'.format(i), data=payload)))
+    assert len(queue._overflow) > 0
+    assert len(queue) == 20
+
+    popped = []
+    for i in xrange(20):
+        name, task = queue.pop()
+        assert task['data'] == payload
+        popped.append(name)
+        queue.task_done(name)
+        ## Keep the ring busy, so records wrap around the end
+        if i < 10:
+            queue.push(*_named(BaseTask('more-{0}'.format(i),
+                                        data=payload)))
+    assert popped[:20] == ['task-{0}'.format(i) for i in xrange(20)]
+    assert len(queue) == 10
+
+    with pytest.raises(ValueError):
+        queue.push(*_named(BaseTask('huge', data='x' * 2048)))
+
+
+def test_shm_queue_push_many():
+    queue = SharedMemoryQueueManager(size=1024, dedup_bits=1024)
+    queue.push(*_named(BaseTask('task-0')))
+    queue.push_many(_named(BaseTask('task-{0}'.format(i), data='x' * 100))
+                    for i in xrange(20))
+    assert len(queue) == 20  # task-0 was a duplicate
+    assert len(queue._overflow) > 0
+
+    names = []
+    for i in xrange(20):
+        name, task = queue.pop()
+        names.append(name)
+        queue.task_done(name)
+    assert names == ['task-{0}'.format(i) for i in xrange(20)]
+
+
+def test_shm_queue_no_dedup():
+    queue = SharedMemoryQueueManager(size=4096, dedup_bits=0)
+    queue.push(*_named(BaseTask('task-1')))
+    queue.push(*_named(BaseTask('task-1')))
+    assert len(queue) == 2
+
+
+class FanOutRunner(BaseTaskRunner):
+    def __init__(self, results, **kwargs):
+        super(FanOutRunner, self).__init__(**kwargs)
+        self._results = results
+
+    def __call__(self, task):
+        self._results.put(task.id)
+        if task['depth'] < 3:
+            for i in xrange(3):
+                yield FanOutTask('{0}.{1}'.format(task.id, i),
+                                 depth=task['depth'] + 1)
+
+
+def _worker(queue, results):
+    spider = Spider(queue=queue)
+    spider.add_runners([FanOutRunner(results)])
+    spider.run()
+
+
+def test_shm_queue_many_processes():
+    queue = SharedMemoryQueueManager(size=64 * 1024)
+    results = multiprocessing.Queue()
+    queue.push(*_named(FanOutTask('root', depth=0)))
+
+    procs = [multiprocessing.Process(target=_worker, args=(queue, results))
+             for _ in xrange(4)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join(30)
+        assert proc.exitcode == 0
+
+    done = []
+    while not results.empty():
+        done.append(results.get())
+    assert len(done) == 1 + 3 + 9 + 27
+    assert len(set(done)) == len(done)
+    assert len(queue) == 0
+
+
+def _die_while_running(queue):
+    queue.pop()
+    os._exit(3)
+
+
+def test_shm_queue_dead_worker():
+    queue = SharedMemoryQueueManager(size=64 * 1024, max_workers=2)
+    queue.push(*_named(BaseTask('task-1')))
+    proc = multiprocessing.Process(target=_die_while_running, args=(queue,))
+    proc.start()
+    while len(queue):
+        proc.join(0.01)
+
+    ## The dead process is not waited for (even before it's joined)
+    errors = []
+
+    def pop():
+        try:
+            queue.pop()
+        except IndexError, e:
+            errors.append(e)
+
+    thread = threading.Thread(target=pop)
+    thread.daemon = True
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert len(errors) == 1
+    proc.join()
+
+    ## Its slot can be reused
+    for i in xrange(2):
+        proc = multiprocessing.Process(target=_die_while_running,
+                                       args=(queue,))
+        queue.push(*_named(BaseTask('task-{0}'.format(i + 2))))
+        proc.start()
+        proc.join()
+        assert proc.exitcode == 3
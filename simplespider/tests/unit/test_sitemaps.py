@@ -0,0 +1,167 @@
+import gzip
+import io
+
+from simplespider import ListQueueManager, Spider
+from simplespider.sitemaps import SitemapSeeder, canonicalize_url, \
+    iter_sitemap, open_stream
+
+NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+
+def make_sitemap(urls):
+    return ''.join(
+        ['<?xml version="1.0" encoding="UTF-8"?>\n',
+         '<urlset xmlns="{0}">\n'.format(NS)] +
+        ['<url><loc>{0}</loc><lastmod>2016-01-01</lastmod></url>\n'
+         .format(url) for url in urls] +
+        ['</urlset>\n'])
+
+
+def make_index(urls):
+    return ''.join(
+        ['<sitemapindex xmlns="{0}">\n'.format(NS)] +
+        ['<sitemap><loc>{0}</loc></sitemap>\n'.format(url) for url in urls] +
+        ['</sitemapindex>\n'])
+
+
+def gzipped(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as fp:
+        fp.write(data)
+    return buf.getvalue()
+
+
+def test_canonicalize_url():
+    assert canonicalize_url(' HTTP://Example.COM:80#top ') == \
+        'http://example.com/'
+    assert canonicalize_url('https://example.com:443/a?b=1#c') == \
+        'https://example.com/a?b=1'
+    assert canonicalize_url('http://user@Example.com:8080/A') == \
+        'http://user@example.com:8080/A'
+    assert canonicalize_url('ftp://example.com/') is None
+    assert canonicalize_url('/relative') is None
+    assert canonicalize_url('http://example.com:bad/') is None
+
+    ## IPv6 addresses keep their brackets
+    assert canonicalize_url('http://[::1]:8080/a') == 'http://[::1]:8080/a'
+    assert canonicalize_url('http://[FE80::1]:80/') == 'http://[fe80::1]/'
+
+
+def test_open_stream_gzip():
+    data = make_sitemap(['http://example.com/'])
+    assert open_stream(io.BytesIO(gzipped(data))).read() == data
+    assert open_stream(io.BytesIO(data)).read() == data
+
+    ## Read in small chunks, with concatenated members
+    stream = open_stream(io.BytesIO(gzipped('abc') + gzipped('def')))
+    assert ''.join(iter(lambda: stream.read(2), '')) == 'abcdef'
+
+
+def test_iter_sitemap():
+    sitemap = make_sitemap(['http://example.com/a', 'http://example.com/b'])
+    assert list(iter_sitemap(io.BytesIO(sitemap))) == [
+        ('url', 'http://example.com/a'), ('url', 'http://example.com/b')]
+    index = make_index(['http://example.com/s1.xml.gz'])
+    assert list(iter_sitemap(io.BytesIO(gzipped(index)))) == [
+        ('sitemap', 'http://example.com/s1.xml.gz')]
+
+    ## No namespace, comments, and entries without a location
+    assert list(iter_sitemap(io.BytesIO(
+        '<urlset><!-- x --><url><loc> http://example.com/ </loc></url>'
+        '<url></url></urlset>'))) == [('url', 'http://example.com/')]
+
+
+def test_iter_sitemap_large():
+    ## The largest sitemaps allowed, read in chunks
+    sitemap = gzipped(make_sitemap('http://example.com/{0}'.format(i)
+                                   for i in xrange(50000)))
+    count = 0
+    for kind, url in iter_sitemap(io.BytesIO(sitemap)):
+        count += 1
+    assert count == 50000
+    assert url == 'http://example.com/49999'
+
+
+def test_sitemap_seeder():
+    files = {
+        'http://example.com/index.xml': make_index([
+            'http://example.com/s1.xml.gz',
+            '/s2.xml',  # relative
+            'http://example.com/missing.xml',
+            'http://example.com/index.xml',  # loops are ignored
+        ]),
+        'http://example.com/s1.xml.gz': gzipped(make_sitemap(
+            ['http://example.com/{0}'.format(i) for i in xrange(25)])),
+        'http://example.com/s2.xml': make_sitemap([
+            'HTTP://EXAMPLE.COM:80/1#x',  # duplicate, once canonical
+            'http://example.com/other',
+            'mailto:someone@example.com',
+            'http://example.com/skip-me',
+        ]),
+    }
+
+    def opener(url):
+        if url not in files:
+            raise IOError("Not found: {0}".format(url))
+        return io.BytesIO(files[url])
+
+    queue = ListQueueManager()
+    spider = Spider(queue=queue)
+    seeder = SitemapSeeder(spider, batch_size=10, opener=opener,
+                           url_filter=lambda url: 'skip' not in url)
+    stats = seeder.seed('http://example.com/index.xml')
+    assert stats == {'sitemaps': 3, 'urls': 29, 'queued': 27, 'errors': 1}
+
+    urls = set()
+    while len(queue):
+        urls.add(queue.pop()[1]['url'])
+    assert urls == set(['http://example.com/{0}'.format(i)
+                        for i in xrange(25)] + ['http://example.com/other'])
+
+
+class _BufferedQueue(ListQueueManager):
+    """Keep the pushed tasks in a buffer, until flushed"""
+
+    def __init__(self, *args, **kwargs):
+        super(_BufferedQueue, self).__init__(*args, **kwargs)
+        self.buffer = []
+
+    def push_many(self, items):
+        self.buffer.extend(items)
+
+    def flush(self):
+        super(_BufferedQueue, self).push_many(self.buffer)
+        self.buffer = []
+
+
+def test_sitemap_seeder_flush():
+    def opener(url):
+        return io.BytesIO(make_sitemap(
+            ['http://example.com/{0}'.format(i) for i in xrange(5)]))
+
+    queue = _BufferedQueue()
+    spider = Spider(queue=queue)
+    stats = SitemapSeeder(spider, batch_size=2, opener=opener).seed(
+        'http://example.com/sitemap.xml')
+    assert stats['queued'] == 5
+    assert len(queue) == 5
+    assert queue.buffer == []
+
+
+def test_sitemap_seeder_max_depth(tmpdir):
+    tmpdir.join('sitemap.xml').write(make_sitemap(['http://example.com/']))
+    tmpdir.join('index2.xml').write(make_index([
+        str(tmpdir.join('sitemap.xml'))]))
+    tmpdir.join('index1.xml').write(make_index([
+        str(tmpdir.join('index2.xml'))]))
+
+    stats = SitemapSeeder(Spider(), max_depth=1).seed(
+        str(tmpdir.join('index1.xml')))
+    assert stats['sitemaps'] == 2
+    assert stats['queued'] == 0
+
+    spider = Spider()
+    stats = SitemapSeeder(spider).seed(str(tmpdir.join('index1.xml')))
+    assert stats['sitemaps'] == 3
+    assert stats['queued'] == 1
+    assert len(spider._task_queue) == 1
@@ -0,0 +1,95 @@
+"""
+Tests for the task lifecycle tracer
+"""
+
+import json
+
+from simplespider import Spider, BaseTask, BaseTaskRunner
+from simplespider.tracing import Tracer
+
+
+class ParentRunner(BaseTaskRunner):
+    def __call__(self, task):
+        for i in xrange(task.get('children', 0)):
+            yield BaseTask('{0}.{1}'.format(task.id, i))
+
+
+class NeverRunner(BaseTaskRunner):
+    def match(self, task):
+        return False
+
+
+def _run_spider(tracer, roots=1):
+    spider = Spider(tracer=tracer)
+    spider.add_runners([NeverRunner(), ParentRunner()])
+    for i in xrange(roots):
+        spider.queue_task(BaseTask('root-{0}'.format(i), children=2))
+    spider.run()
+    return spider
+
+
+def test_tracer_spans(tmpdir):
+    path = str(tmpdir.join('trace.json'))
+    tracer = Tracer(sample_rate=1.0, path=path)
+    _run_spider(tracer)
+
+    with open(path) as fp:
+        trace = json.load(fp)
+    events = trace['traceEvents']
+    assert events == tracer.events
+
+    def find(**kw):
+        return [e for e in events
+                if all(e.get(k) == v for k, v in kw.iteritems())]
+
+    tasks = find(cat='task')
+    assert sorted(e['args']['task'] for e in tasks) == [
+        'root-0', 'root-0.0', 'root-0.1']
+    assert all(e['args']['outcome'] == 'success' for e in tasks)
+    assert len(find(cat='queue')) == 3
+    assert len(find(cat='match', name='NeverRunner')) == 3
+    assert len(find(cat='match', name='ParentRunner')) == 3
+    assert len(find(cat='run', name='ParentRunner')) == 3
+
+    ## Parent -> children links
+    starts = find(cat='flow', ph='s')
+    ends = find(cat='flow', ph='f')
+    assert len(starts) == len(ends) == 2
+    assert set(e['id'] for e in starts) == set(e['id'] for e in ends)
+
+    ## Spans are nested within the task span
+    root = find(cat='task', args={'task': 'root-0', 'outcome': 'success'})[0]
+    run = [e for e in find(cat='run')
+           if root['ts'] <= e['ts'] <= root['ts'] + root['dur']][0]
+    assert run['ts'] + run['dur'] <= root['ts'] + root['dur']
+
+
+def test_tracer_sampling():
+    tracer = Tracer(sample_rate=0.0)
+    _run_spider(tracer, roots=10)
+    assert tracer.events == []
+
+    tracer = Tracer(sample_rate=0.5)
+    _run_spider(tracer, roots=200)
+    traced = set(e['args']['task'] for e in tracer.events
+                 if e['cat'] == 'task')
+    roots = set(t for t in traced if '.' not in t)
+    children = traced - roots
+    assert 50 < len(roots) < 150
+
+    ## Children are sampled on their own, not along with their parent
+    assert 100 < len(children) < 300
+    linked = set('{0}.{1}'.format(r, i) for r in roots for i in xrange(2))
+    assert children - linked and linked - children
+
+    ## Flow arrows only link traced parents to traced children
+    flows = [e for e in tracer.events if e['cat'] == 'flow']
+    assert len([e for e in flows if e['ph'] == 's']) == \
+        len([e for e in flows if e['ph'] == 'f']) == \
+        len(children & linked)
+
+
+def test_tracer_max_events():
+    tracer = Tracer(max_events=10)
+    _run_spider(tracer, roots=10)
+    assert len(tracer.events) == 10
@@ -0,0 +1,85 @@
+import copy
+import pickle
+
+from simplespider import BaseTask
+from simplespider.transports import HttpResponse
+from simplespider.web import Downloader, DownloadTask, LinkExtractor, \
+    ScrapingTask, Trail
+
+
+def test_trail():
+    trail = Trail.from_list(['http://a/', 'http://b/', 'http://c/'])
+    assert len(trail) == 3
+    assert trail.url == 'http://c/'
+    assert trail.to_list() == ['http://a/', 'http://b/', 'http://c/']
+    assert list(trail) == trail.to_list()
+    assert trail[0] == 'http://a/'
+    assert trail[-1] == 'http://c/'
+    assert trail == ['http://a/', 'http://b/', 'http://c/']
+    assert trail != ['http://a/', 'http://b/']
+
+    ## Nodes are interned and shared
+    assert Trail.from_list(['http://a/', 'http://b/', 'http://c/']) is trail
+    assert trail.extend('http://d/').parent is trail
+    assert trail.extend('http://d/') is trail.extend('http://d/')
+    assert Trail.from_list([]) is None
+    assert Trail.coerce(None) is None
+    assert Trail.coerce(trail) is trail
+
+    ## Immutable: copies are the node itself
+    assert copy.copy(trail) is trail
+    assert copy.deepcopy(trail) is trail
+
+    ## Pickled as a flat list, and interned again when loaded
+    data = pickle.dumps(trail, pickle.HIGHEST_PROTOCOL)
+    assert pickle.loads(data) is trail
+
+
+def test_deep_trail_pickle():
+    trail = Trail.from_list(['http://example.com/{0}'.format(i)
+                             for i in xrange(5000)])
+    assert len(trail) == 5000
+    loaded = pickle.loads(pickle.dumps(trail, pickle.HIGHEST_PROTOCOL))
+    assert loaded.to_list() == trail.to_list()
+
+
+def test_task_trail():
+    task = DownloadTask(url='http://c/', trail=['http://a/', 'http://b/'])
+    assert isinstance(task['trail'], Trail)
+    assert len(task['trail']) == 2
+
+    ## Serialized as a plain list, eg. for JSON
+    data = task.to_dict()
+    assert data['trail'] == ['http://a/', 'http://b/']
+    assert type(data['trail']) is list
+    loaded = BaseTask.from_dict(data)
+    assert loaded['trail'] is task['trail']
+    assert loaded == task
+
+    assert 'trail' not in DownloadTask(url='http://a/')._attributes
+    assert DownloadTask(url='http://a/', trail=[])['trail'] is None
+
+
+def test_link_extractor_shares_trail():
+    task = ScrapingTask(
+        url='http://example.com/b', trail=['http://example.com/'],
+        response=HttpResponse(
+            url='http://example.com/b',
+            headers={'content-type': 'text/html'},
+            content='<a href="/c">c</a><a href="/d">d</a>'))
+    tasks = list(LinkExtractor()(task))
+    assert sorted(t['url'] for t in tasks) == \
+        ['http://example.com/c', 'http://example.com/d']
+    assert tasks[0]['trail'] is tasks[1]['trail']
+    assert tasks[0]['trail'] == ['http://example.com/',
+                                 'http://example.com/b']
+    assert tasks[0]['trail'].parent is task['trail']
+
+
+def test_downloader_max_depth():
+    downloader = Downloader(max_depth=2)
+    assert downloader.match(DownloadTask(url='http://a/'))
+    assert downloader.match(DownloadTask(
+        url='http://c/', trail=['http://a/', 'http://b/']))
+    assert not downloader.match(DownloadTask(
+        url='http://d/', trail=['http://a/', 'http://b/', 'http://c/']))
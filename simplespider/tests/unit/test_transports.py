@@ -0,0 +1,127 @@
+import BaseHTTPServer
+import threading
+
+import pytest
+import requests
+
+from simplespider.transports import DictTransport, FileTransport, \
+    HttpResponse, RequestsTransport, Urllib3Transport
+from simplespider.web import Downloader, DownloadTask
+
+
+@pytest.fixture(scope='module')
+def server(request):
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/redirect':
+                self.send_response(302)
+                self.send_header('Location', '/page')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = '<html><a href="/redirect">x</a></html>'
+            self.send_response(200 if self.path == '/page' else 404)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    request.addfinalizer(server.shutdown)
+    return 'http://127.0.0.1:{0}'.format(server.server_address[1])
+
+
+def _without_date(response):
+    response = HttpResponse(**response)
+    response['headers'] = dict((k.lower(), v)
+                               for k, v in response['headers'].items()
+                               if k.lower() not in ('date', 'server'))
+    return response
+
+
+@pytest.mark.parametrize('path', ['/page', '/redirect', '/missing'])
+def test_http_transports(server, path):
+    expected = RequestsTransport().fetch(server + path, timeout=(1, 1))
+    if path == '/redirect':
+        assert expected['url'] == server + '/page'
+    for transport in (RequestsTransport(requests.Session()),
+                      Urllib3Transport()):
+        response = transport.fetch(server + path, timeout=(1, 1))
+        assert _without_date(response) == _without_date(expected)
+
+
+def test_http_transports_no_redirects(server):
+    for transport in (RequestsTransport(), Urllib3Transport()):
+        response = transport.fetch(server + '/redirect',
+                                   allow_redirects=False)
+        assert response['status_code'] == 302
+        assert response['url'] == server + '/redirect'
+
+
+def test_http_transports_errors():
+    for transport in (RequestsTransport(), Urllib3Transport()):
+        with pytest.raises(transport.errors):
+            transport.fetch('http://127.0.0.1:1/', timeout=(1, 1))
+
+
+def test_file_transport(tmpdir):
+    tmpdir.join('example.com', 'a').ensure(dir=True)
+    tmpdir.join('example.com', 'index.html').write('<html>home</html>')
+    tmpdir.join('example.com', 'a', 'b.txt').write('hello')
+    transport = FileTransport(root=str(tmpdir))
+
+    response = transport.fetch('http://example.com/')
+    assert response['status_code'] == 200
+    assert response['content'] == '<html>home</html>'
+    assert response['headers']['Content-Type'] == 'text/html'
+    assert response['url'] == 'http://example.com/'
+
+    response = transport.fetch('http://example.com/a/b.txt')
+    assert response['content'] == 'hello'
+    assert response['encoding'] == 'ISO-8859-1'  # as requests does
+
+    response = transport.fetch('http://example.com/../../etc/passwd')
+    assert response['status_code'] == 404
+    assert not response['ok']
+
+    path = tmpdir.join('example.com', 'a', 'b.txt')
+    response = transport.fetch('file://' + str(path))
+    assert response['content'] == 'hello'
+    assert FileTransport().fetch('http://example.com/')['status_code'] == 404
+
+
+def test_dict_transport():
+    transport = DictTransport({
+        'http://example.com/': '<html></html>',
+        'http://example.com/error': (503, {}, 'Try later'),
+        'http://example.com/full': HttpResponse(status_code=200,
+                                                content='full'),
+    })
+    response = transport.fetch('http://example.com/')
+    assert response == HttpResponse(
+        headers={'Content-Type': 'text/html; charset=utf-8'},
+        content='<html></html>', encoding='utf-8', ok=True,
+        status_code=200, reason='OK', url='http://example.com/')
+    response = transport.fetch('http://example.com/error')
+    assert (response['status_code'], response['reason'], response['ok']) \
+        == (503, 'Service Unavailable', False)
+    assert transport.fetch('http://example.com/full')['content'] == 'full'
+    assert transport.fetch('http://example.com/x')['status_code'] == 404
+
+
+def test_downloader_transport():
+    transport = DictTransport({'http://example.com/': '<html></html>',
+                               'http://example.com/error': (500, {}, '')})
+    downloader = Downloader(transport=transport)
+    task, = downloader(DownloadTask(url='http://example.com/'))
+    assert task['response']['content'] == '<html></html>'
+
+    for i in xrange(5):
+        list(downloader(DownloadTask(url='http://example.com/error')))
+    assert downloader.conf['circuit_breaker'].state('example.com') == 'open'
@@ -0,0 +1,138 @@
+"""
+Task lifecycle tracing, exported as Chrome trace events
+
+Spans are recorded for the time each task spent queued, the time
+spent in each runner's ``match()`` and ``__call__()`` and the whole
+task execution; tasks are linked to the tasks they yield with flow
+arrows. The resulting JSON file can be opened in ``chrome://tracing``
+or https://ui.perfetto.dev::
+
+    tracer = Tracer(sample_rate=0.01, path='crawl-trace.json')
+    spider = Spider(tracer=tracer)
+    ...
+    spider.run()  # the trace is written at the end
+"""
+
+import json
+import os
+import threading
+import time
+import zlib
+
+
+class Tracer(object):
+    """
+    Collects trace events for a sample of the tasks.
+
+    Each task is traced with probability ``sample_rate``, decided by
+    hashing its id (so different processes agree on which tasks to
+    trace), independently of its parent: as every task of a crawl
+    descends from a seed, tracing whole subtrees would end up tracing
+    everything. Flow arrows link the traced tasks yielded by
+    traced tasks.
+    """
+
+    def __init__(self, sample_rate=1.0, path=None, max_events=1000000):
+        """
+        :param sample_rate: fraction of the tasks to be traced
+        :param path: file the trace is written to by :py:meth:`export`
+        :param max_events: stop recording after this many events,
+            to keep memory bounded
+        """
+        self.sample_rate = sample_rate
+        self.path = path
+        self.max_events = max_events
+        self.events = []
+        self._threshold = int(sample_rate * 0xffffffff)
+        self._queued = {}  # task id -> (queued at, has traced parent)
+        self._local = threading.local()
+        self._pid = os.getpid()
+
+    def _now(self):
+        return time.time() * 1e6  # microseconds
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _add(self, event):
+        if len(self.events) < self.max_events:
+            event['pid'] = self._pid
+            event['tid'] = threading.current_thread().ident
+            self.events.append(event)
+
+    def _flow_id(self, task_id):
+        if isinstance(task_id, unicode):
+            task_id = task_id.encode('utf-8')
+        return zlib.crc32(task_id) & 0xffffffff
+
+    def is_sampled(self, task):
+        return self._flow_id(task.id) <= self._threshold
+
+    @property
+    def current(self):
+        """The task being traced in this thread, if any"""
+        stack = self._stack()
+        if stack and stack[-1] is not None:
+            return stack[-1][0]
+        return None
+
+    def task_queued(self, task):
+        """Called when a task is queued, from within its parent"""
+        if not self.is_sampled(task):
+            return
+        now = self._now()
+        parent = self.current
+        if len(self._queued) >= self.max_events:
+            return
+        self._queued[task.id] = (now, parent is not None)
+        if parent is not None:
+            self._add({'name': 'yield', 'cat': 'flow', 'ph': 's',
+                       'id': self._flow_id(task.id), 'ts': now})
+
+    def begin_task(self, task):
+        now = self._now()
+        if not self.is_sampled(task):
+            self._stack().append(None)
+            return
+        queued_at, has_parent = self._queued.pop(task.id, (None, False))
+        self._stack().append((task, now))
+        if queued_at is not None:
+            self._add({'name': 'queued', 'cat': 'queue', 'ph': 'X',
+                       'ts': queued_at, 'dur': now - queued_at,
+                       'args': {'task': task.id}})
+        if has_parent:
+            self._add({'name': 'yield', 'cat': 'flow', 'ph': 'f',
+                       'bp': 'e', 'id': self._flow_id(task.id), 'ts': now})
+
+    def end_task(self, task, outcome=None):
+        item = self._stack().pop()
+        if item is None:
+            return
+        start = item[1]
+        self._add({'name': task.type, 'cat': 'task', 'ph': 'X',
+                   'ts': start, 'dur': self._now() - start,
+                   'args': {'task': task.id, 'outcome': outcome}})
+
+    def begin(self):
+        """Start a span within the current task, if traced"""
+        if self.current is None:
+            return None
+        return self._now()
+
+    def end(self, start, name, cat, **args):
+        """End a span started with :py:meth:`begin`"""
+        if start is None:
+            return
+        self._add({'name': name, 'cat': cat, 'ph': 'X', 'ts': start,
+                   'dur': self._now() - start, 'args': args})
+
+    def export(self, path=None):
+        """Write the trace to ``path`` in the Chrome trace event format"""
+        path = path or self.path
+        with open(path, 'w') as fp:
+            json.dump({'traceEvents': self.events,
+                       'displayTimeUnit': 'ms'}, fp)
+        return path
@@ -0,0 +1,212 @@
+"""
+Fetch transports for the :py:class:`~simplespider.web.Downloader`
+
+A transport turns an URL into an :py:class:`HttpResponse`; they all
+build the same response dicts, so they can be swapped freely, eg. to
+use a faster HTTP client, or to run a crawl offline::
+
+    Downloader(transport=Urllib3Transport(maxsize=4))
+    Downloader(transport=DictTransport({'http://example.com/': '<html>'}))
+
+Errors that should count as a failure of the remote host (for the
+circuit breaker, and to retry the task) are the ones listed in the
+``errors`` attribute of each transport.
+"""
+
+import httplib
+import mimetypes
+import os
+import urllib
+import urlparse
+
+import requests
+import requests.structures
+import requests.utils
+
+try:
+    import urllib3
+except ImportError:  # pragma: no cover
+    urllib3 = None
+
+
+class HttpResponse(dict):
+    def __init__(self, **kwargs):
+        kwargs.setdefault('headers', {})
+        kwargs.setdefault('content', '')
+        kwargs.setdefault('encoding', None)
+        kwargs.setdefault('ok', True)
+        kwargs.setdefault('status_code', None)
+        kwargs.setdefault('reason', '')
+        kwargs.setdefault('url', '')
+        self.update(kwargs)
+
+    def __repr__(self):
+        return "<HttpResponse {0!r} ({1!r})>".format(
+            self['status_code'], self['url'])
+
+
+def make_response(url, status_code, headers, content, reason=None):
+    """Build an :py:class:`HttpResponse` the way ``requests`` would"""
+    if reason is None:
+        reason = httplib.responses.get(status_code, '')
+    encoding = requests.utils.get_encoding_from_headers(
+        requests.structures.CaseInsensitiveDict(headers))
+    return HttpResponse(
+        headers=dict(headers),
+        content=content,
+        encoding=encoding,
+        ok=status_code < 400,
+        status_code=status_code,
+        reason=reason,
+        url=url)
+
+
+class BaseTransport(object):
+    errors = ()
+
+    def fetch(self, url, headers=None, timeout=None, allow_redirects=True):
+        """
+        Retrieve an URL.
+
+        :param headers: dict of request headers
+        :param timeout: ``(connect, read)`` timeouts, or a single
+            number for both, in seconds
+        :return: an :py:class:`HttpResponse`
+        """
+        raise NotImplementedError
+
+
+class RequestsTransport(BaseTransport):
+    """Fetch pages with ``requests``"""
+
+    errors = (requests.ConnectionError, requests.Timeout)
+
+    def __init__(self, session=None):
+        """
+        :param session: ``requests.Session`` to be used, eg. to keep
+            connections alive. (Default: None, one-off requests)
+        """
+        self.session = session
+
+    def fetch(self, url, headers=None, timeout=None, allow_redirects=True):
+        get = requests.get if self.session is None else self.session.get
+        response = get(url, headers=headers, timeout=timeout,
+                       allow_redirects=allow_redirects)
+        return HttpResponse(
+            headers=dict(response.headers),
+            content=response.content,
+            encoding=response.encoding,
+            ok=response.ok,
+            status_code=response.status_code,
+            reason=response.reason,
+            url=response.url,  # might change
+        )
+
+
+class Urllib3Transport(BaseTransport):
+    """Fetch pages with an ``urllib3`` pool manager"""
+
+    def __init__(self, pool_manager=None, max_redirects=30, **kwargs):
+        """
+        :param pool_manager: ``urllib3.PoolManager`` to be used.
+            (Default: a new one, created with the extra arguments)
+        :param max_redirects: maximum number of redirects to follow
+        """
+        if urllib3 is None:  # pragma: no cover
+            raise RuntimeError("urllib3 is not installed")
+        self.errors = (urllib3.exceptions.HTTPError,)
+        if pool_manager is None:
+            pool_manager = urllib3.PoolManager(**kwargs)
+        self.pool_manager = pool_manager
+        self.max_redirects = max_redirects
+
+    def fetch(self, url, headers=None, timeout=None, allow_redirects=True):
+        if isinstance(timeout, tuple):
+            timeout = urllib3.Timeout(connect=timeout[0], read=timeout[1])
+        retries = urllib3.Retry(
+            total=None, connect=0, read=0, status=0,
+            redirect=self.max_redirects if allow_redirects else 0,
+            raise_on_redirect=False)
+        response = self.pool_manager.request(
+            'GET', url, headers=headers, timeout=timeout, retries=retries,
+            redirect=allow_redirects)
+
+        final_url = url
+        if response.retries is not None:
+            for redirect in response.retries.history:
+                if redirect.redirect_location:
+                    final_url = urlparse.urljoin(final_url,
+                                                 redirect.redirect_location)
+        return make_response(final_url, response.status,
+                             response.headers, response.data,
+                             reason=response.reason)
+
+
+class FileTransport(BaseTransport):
+    """
+    Read pages from the local filesystem.
+
+    ``file://`` URLs are read as they are; if ``root`` is set, HTTP
+    URLs are mapped to ``<root>/<host>/<path>`` too, so that mirrored
+    sites (eg. with ``wget -m``) can be crawled offline. URLs pointing
+    to directories are served their ``index.html``.
+    """
+
+    errors = (IOError, OSError)
+
+    def __init__(self, root=None, index='index.html'):
+        self.root = root
+        self.index = index
+
+    def _path(self, url):
+        parts = urlparse.urlsplit(url)
+        path = urllib.url2pathname(parts.path)
+        if parts.scheme == 'file':
+            return path
+        if self.root is not None and parts.scheme in ('http', 'https'):
+            path = os.path.normpath('/' + path).lstrip('/')
+            return os.path.join(self.root, parts.netloc, path)
+        return None
+
+    def fetch(self, url, headers=None, timeout=None, allow_redirects=True):
+        path = self._path(url)
+        if path is not None and os.path.isdir(path):
+            path = os.path.join(path, self.index)
+        if path is None or not os.path.isfile(path):
+            return make_response(url, 404, {'Content-Type': 'text/plain'},
+                                 'Not found')
+        with open(path, 'rb') as fp:
+            content = fp.read()
+        content_type = mimetypes.guess_type(path)[0] or \
+            'application/octet-stream'
+        return make_response(url, 200, {
+            'Content-Type': content_type,
+            'Content-Length': str(len(content)),
+        }, content)
+
+
+class DictTransport(BaseTransport):
+    """
+    Serve pages from a dict, for tests and benchmarks.
+
+    Values can be the page content (served as HTML), a
+    ``(status_code, headers, content)`` tuple, or a complete
+    :py:class:`HttpResponse`. Missing URLs get a 404.
+    """
+
+    def __init__(self, pages=None):
+        self.pages = pages if pages is not None else {}
+
+    def fetch(self, url, headers=None, timeout=None, allow_redirects=True):
+        page = self.pages.get(url)
+        if page is None:
+            return make_response(url, 404, {'Content-Type': 'text/plain'},
+                                 'Not found')
+        if isinstance(page, HttpResponse):
+            return HttpResponse(**page)
+        if isinstance(page, tuple):
+            status_code, page_headers, content = page
+            return make_response(url, status_code, page_headers, content)
+        return make_response(url, 200, {
+            'Content-Type': 'text/html; charset=utf-8',
+        }, page)
@@ -2,6 +2,9 @@
 Miscellaneous utilities
 """
 
+import os
+import urlparse
+
 
 def lazy_property(fn):
     attr_name = '_lazy_' + fn.__name__
@@ -18,3 +21,21 @@ def lazy_property(fn):
         delattr(self, attr_name)
 
     return property(fget=getter, fset=setter, fdel=deleter, doc=fn.__doc__)
+
+
+def url_host(url):
+    """Return the (lowercase) host name for an URL, or None"""
+    try:
+        return urlparse.urlsplit(url).hostname
+    except (AttributeError, ValueError):
+        return None
+
+
+def current_rss():
+    """Current resident set size of this process, in bytes, or None"""
+    try:
+        with open('/proc/self/statm') as fp:
+            pages = int(fp.read().split()[1])
+    except (IOError, OSError, ValueError, IndexError):
+        return None  # Not on Linux
+    return pages * os.sysconf('SC_PAGE_SIZE')
@@ -5,13 +5,18 @@ Web-crawler related stuff
 import cgi
 import logging
 import re
+import time
 import urlparse
+import weakref
 
 import lxml.html
-import requests
 import requests.utils
 
-from simplespider import BaseTask, BaseTaskRunner
+from simplespider import BaseTask, BaseTaskRunner, AbortTask, DeferTask, \
+    RetryTask
+from simplespider.hosts import CircuitBreaker
+from simplespider.transports import HttpResponse, RequestsTransport  # noqa
+from simplespider.utils import url_host
 
 logger = logging.getLogger(__name__)
 
@@ -22,23 +27,133 @@ def default_user_agent():
                     requests.utils.default_user_agent()))
 
 
-class HttpResponse(dict):
-    def __init__(self, **kwargs):
-        kwargs.setdefault('headers', {})
-        kwargs.setdefault('content', '')
-        kwargs.setdefault('encoding', None)
-        kwargs.setdefault('ok', True)
-        kwargs.setdefault('status_code', None)
-        kwargs.setdefault('reason', '')
-        kwargs.setdefault('url', '')
-        self.update(kwargs)
+def _trail_from_list(urls):
+    return Trail.from_list(urls)
+
+
+class Trail(object):
+    """
+    The URLs followed to reach a page, as an immutable linked list.
+
+    Each node only holds its own URL and a reference to its parent, so
+    the links found in a page all share their parent's trail, and the
+    depth is known without walking it. Nodes are interned: extending
+    the same trail with the same URL twice returns the same node.
+
+    Trails behave as read-only sequences of URLs, from the first to
+    the last one; use :py:meth:`to_list` to get a plain list.
+    """
+
+    __slots__ = ['url', 'parent', 'depth', '__weakref__']
+
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, url, parent=None):
+        if isinstance(url, str):
+            url = intern(url)
+        ## Parents are alive as long as their children are, so their
+        ## id is unique for as long as the key is in the dict.
+        key = (id(parent), url)
+        node = cls._interned.get(key)
+        if node is None:
+            node = object.__new__(cls)
+            node.url = url
+            node.parent = parent
+            node.depth = 1 if parent is None else parent.depth + 1
+            cls._interned[key] = node
+        return node
+
+    @classmethod
+    def from_list(cls, urls):
+        """Build a trail from a list of URLs; None if empty"""
+        node = None
+        for url in urls:
+            node = cls(url, node)
+        return node
+
+    @classmethod
+    def coerce(cls, trail):
+        """Turn a list (or None) into a trail"""
+        if trail is None or isinstance(trail, cls):
+            return trail
+        return cls.from_list(trail)
+
+    def extend(self, url):
+        """Return the trail continuing with ``url``"""
+        return Trail(url, self)
+
+    def to_list(self):
+        urls = [None] * self.depth
+        node = self
+        while node is not None:
+            urls[node.depth - 1] = node.url
+            node = node.parent
+        return urls
+
+    def __len__(self):
+        return self.depth
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __getitem__(self, index):
+        return self.to_list()[index]
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if isinstance(other, Trail):
+            return self.depth == other.depth and \
+                self.to_list() == other.to_list()
+        if isinstance(other, (list, tuple)):
+            return self.to_list() == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = object.__hash__
+
+    def __copy__(self):
+        return self  # immutable
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        ## Pickle as a flat list, not as a chain of nested nodes
+        return _trail_from_list, (self.to_list(),)
 
     def __repr__(self):
-        return "<HttpResponse {0!r} ({1!r})>".format(
-            self['status_code'], self['url'])
+        return "Trail({0!r})".format(self.to_list())
+
+
+class _WebTask(BaseTask):
+    """Task carrying the ``trail`` that lead to its URL"""
+
+    __slots__ = []
+
+    def __init__(self, task_id=None, **kwargs):
+        if task_id is None:
+            task_id = ':'.join((self.type, kwargs['url']))
+            ## Revisits of a page must not be deduplicated
+            if kwargs.get('revisit'):
+                task_id = '{0}#{1}'.format(task_id, kwargs['revisit'])
+        if 'trail' in kwargs:
+            kwargs['trail'] = Trail.coerce(kwargs['trail'])
+        super(_WebTask, self).__init__(task_id, **kwargs)
+
+    def to_dict(self):
+        data = super(_WebTask, self).to_dict()
+        if data.get('trail') is not None:
+            data['trail'] = data['trail'].to_list()
+        return data
 
 
-class DownloadTask(BaseTask):
+class DownloadTask(_WebTask):
     __slots__ = []
 
     def __init__(self, task_id=None, **kwargs):
@@ -48,15 +163,19 @@ class DownloadTask(BaseTask):
         :param url: the URL to be retrieved
         :param retry: how many times this task should be retried.
             Defaults to 2.
+        :param trail: the :py:class:`Trail` (or list of URLs)
+            followed to reach the URL
+        :param revisit: revisit number of the URL, for recrawls;
+            part of the task id.
+        :param etag, last_modified: validators from the previous
+            visit, sent for a conditional request
         """
         kwargs.setdefault("url", None)
         kwargs.setdefault("retry", 2)
-        if task_id is None:
-            task_id = ':'.join((self.type, kwargs['url']))
         super(DownloadTask, self).__init__(task_id, **kwargs)
 
 
-class ScrapingTask(BaseTask):
+class ScrapingTask(_WebTask):
     __slots__ = []
 
     def __init__(self, task_id=None, **kwargs):
@@ -65,57 +184,265 @@ class ScrapingTask(BaseTask):
 
         :param url: URL from which the page was retrieved
         :param response: HTTP response for the page
+        :param trail: the :py:class:`Trail` followed to reach the URL
+        :param revisit: see :py:class:`DownloadTask`
         """
         kwargs.setdefault("url", None)
         kwargs.setdefault("response", None)
-        if task_id is None:
-            task_id = ':'.join((self.type, kwargs['url']))
         super(ScrapingTask, self).__init__(task_id, **kwargs)
 
 
 class Downloader(BaseTaskRunner):
     def __init__(self, **kwargs):
+        """
+        :param max_depth:
+            maximum length of the trail followed to reach a page.
+            (Default: 0, meaning "infinite")
+        :param timeout:
+            ``(connect, read)`` timeouts for requests, in seconds. Can
+            be overridden by the ``timeout`` attribute of tasks.
+            (Default: ``(10, 30)``)
+        :param host_timeouts:
+            dict of per-host timeouts, overriding ``timeout``.
+        :param circuit_breaker:
+            :py:class:`~simplespider.hosts.CircuitBreaker` used to stop
+            sending requests to failing hosts for a while, or None to
+            disable. (Default: a new circuit breaker)
+        :param circuit_open:
+            what to do with tasks for hosts whose circuit is open:
+            ``'defer'`` them until the host is due to be probed
+            again, or ``'fail'`` them right away. Deferred tasks are
+            failed too, once the host is considered dead by the
+            circuit breaker. (Default: 'defer')
+        :param concurrency:
+            :py:class:`~simplespider.hosts.AdaptiveConcurrency` used to
+            limit the requests sent to each host; tasks exceeding the
+            host window are deferred. (Default: None)
+        :param metrics:
+            :py:class:`~simplespider.metrics.Registry` used to keep
+            per-host statistics about requests. (Default: None)
+        :param transport:
+            :py:class:`~simplespider.transports.BaseTransport` used
+            to fetch the pages. (Default: a new
+            :py:class:`~simplespider.transports.RequestsTransport`)
+        :param archive:
+            :py:class:`~simplespider.archive.HttpArchive` the
+            responses are recorded to. (Default: None)
+        :param replay:
+            :py:class:`~simplespider.archive.HttpArchive` the
+            responses are read from, instead of the network; tasks
+            for URLs missing from it are aborted. (Default: None)
+        :param robots:
+            :py:class:`~simplespider.robots.RobotsCache` used to abort
+            tasks for URLs disallowed by robots.txt, and to defer them
+            while it's unavailable (until ``circuit_breaker`` tells the
+            host is dead; without one, they're retried instead); its
+            crawl delays are applied to ``concurrency``. (Default: None)
+        :param budget:
+            :py:class:`~simplespider.budget.CrawlBudget` the pages and
+            bytes fetched from each host are counted against.
+            (Default: None)
+        """
         kwargs.setdefault('max_depth', 0)  # 0 means "infinite"
         kwargs.setdefault('allow_redirects', True)
         kwargs.setdefault('user_agent', True)
+        kwargs.setdefault('timeout', (10, 30))
+        kwargs.setdefault('host_timeouts', {})
+        if 'circuit_breaker' not in kwargs:
+            kwargs['circuit_breaker'] = CircuitBreaker()
+        kwargs.setdefault('circuit_open', 'defer')
+        kwargs.setdefault('concurrency', None)
+        kwargs.setdefault('metrics', None)
+        if kwargs.get('transport') is None:
+            kwargs['transport'] = RequestsTransport()
+        kwargs.setdefault('archive', None)
+        kwargs.setdefault('replay', None)
+        kwargs.setdefault('robots', None)
+        kwargs.setdefault('budget', None)
         super(Downloader, self).__init__(**kwargs)
 
+        robots = self.conf['robots']
+        if robots is not None:
+            if robots.transport is None:
+                robots.transport = self.conf['transport']
+            if robots.concurrency is None:
+                robots.concurrency = self.conf['concurrency']
+
+        metrics = self.conf['metrics']
+        if metrics is not None:
+            self._m_bytes = metrics.counter(
+                'simplespider_fetched_bytes_total', 'Bytes downloaded',
+                ['host'])
+            self._m_responses = metrics.counter(
+                'simplespider_responses_total', 'HTTP responses',
+                ['host', 'status'])
+            self._m_errors = metrics.counter(
+                'simplespider_fetch_errors_total',
+                'Connection errors and timeouts', ['host'])
+            self._m_latency = metrics.histogram(
+                'simplespider_fetch_seconds', 'Time taken by requests',
+                ['host'])
+            self._m_disallowed = metrics.counter(
+                'simplespider_robots_disallowed_total',
+                'Pages not fetched because of robots.txt', ['host'])
+
     def match(self, task):
         if not isinstance(task, DownloadTask):
             logger.debug("Type mismatch")
             return False
-        if (self.conf['max_depth'] > 0) and \
-                len(task.get('trail') or []) > self.conf['max_depth']:
+        trail = task.get('trail')
+        if (self.conf['max_depth'] > 0) and trail is not None and \
+                len(trail) > self.conf['max_depth']:
             logger.debug("Trail length exceeded")
             return False
         return True
 
-    def __call__(self, task):
-        assert self.match(task)
+    def _get_timeout(self, task, host):
+        if task.get('timeout') is not None:
+            return task['timeout']
+        return self.conf['host_timeouts'].get(host, self.conf['timeout'])
+
+    def _check_circuit(self, host):
+        breaker = self.conf['circuit_breaker']
+        if breaker is None:
+            return
+        allowed, retry_after = breaker.allow(host)
+        if allowed:
+            return
+        if self.conf['circuit_open'] == 'fail':
+            raise AbortTask("Circuit open for host {0!r}".format(host))
+        if breaker.dead(host):
+            raise AbortTask("Host {0!r} is down".format(host))
+        raise DeferTask("Circuit open for host {0!r}".format(host),
+                        retry_after=retry_after)
+
+    def _check_robots(self, url):
+        robots = self.conf['robots']
+        breaker = self.conf['circuit_breaker']
+        host = url_host(url)
+        rules = robots.cached(url)
+        if rules is None:
+            ## Fetching robots.txt is a request to the host like any
+            ## other: it goes through the circuit breaker
+            self._check_circuit(host)
+            rules = robots.rules(url)
+            if breaker is not None:
+                if rules.unavailable:
+                    breaker.record_failure(host)
+                else:
+                    breaker.record_success(host)
+        if rules.unavailable:
+            message = "robots.txt unavailable for {0!r}".format(url)
+            retry_after = robots.retry_after(url)
+            if breaker is None:
+                ## Nothing tells when to give up: use the task retries
+                raise RetryTask(message, retry_after=retry_after)
+            if breaker.dead(host):
+                raise AbortTask("Host {0!r} is down".format(host))
+            raise DeferTask(message, retry_after=retry_after)
+        if not rules.allowed(url):
+            if self.conf['metrics'] is not None:
+                self._m_disallowed.inc(labels=(url_host(url),))
+            raise AbortTask("{0!r} is disallowed by robots.txt".format(url))
+
+    def _acquire_slot(self, host):
+        concurrency = self.conf['concurrency']
+        if concurrency is None:
+            return
+        allowed, retry_after = concurrency.acquire(host)
+        if not allowed:
+            raise DeferTask("Too many requests to {0!r}".format(host),
+                            retry_after=retry_after)
+
+    def _fetch(self, task):
+        host = url_host(task['url'])
+        self._check_circuit(host)
+        try:
+            self._acquire_slot(host)
+        except DeferTask:
+            ## If this was to be the probe, let the next request be it
+            if self.conf['circuit_breaker'] is not None:
+                self.conf['circuit_breaker'].cancel_probe(host)
+            raise
+
         headers = {
             'User-agent': default_user_agent(),
         }
-        response = requests.get(task['url'], headers=headers)
-
-        ## We need to serialize this!
-        response_dict = HttpResponse(
-            headers=dict(response.headers),
-            content=response.content,
-            encoding=response.encoding,
-            ok=response.ok,
-            status_code=response.status_code,
-            reason=response.reason,
-            url=response.url,  # might change
-        )
+        if task.get('etag'):
+            headers['If-None-Match'] = task['etag']
+        if task.get('last_modified'):
+            headers['If-Modified-Since'] = task['last_modified']
+        breaker = self.conf['circuit_breaker']
+        concurrency = self.conf['concurrency']
+        transport = self.conf['transport']
+        start = time.time()
+        try:
+            response = transport.fetch(
+                task['url'], headers=headers,
+                timeout=self._get_timeout(task, host),
+                allow_redirects=self.conf['allow_redirects'])
+        except transport.errors:
+            if breaker is not None:
+                breaker.record_failure(host)
+            if concurrency is not None:
+                concurrency.release(host, error=True)
+            if self.conf['metrics'] is not None:
+                self._m_errors.inc(labels=(host,))
+            raise
+        except Exception:
+            ## Not the host's fault (eg. an invalid URL, or too many
+            ## redirects): if this was a probe, the next one will do
+            if breaker is not None:
+                breaker.cancel_probe(host)
+            if concurrency is not None:
+                concurrency.release(host)
+            raise
+
+        latency = time.time() - start
+        status_code = response['status_code']
+        if concurrency is not None:
+            concurrency.release(host, latency=latency,
+                                status_code=status_code)
+        if self.conf['metrics'] is not None:
+            self._m_latency.observe(latency, (host,))
+            self._m_bytes.inc(len(response['content']), (host,))
+            self._m_responses.inc(labels=(host, status_code))
+        if self.conf['budget'] is not None:
+            self.conf['budget'].record_fetch(host, len(response['content']))
+
+        if breaker is not None:
+            if status_code >= 500:
+                breaker.record_failure(host)
+            else:
+                breaker.record_success(host)
+        return response
 
-        ## Keep history of the followed "trail"
-        trail = task.get('trail') or []
+    def __call__(self, task):
+        assert self.match(task)
 
+        replay = self.conf['replay']
+        if replay is not None:
+            response_dict = replay.get(task['url'])
+            if response_dict is None:
+                raise AbortTask("{0!r} is not in the archive"
+                                .format(task['url']))
+        else:
+            if self.conf['robots'] is not None:
+                self._check_robots(task['url'])
+            response_dict = self._fetch(task)
+            if self.conf['archive'] is not None:
+                self.conf['archive'].record(task['url'], response_dict)
+
+        ## Keep history of the followed "trail"
+        extra = {}
+        if task.get('revisit'):
+            extra['revisit'] = task['revisit']
         yield ScrapingTask(
             url=task['url'],
-            trail=trail,
+            trail=task.get('trail'),
             response=response_dict,
-            tags=['wikipedia'])
+            tags=['wikipedia'],
+            **extra)
 
 
 class BaseScraper(BaseTaskRunner):
@@ -155,6 +482,8 @@ class LinkExtractor(BaseScraper):
             yield url
 
     def _extract_links(self, response):
+        if not response['content']:
+            return  # eg. "304 Not Modified"
         content_type, params = cgi.parse_header(
             response['headers'].get('content-type') or 'text/html')
 
@@ -176,13 +505,11 @@ class LinkExtractor(BaseScraper):
         assert self.match(task)
         response = task['response']
 
-        ## Trail that was followed to find this link
-        trail = []
-        if task.get('trail'):
-            trail.extend(task['trail'])
-        trail.append(task['url'])
+        ## Trail that was followed to find this link; it is shared
+        ## by all the links found in the page.
+        trail = Trail(task['url'], Trail.coerce(task.get('trail')))
         if response['url'] != task['url']:
-            trail.append(response['url'])
+            trail = trail.extend(response['url'])
 
         ## Extract all links in this page
         links = self._extract_links(response)